@@ -0,0 +1,92 @@
+#assemble many P16 programs at once and make rom and ram schematics for each of them, e.g.
+#    python batch.py "programs/*.txt" --out builds --workers 8
+#each program's schematics go in their own directory under --out, named after the source file
+import os
+import io
+import sys
+import glob
+import time
+import argparse
+import contextlib
+import concurrent.futures
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) #so main can be imported wherever this is run from
+
+import main as p16
+
+
+#expand any glob patterns in paths, keeping the order they were given in and dropping repeats
+def find_sources(paths):
+    sources = []
+    for path in paths:
+        matches = sorted(glob.glob(path)) if glob.has_magic(path) else [path]
+        for match in matches:
+            if not match in sources:
+                sources.append(match)
+    return sources
+
+
+#assemble one program and save its schematics in out_dir, this is what the worker processes run
+#returns a dict of timings and an error message if it failed
+def build_program(source, out_dir, active_pages, compression = "default"):
+    result = {"source" : source, "out_dir" : out_dir, "error" : None, "compile" : 0.0, "schem" : 0.0}
+    try:
+        start = time.perf_counter()
+        with open(source) as f:
+            rom, ram = p16.compile_assembly(f.read())
+        result["compile"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        os.makedirs(out_dir, exist_ok = True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            p16.nibbles_to_schem(rom, ram, active_pages = active_pages, out_dir = out_dir, compression = compression)
+        result["schem"] = time.perf_counter() - start
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+#build every source on a pool of workers processes, saving each one's schematics to out_root/<source name>
+#returns the results of build_program in the order of sources
+def build_programs(sources, out_root, workers = None, active_pages = p16.DEFAULT_ACTIVE_PAGES, compression = "default"):
+    out_dirs = [os.path.join(out_root, os.path.splitext(os.path.basename(source))[0]) for source in sources]
+    for out_dir in out_dirs:
+        if out_dirs.count(out_dir) != 1:
+            raise ValueError(f"More than one program would be saved to {out_dir}, rename them so that their file names differ")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as pool:
+        return list(pool.map(build_program, sources, out_dirs, [active_pages] * len(sources), [compression] * len(sources)))
+
+
+def print_summary(results, total):
+    width = max([len("program")] + [len(result["source"]) for result in results])
+    print(f"{'program':<{width}}  {'compile':>9}  {'schem':>9}")
+    for result in results:
+        if result["error"] is None:
+            print(f"{result['source']:<{width}}  {1000 * result['compile']:7.1f}ms  {1000 * result['schem']:7.1f}ms  -> {result['out_dir']}")
+        else:
+            print(f"{result['source']:<{width}}  failed: {result['error']}")
+    failed = sum(result["error"] is not None for result in results)
+    print(f"{len(results) - failed} built, {failed} failed in {total:.2f}s")
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Assemble P16 programs and make their rom and ram schematics")
+    parser.add_argument("sources", nargs = "+", help = "assembly files or glob patterns")
+    parser.add_argument("--out", default = "builds", help = "directory to put each program's schematics in")
+    parser.add_argument("--workers", type = int, default = None, help = "number of processes, defaults to one per cpu")
+    parser.add_argument("--pages", type = int, nargs = "+", default = sorted(p16.DEFAULT_ACTIVE_PAGES), help = "rom pages to build")
+    parser.add_argument("--compression", choices = p16.schemgen.COMPRESSIONS, default = "default", help = "how to compress the schematics")
+    args = parser.parse_args(argv)
+
+    sources = find_sources(args.sources)
+    if len(sources) == 0:
+        parser.error("no assembly files found")
+
+    start = time.perf_counter()
+    results = build_programs(sources, args.out, args.workers, set(args.pages), args.compression)
+    print_summary(results, time.perf_counter() - start)
+    return 1 if any(result["error"] is not None for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
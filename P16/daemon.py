@@ -0,0 +1,266 @@
+#a P16 build server which keeps running between builds, so that a build doesn't pay for starting python, importing nbtlib,
+#or recompiling pages that haven't changed since someone last sent them. Start it with
+#    python daemon.py serve
+#and then build through it with
+#    python daemon.py build assembly.txt --out build
+#or by POSTing {"code" : ...} to http://127.0.0.1:8016/build yourself, see BuildServer.build for what else can be sent
+#GET /stats returns how many requests it has handled, its cache hit rates and how long builds take
+#it only listens on localhost, and the schematics are sent back in the response rather than saved anywhere
+#only the server imports main (and with it numpy, nbtlib and schemgen), so sending it a build starts quickly
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+import threading
+import collections
+import http.client
+import http.server
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) #so main can be imported wherever this is run from
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8016
+
+#how many whole build results are kept, the assembly cache is kept too so a miss here still only recompiles changed pages
+RESULT_CACHE_SIZE = 64
+#the least recently used assembly cache entries are dropped past this many, so a server left running for a long time doesn't keep growing
+ASSEMBLY_CACHE_LIMIT = 100000
+#how many of the most recent timings the latency percentiles are taken over
+LATENCY_WINDOW = 1000
+
+
+#the timings of something the server does, for the stats
+class Latencies():
+    def __init__(self):
+        self.recent = collections.deque(maxlen = LATENCY_WINDOW)
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.recent.append(seconds)
+            self.count += 1
+            self.total += seconds
+
+    #in milliseconds, the percentiles are of the last LATENCY_WINDOW timings
+    def stats(self):
+        with self.lock:
+            recent = sorted(self.recent)
+            count, total = self.count, self.total
+        if count == 0:
+            return {"count" : 0}
+        return {"count" : count, "mean_ms" : 1000 * total / count,
+                "p50_ms" : 1000 * recent[len(recent) // 2], "p95_ms" : 1000 * recent[(95 * len(recent)) // 100], "max_ms" : 1000 * recent[-1]}
+
+
+def hit_rate(hits, misses):
+    return {"hits" : hits, "misses" : misses, "hit_rate" : hits / (hits + misses) if hits + misses != 0 else None}
+
+
+#what the server remembers between requests. Requests are handled on their own threads, so everything shared is locked
+class BuildServer():
+    def __init__(self):
+        import main as p16 #only imported by the server, see the top of this file
+        self.p16 = p16
+        self.assembly_cache = p16.AssemblyCache()
+        self.compile_lock = threading.Lock() #compile_assembly changes the cache as it goes
+        self.results = collections.OrderedDict() #request key -> response, least recently used first
+        self.results_lock = threading.Lock()
+        self.result_hits = 0
+        self.result_misses = 0
+        self.requests = 0
+        self.errors = 0
+        self.latencies = {"compile" : Latencies(), "schematics" : Latencies(), "build" : Latencies()}
+        self.started = time.time()
+
+    #request is a dict of
+    #    "code"          the assembly to build
+    #    "pages"         which rom pages to build, by default main.DEFAULT_ACTIVE_PAGES
+    #    "compression"   one of schemgen.COMPRESSIONS, by default "default"
+    #    "schematics"    false to only compile, by default true
+    #returns a dict of "rom" and "ram" as returned by compile_assembly (with the keys as strings), "schematics", a dict of
+    #file name -> base64 of the file, and "cached", which is true if the whole response was remembered from an earlier request
+    #raises P16SyntaxError for bad assembly and ValueError for bad requests
+    def build(self, request):
+        p16 = self.p16
+        start = time.perf_counter()
+        code = request.get("code")
+        pages = request.get("pages", sorted(p16.DEFAULT_ACTIVE_PAGES))
+        compression = request.get("compression", "default")
+        schematics = request.get("schematics", True)
+        if type(code) != str:
+            raise ValueError("\"code\" must be the assembly as a string")
+        if type(pages) != list or not all(type(page) == int and 0 <= page < 16 for page in pages):
+            raise ValueError("\"pages\" must be a list of rom pages from 0-15")
+        p16.schemgen.check_compression(compression)
+
+        key = hashlib.sha256(repr((code, sorted(set(pages)), compression, bool(schematics))).encode("utf-8")).hexdigest()
+        with self.results_lock:
+            response = self.results.get(key)
+            if response is not None:
+                self.results.move_to_end(key)
+                self.result_hits += 1
+            else:
+                self.result_misses += 1
+        if response is not None:
+            self.latencies["build"].add(time.perf_counter() - start)
+            return dict(response, cached = True)
+
+        with self.compile_lock:
+            compile_start = time.perf_counter()
+            self.assembly_cache.trim(ASSEMBLY_CACHE_LIMIT)
+            rom, ram = p16.compile_assembly(code, self.assembly_cache)
+            self.latencies["compile"].add(time.perf_counter() - compile_start)
+
+        files = {}
+        if schematics:
+            schem_start = time.perf_counter()
+            files = p16.nibbles_to_schem_bytes(rom, ram, set(pages), compression = compression)
+            self.latencies["schematics"].add(time.perf_counter() - schem_start)
+
+        response = {"rom" : {str(page) : nibbles for page, nibbles in rom.items()},
+                    "ram" : {str(addr) : nibbles for addr, nibbles in ram.items()},
+                    "schematics" : {name : base64.b64encode(data).decode("ascii") for name, data in files.items()}}
+        with self.results_lock:
+            self.results[key] = response
+            while len(self.results) > RESULT_CACHE_SIZE:
+                self.results.popitem(last = False)
+        self.latencies["build"].add(time.perf_counter() - start)
+        return dict(response, cached = False)
+
+    def stats(self):
+        with self.results_lock:
+            results = hit_rate(self.result_hits, self.result_misses)
+            results["size"] = len(self.results)
+        with self.compile_lock:
+            assembly = hit_rate(self.assembly_cache.hits, self.assembly_cache.misses)
+            assembly["size"] = len(self.assembly_cache.entries)
+        return {"uptime" : time.time() - self.started, "requests" : self.requests, "errors" : self.errors,
+                "result_cache" : results, "assembly_cache" : assembly,
+                "block_states" : len(self.p16.schemgen.BLOCK_STATES.names),
+                "latency" : {name : latencies.stats() for name, latencies in self.latencies.items()}}
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.build_server.stats())
+        else:
+            self.send_json(404, {"error" : f"Unknown path {self.path}, GET /stats or POST /build"})
+
+    def do_POST(self):
+        build_server = self.server.build_server
+        if self.path != "/build":
+            self.send_json(404, {"error" : f"Unknown path {self.path}, GET /stats or POST /build"})
+            return
+        with build_server.results_lock:
+            build_server.requests += 1
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if type(request) != dict:
+                raise ValueError("The request must be a json object")
+            self.send_json(200, build_server.build(request))
+        except (build_server.p16.P16SyntaxError, ValueError) as e: #json's errors are ValueErrors too
+            with build_server.results_lock:
+                build_server.errors += 1
+            self.send_json(400, {"error" : str(e)})
+        except Exception as e:
+            with build_server.results_lock:
+                build_server.errors += 1
+            self.send_json(500, {"error" : f"{type(e).__name__}: {e}"})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(host = DEFAULT_HOST, port = DEFAULT_PORT, verbose = False):
+    server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.build_server = BuildServer()
+    server.verbose = verbose
+    print(f"Serving P16 builds on http://{host}:{port}, POST /build or GET /stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+#send a request to a running server, returning the decoded json response. Errors the server reports are raised as RuntimeErrors
+def request_server(method, path, body = None, host = DEFAULT_HOST, port = DEFAULT_PORT):
+    connection = http.client.HTTPConnection(host, port)
+    try:
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        connection.request(method, path, data, {"Content-Type" : "application/json"})
+        response = connection.getresponse()
+        result = json.loads(response.read())
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError(result["error"])
+    return result
+
+#build code on a running server, returns rom and ram as compile_assembly does and a dict of schematic file name -> bytes
+#active_pages defaults to main.DEFAULT_ACTIVE_PAGES
+def remote_build(code, active_pages = None, compression = "default", host = DEFAULT_HOST, port = DEFAULT_PORT):
+    request = {"code" : code, "compression" : compression}
+    if active_pages is not None:
+        request["pages"] = sorted(active_pages)
+    result = request_server("POST", "/build", request, host, port)
+    rom = {int(page) : nibbles for page, nibbles in result["rom"].items()}
+    ram = {int(addr) : nibbles for addr, nibbles in result["ram"].items()}
+    return rom, ram, {name : base64.b64decode(data) for name, data in result["schematics"].items()}
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Serve P16 builds from a process that stays running, or send builds to it")
+    parser.add_argument("--host", default = DEFAULT_HOST)
+    parser.add_argument("--port", type = int, default = DEFAULT_PORT)
+    commands = parser.add_subparsers(dest = "command", required = True)
+    serve_parser = commands.add_parser("serve", help = "run the server until it is interrupted")
+    serve_parser.add_argument("--verbose", action = "store_true", help = "log every request")
+    build_parser = commands.add_parser("build", help = "build an assembly file on the server and save its schematics")
+    build_parser.add_argument("source", help = "assembly file")
+    build_parser.add_argument("--out", default = ".", help = "directory to save rom.schem and ram.schem in")
+    build_parser.add_argument("--pages", type = int, nargs = "+", help = "rom pages to build, defaults to the same ones as main.py")
+    build_parser.add_argument("--compression", default = "default", help = "how to compress the schematics, one of schemgen.COMPRESSIONS")
+    commands.add_parser("stats", help = "print the server's stats")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(args.host, args.port, args.verbose)
+    elif args.command == "build":
+        with open(args.source) as f:
+            code = f.read()
+        start = time.perf_counter()
+        rom, ram, schematics = remote_build(code, args.pages, args.compression, args.host, args.port)
+        os.makedirs(args.out, exist_ok = True)
+        for name, data in schematics.items():
+            #renamed into place once written, like schemgen.atomic_write does
+            path = os.path.join(args.out, name)
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        print(f"Built {len(rom)} rom and {len(ram)} ram pages and saved {', '.join(schematics)} to \"{args.out}\" "
+              f"in {1000 * (time.perf_counter() - start):.1f}ms")
+    elif args.command == "stats":
+        print(json.dumps(request_server("GET", "/stats", host = args.host, port = args.port), indent = 4))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
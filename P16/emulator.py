@@ -0,0 +1,428 @@
+#an emulator for the P16, for running the output of compile_assembly without pasting it into minecraft
+#
+#the machine as modelled here:
+#   16 registers r0-r15 and a stack of 16 bit values, most instructions work on the top of the stack
+#   16 rom pages of 256 nibbles, and 4096 nibbles of ram which also holds 1024 16 bit words (most significant nibble first)
+#   code addresses are 8 bit nibble offsets into the current page, ram pages start at 4 * their .PRAM word address
+#   CALL pushes the return address onto a separate call stack, and RETURN with an empty call stack halts
+#
+#instructions are decoded once per page into tuples of (handler, length, a, b) using a table keyed by their leading nibble
+#
+#flags (Z, N, V, C) only become visible FLAG_LATENCY nibbles after the start of the instruction that set them, which is what .WAITFLAG pads for
+#reading flags any sooner gets the old ones and is recorded in flag_hazards
+
+import collections
+
+
+#how many nibbles after the start of a flag setting instruction its flags can be read, see parse_waitflag in main.py
+FLAG_LATENCY = 7
+
+FLAG_C = 1
+FLAG_V = 2
+FLAG_N = 4
+FLAG_Z = 8
+
+
+class P16EmulatorError(Exception):
+    def __str__(self):
+        return "P16 Emulator error: " + super().__str__()
+
+
+#BRANCH_TABLE[condition][flags] is whether BRANCH with that condition is taken, the I conditions (0 and 1) are handled separately
+def make_branch_table():
+    def conditions(flags):
+        c = bool(flags & FLAG_C)
+        v = bool(flags & FLAG_V)
+        n = bool(flags & FLAG_N)
+        z = bool(flags & FLAG_Z)
+        return [False, False, z, not z, n, not n, v, not v, c, not c,
+                c and not z, not c or z, n == v, n != v, not z and n == v, z or n != v]
+    table = [[False] * 16 for _ in range(16)]
+    for flags in range(16):
+        for cond, taken in enumerate(conditions(flags)):
+            table[cond][flags] = taken
+    return table
+
+BRANCH_TABLE = make_branch_table()
+
+
+def logic_flags(value):
+    return (FLAG_Z if value == 0 else 0) | (FLAG_N if value & 0x8000 else 0)
+
+#flags for a + b + carry_in
+def add_flags(a, b, carry_in):
+    total = a + b + carry_in
+    value = total & 0xFFFF
+    flags = logic_flags(value)
+    if total > 0xFFFF:
+        flags |= FLAG_C
+    if (a ^ value) & (b ^ value) & 0x8000:
+        flags |= FLAG_V
+    return value, flags
+
+#a - b is a + ~b + 1, so C set means no borrow
+def sub_flags(a, b, carry_in = 1):
+    return add_flags(a, b ^ 0xFFFF, carry_in)
+
+
+#ALM1 instructions act on the top of the stack. Each updates the stack and returns the flags to set
+#only the ones which use the carry flag read the flags
+#P and K versions of an instruction pop and keep the top of the stack respectively
+def alm1_pass(emu):
+    return logic_flags(emu.stack[-1])
+
+def alm1_not(emu):
+    emu.stack[-1] ^= 0xFFFF
+    return logic_flags(emu.stack[-1])
+
+def alm1_pread(emu):
+    emu.stack.append(emu.read_word(emu.stack.pop()))
+    return logic_flags(emu.stack[-1])
+
+def alm1_kread(emu):
+    emu.stack.append(emu.read_word(emu.stack[-1]))
+    return logic_flags(emu.stack[-1])
+
+def alm1_inc(emu):
+    emu.stack[-1], flags = add_flags(emu.stack[-1], 1, 0)
+    return flags
+
+def alm1_cin(emu):
+    emu.stack[-1], flags = add_flags(emu.stack[-1], 0, emu.read_flags() & FLAG_C)
+    return flags
+
+def alm1_dec(emu):
+    emu.stack[-1], flags = sub_flags(emu.stack[-1], 1)
+    return flags
+
+def alm1_cdec(emu):
+    emu.stack[-1], flags = sub_flags(emu.stack[-1], 0, emu.read_flags() & FLAG_C)
+    return flags
+
+def alm1_ptf(emu):
+    return logic_flags(emu.stack.pop())
+
+def alm1_dup(emu):
+    emu.stack.append(emu.stack[-1])
+    return logic_flags(emu.stack[-1])
+
+def alm1_ktf(emu):
+    return logic_flags(emu.stack[-1])
+
+def alm1_del(emu):
+    return logic_flags(emu.stack.pop())
+
+def shift_right(emu, top_bit):
+    old = emu.stack[-1]
+    emu.stack[-1] = (old >> 1) | top_bit
+    return logic_flags(emu.stack[-1]) | (FLAG_C if old & 1 else 0)
+
+def alm1_rsh(emu):
+    return shift_right(emu, 0)
+
+def alm1_crsh(emu):
+    return shift_right(emu, 0x8000 if emu.read_flags() & FLAG_C else 0)
+
+def alm1_irsh(emu):
+    return shift_right(emu, 0x8000)
+
+def alm1_arsh(emu):
+    return shift_right(emu, emu.stack[-1] & 0x8000)
+
+#in the same order as ALM1_OPPS in main.py
+ALM1_HANDLERS = [alm1_pass, alm1_not, alm1_pread, alm1_kread, alm1_inc, alm1_cin, alm1_dec, alm1_cdec,
+                 alm1_ptf, alm1_dup, alm1_ktf, alm1_del, alm1_rsh, alm1_crsh, alm1_irsh, alm1_arsh]
+
+
+#ALM2 instructions act on the top of the stack and register r, otherwise they are like the ALM1 ones
+def alm2_swap(emu, r):
+    emu.stack[-1], emu.registers[r] = emu.registers[r], emu.stack[-1]
+    return logic_flags(emu.stack[-1])
+
+def alm2_sub(emu, r):
+    emu.stack[-1], flags = sub_flags(emu.stack[-1], emu.registers[r])
+    return flags
+
+def alm2_kwrite(emu, r):
+    emu.write_word(emu.stack[-1], emu.registers[r])
+    return logic_flags(emu.registers[r])
+
+def alm2_pwrite(emu, r):
+    emu.write_word(emu.stack.pop(), emu.registers[r])
+    return logic_flags(emu.registers[r])
+
+def alm2_and(emu, r):
+    emu.stack[-1] &= emu.registers[r]
+    return logic_flags(emu.stack[-1])
+
+def alm2_nand(emu, r):
+    emu.stack[-1] = (emu.stack[-1] & emu.registers[r]) ^ 0xFFFF
+    return logic_flags(emu.stack[-1])
+
+def alm2_or(emu, r):
+    emu.stack[-1] |= emu.registers[r]
+    return logic_flags(emu.stack[-1])
+
+def alm2_nor(emu, r):
+    emu.stack[-1] = (emu.stack[-1] | emu.registers[r]) ^ 0xFFFF
+    return logic_flags(emu.stack[-1])
+
+def alm2_xor(emu, r):
+    emu.stack[-1] ^= emu.registers[r]
+    return logic_flags(emu.stack[-1])
+
+def alm2_nxor(emu, r):
+    emu.stack[-1] = emu.stack[-1] ^ emu.registers[r] ^ 0xFFFF
+    return logic_flags(emu.stack[-1])
+
+def alm2_rtf(emu, r):
+    return logic_flags(emu.registers[r])
+
+def alm2_cmp(emu, r):
+    value, flags = sub_flags(emu.stack[-1], emu.registers[r])
+    return flags
+
+#unlike ADD, SADD sets the flags. SSUB is SUB with its operands swapped
+def alm2_sadd(emu, r):
+    emu.stack[-1], flags = add_flags(emu.stack[-1], emu.registers[r], 0)
+    return flags
+
+def alm2_ssub(emu, r):
+    emu.stack[-1], flags = sub_flags(emu.registers[r], emu.stack[-1])
+    return flags
+
+def alm2_cadd(emu, r):
+    emu.stack[-1], flags = add_flags(emu.stack[-1], emu.registers[r], emu.read_flags() & FLAG_C)
+    return flags
+
+def alm2_csub(emu, r):
+    emu.stack[-1], flags = sub_flags(emu.stack[-1], emu.registers[r], emu.read_flags() & FLAG_C)
+    return flags
+
+#in the same order as ALM2_OPPS in main.py
+ALM2_HANDLERS = [alm2_swap, alm2_sub, alm2_kwrite, alm2_pwrite, alm2_and, alm2_nand, alm2_or, alm2_nor,
+                 alm2_xor, alm2_nxor, alm2_rtf, alm2_cmp, alm2_sadd, alm2_ssub, alm2_cadd, alm2_csub]
+
+
+#instruction handlers take the emulator, the address of the next instruction and the decoded operands a and b
+#they return the address to continue from, or None if they have moved to another page
+def op_pass(emu, pc, a, b):
+    return pc
+
+def op_value(emu, pc, a, b):
+    emu.stack.append(a)
+    return pc
+
+def op_jump(emu, pc, a, b):
+    return a
+
+def op_branch(emu, pc, a, b):
+    if b < 2:
+        taken = (len(emu.inputs) != 0) == (b == 0)
+    else:
+        taken = BRANCH_TABLE[b][emu.read_flags()]
+    if taken:
+        return a
+    return pc
+
+def op_push(emu, pc, a, b):
+    emu.stack.append(emu.registers[a])
+    return pc
+
+def op_pop(emu, pc, a, b):
+    emu.registers[a] = emu.stack.pop()
+    return pc
+
+def op_call(emu, pc, a, b):
+    emu.calls.append((emu.medium, emu.location, pc))
+    return a
+
+def op_return(emu, pc, a, b):
+    if len(emu.calls) == 0:
+        emu.halted = True
+        return pc
+    emu.goto(*emu.calls.pop())
+
+def op_add(emu, pc, a, b):
+    emu.stack[-1] = (emu.stack[-1] + emu.registers[a]) & 0xFFFF
+    return pc
+
+def op_rotate(emu, pc, a, b):
+    value = emu.registers[b]
+    emu.registers[b] = ((value << a) | (value >> (16 - a))) & 0xFFFF
+    return pc
+
+def op_alm1(emu, pc, a, b):
+    emu.set_flags(ALM1_HANDLERS[a](emu))
+    return pc
+
+def op_alm2(emu, pc, a, b):
+    emu.set_flags(ALM2_HANDLERS[a](emu, b))
+    return pc
+
+def op_call_rom(emu, pc, a, b):
+    emu.calls.append((emu.medium, emu.location, pc))
+    emu.goto("ROM", b, a)
+
+def op_call_ram(emu, pc, a, b):
+    location = emu.stack.pop() % 2 ** 12
+    emu.calls.append((emu.medium, emu.location, pc))
+    emu.goto("RAM", location, a)
+
+def op_input(emu, pc, a, b):
+    if len(emu.inputs) == 0:
+        emu.stack.append(0)
+    else:
+        emu.stack.append(emu.inputs.popleft() & 0xFFFF)
+    return pc
+
+def op_output(emu, pc, a, b):
+    emu.outputs.append((a, emu.stack.pop()))
+    return pc
+
+
+#decoders take the nibbles of a page and the address of an instruction and return its (handler, length, a, b)
+def byte_at(nibbles, pc):
+    return 16 * nibbles[pc % 256] + nibbles[(pc + 1) % 256]
+
+def decode_value(nibbles, pc):
+    value = 0
+    for k in range(1, 5):
+        value = 16 * value + nibbles[(pc + k) % 256]
+    return (op_value, 5, value, None)
+
+def decode_output(nibbles, pc):
+    address = []
+    k = 1
+    while True:
+        n = nibbles[(pc + k) % 256]
+        k += 1
+        if n >= 8:
+            address.append(n - 8)
+            break
+        address.append(n)
+        if k > 256:
+            raise P16EmulatorError(f"OUTPUT at {pc} has no end to its address")
+    return (op_output, k, tuple(address), None)
+
+DECODERS = [lambda nibbles, pc : (op_pass, 1, None, None),
+            decode_value,
+            lambda nibbles, pc : (op_jump, 3, byte_at(nibbles, pc + 1), None),
+            lambda nibbles, pc : (op_branch, 4, byte_at(nibbles, pc + 2), nibbles[(pc + 1) % 256]),
+            lambda nibbles, pc : (op_push, 2, nibbles[(pc + 1) % 256], None),
+            lambda nibbles, pc : (op_pop, 2, nibbles[(pc + 1) % 256], None),
+            lambda nibbles, pc : (op_call, 3, byte_at(nibbles, pc + 1), None),
+            lambda nibbles, pc : (op_return, 1, None, None),
+            lambda nibbles, pc : (op_add, 2, nibbles[(pc + 1) % 256], None),
+            lambda nibbles, pc : (op_rotate, 3, nibbles[(pc + 1) % 256], nibbles[(pc + 2) % 256]),
+            lambda nibbles, pc : (op_alm1, 2, nibbles[(pc + 1) % 256], None),
+            lambda nibbles, pc : (op_alm2, 3, nibbles[(pc + 1) % 256], nibbles[(pc + 2) % 256]),
+            lambda nibbles, pc : (op_call_rom, 4, byte_at(nibbles, pc + 2), nibbles[(pc + 1) % 256]),
+            lambda nibbles, pc : (op_call_ram, 3, byte_at(nibbles, pc + 1), None),
+            lambda nibbles, pc : (op_input, 1, None, None),
+            decode_output]
+
+
+#the 256 nibbles of a page decoded at every address, so jumps into the middle of an instruction still work
+def decode_page(nibbles):
+    return [DECODERS[nibbles[pc]](nibbles, pc) for pc in range(256)]
+
+
+def parse_nibbles(text):
+    return ["0123456789ABCDEF".index(n) for n in text.replace(" ", "")]
+
+
+#rom and ram are as returned by compile_assembly, execution starts at the beginning of rom page start_page
+#inputs are the values INPUT reads in order, once they run out INPUT reads 0
+class P16Emulator():
+    def __init__(self, rom, ram, start_page = 0, inputs = ()):
+        self.rom = [[0] * 256 for _ in range(16)]
+        for page, text in rom.items():
+            nibbles = parse_nibbles(text)
+            if len(nibbles) > 256:
+                raise P16EmulatorError(f"rom page {page} is {len(nibbles)} nibbles long but pages only hold 256")
+            self.rom[page][:len(nibbles)] = nibbles
+        self.ram = [0] * 2 ** 12
+        for addr, text in ram.items():
+            for offset, n in enumerate(parse_nibbles(text)):
+                self.ram[(4 * addr + offset) % 2 ** 12] = n
+
+        self.registers = [0] * 16
+        self.stack = []
+        self.calls = [] #(medium, location, pc) to return to
+        self.inputs = collections.deque(inputs)
+        self.outputs = [] #(octal address, value) for each OUTPUT
+        self.flags = 0
+        self.pending_flags = [] #(clock when visible, flags) in the order they were set
+        self.flag_hazards = [] #(medium, location, pc, clock) of each instruction which read flags before they had settled
+        self.clock = 0 #nibbles executed so far
+        self.steps = 0 #instructions executed so far
+        self.halted = False
+
+        self.decoded_rom = {}
+        self.decoded_ram = {}
+        self.goto("ROM", start_page, 0)
+
+    #move execution to address pc of a rom page or of the ram page starting at word address location
+    def goto(self, medium, location, pc):
+        self.medium = medium
+        self.location = location
+        self.pc = pc
+        if medium == "ROM":
+            if not location in self.decoded_rom:
+                self.decoded_rom[location] = decode_page(self.rom[location])
+            self.code = self.decoded_rom[location]
+        else:
+            if not location in self.decoded_ram:
+                base = 4 * location
+                self.decoded_ram[location] = decode_page([self.ram[(base + k) % 2 ** 12] for k in range(256)])
+            self.code = self.decoded_ram[location]
+
+    def read_word(self, addr):
+        base = 4 * (addr % 2 ** 10)
+        ram = self.ram
+        return (ram[base] << 12) | (ram[base + 1] << 8) | (ram[base + 2] << 4) | ram[base + 3]
+
+    def write_word(self, addr, value):
+        base = 4 * (addr % 2 ** 10)
+        for k in range(4):
+            self.ram[base + k] = (value >> (12 - 4 * k)) & 15
+        #ram pages may have been changed, so decode them again when they are next run
+        self.decoded_ram.clear()
+        if self.medium == "RAM":
+            self.goto(self.medium, self.location, self.pc)
+
+    #the flags as seen by the current instruction
+    def read_flags(self):
+        while len(self.pending_flags) != 0 and self.pending_flags[0][0] <= self.clock:
+            self.flags = self.pending_flags.pop(0)[1]
+        if len(self.pending_flags) != 0:
+            self.flag_hazards.append((self.medium, self.location, self.pc, self.clock))
+        return self.flags
+
+    def set_flags(self, flags):
+        self.pending_flags.append((self.clock + FLAG_LATENCY, flags))
+
+    #run until the program halts or max_steps more instructions have been executed, returns how many were
+    def run(self, max_steps):
+        start = self.steps
+        end = self.steps + max_steps
+        steps = self.steps
+        code = self.code
+        pc = self.pc
+        try:
+            while steps < end and not self.halted:
+                handler, length, a, b = code[pc]
+                self.pc = pc
+                next_pc = handler(self, (pc + length) & 0xFF, a, b)
+                self.clock += length
+                steps += 1
+                #handlers which change page or rewrite the ram set self.code and self.pc themselves
+                code = self.code
+                pc = self.pc if next_pc is None else next_pc
+        except IndexError:
+            raise P16EmulatorError(f"stack underflow at {self.medium} {self.location} address {self.pc}")
+        finally:
+            self.steps = steps
+        self.pc = pc
+        return self.steps - start
@@ -1,380 +1,531 @@
+import os
+import re
 import sys
-sys.path.append('..') #hack to allow importing schemgen
-
+import time
+import gzip
+import json
+import bisect
+import struct
+import hashlib
+import argparse
+import contextlib
+import concurrent.futures
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")) #so schemgen can be imported wherever this is run from
+
+import numpy
+import nbtlib
 import schemgen
 
 
-def compile_assembly(code):
-    ALM1_OPPS = ["PASS", "NOT", "PREAD", "KREAD", "INC", "CIN", "DEC", "CDEC", "PTF", "DUP", "KTF", "DEL", "RSH", "CRSH", "IRSH", "ARSH"]
-    ALM2_OPPS = ["SWAP", "SUB", "KWRITE", "PWRITE", "AND", "NAND", "OR", "NOR", "XOR", "NXOR", "RTF", "CMP", "SADD", "SSUB", "CADD", "CSUB"]
-    BRANCH_CONDITIONS = {"I" : 0, "!I" : 1,
-                         "Z" : 2, "=" : 2, "!Z" : 3, "!=" : 3,
-                         "N" : 4, "!N" : 5,
-                         "V" : 6, "!V" : 7,
-                         "C" : 8, "u>=" : 8, "!C" : 9, "u<" : 9,
-                         "u>" : 10, "u<=" : 11,
-                         "s>=" : 12, "<" : 13,
-                         "s>" : 14, "s<=" : 15}
-            
-
-    class P16SyntaxError(Exception):
-        def __str__(self):
-            return "P16 Syntax error: " + super().__str__()
-
-
-    def parse_register(text):
-        assert text != ""
-        if text[0] != "r":
-            raise P16SyntaxError(f"Registers must begin with an \"r\", for example \"r5\"")
-        reg_num = parse_integer(text[1:])
-        if reg_num < 0 or reg_num > 15:
-            raise P16SyntaxError(f"Register range from r0-r15, r{reg_num} is out of this range")
-        return reg_num
-
-    def parse_integer(text):
-        try:
-            return int(text)
-        except ValueError:
-            raise P16SyntaxError(f"{text} is not an integer")
-
-    class Line():
-        def __init__(self, line):
-            self.line = line
-            self.bare_line = remove_comments(line)
-
-        def length(self):
-            return 0
-
-        def __str__(self):
-            return f"{type(self).__name__}({self.line})"
-
-    class OppLine(Line):
-        def __init__(self, line):
-            super().__init__(line)
-            line_split = self.bare_line.split(" ")
-            self.oppcode = line_split[0]
-            opperands = line_split[1:]
-            def check_num_opperands(n):
-                if len(opperands) != n:
-                    raise P16SyntaxError(f"Oppcode {self.oppcode} has the wrong number of opperands, got {len(opperands)} but need {n}")
-            if self.oppcode == "PASS":
-                check_num_opperands(0)
-            elif self.oppcode == "VALUE":
-                check_num_opperands(1)
-                self.value = parse_integer(opperands[0]) % (2 ** 16)
-            elif self.oppcode == "JUMP":
-                check_num_opperands(1)
-                self.jumpto_label = opperands[0]
-                self.jumpto_local = None
-            elif self.oppcode == "BRANCH":
-                check_num_opperands(2)
-                condition = opperands[0]
-                if not condition in BRANCH_CONDITIONS:
-                    raise P16SyntaxError(f"Unknown branch condition {condition}, must be one of " + ", ".join(cond for cond in BRANCH_CONDITIONS))
-                self.condition = BRANCH_CONDITIONS[condition]
-                assert type(self.condition) == int and 0 <= self.condition < 16
-                self.jumpto_label = opperands[1]
-                self.jumpto_local = None
-            elif self.oppcode == "PUSH":
-                check_num_opperands(1)
-                self.register = parse_register(opperands[0])
-            elif self.oppcode == "POP":
-                check_num_opperands(1)
-                self.register = parse_register(opperands[0])
-            elif self.oppcode == "CALL":
-                check_num_opperands(1)
-                self.jumpto_label = opperands[0]
-                self.jumpto_local = None
-                #jumpto_page is set to:
-                #("INTERNAL", None) for local calls
-                #("ROM", page : int) for prom
-                #("RAM", addr : int) for pram
-                self.jumpto_page = None
-                #the length depends on the value of jumpto_page, so we need to figure it out before finding exact addresses
-            elif self.oppcode == "RETURN":
-                check_num_opperands(0)
-            elif self.oppcode == "ADD":
-                check_num_opperands(1)
-                self.register = parse_register(opperands[0])
-            elif self.oppcode == "ROTATE":
-                check_num_opperands(2)
-                self.rot_num = parse_integer(opperands[0])
-                self.register = parse_register(opperands[1])
-            elif self.oppcode in ALM1_OPPS:
-                check_num_opperands(0)
-            elif self.oppcode in ALM2_OPPS:
-                check_num_opperands(1)
-                self.register = parse_register(opperands[0])
-            elif self.oppcode == "PAGERETURN":
-                check_num_opperands(0)
-            elif self.oppcode == "INPUT":
-                check_num_opperands(0)
-            elif self.oppcode == "OUTPUT":
-                check_num_opperands(1)
-                adr_oct_str = opperands[0]
-                adr_oct = [parse_integer(n) for n in adr_oct_str.split(".")]
-                for n in adr_oct:
-                    if n < 0 or n > 7:
-                        raise P16SyntaxError(f"Octal output address values must range from 0-7 separated by dots, {adr_oct_str} is not of this form")
-                self.address_octal = tuple(adr_oct)
-            else:
-                raise P16SyntaxError(f"Unknown oppcode {self.oppcode}")
-            
-            self.address = None
-
-        def sets_flags(self):
-            if self.oppcode in ALM1_OPPS:
-                return True
-            if self.oppcode in ALM2_OPPS:
-                return True
-            return False
-
-        def length(self):
-            return len(self.compile())
-
-        def compile(self):
-            def int8_to_nibbles(val):
-                if val is None:
-                    return "XX"
-                else:
-                    return "0123456789ABCDEF"[val // 16] + "0123456789ABCDEF"[val % 16]
-
-            if self.oppcode == "PASS":
-                return "0"
-            elif self.oppcode == "VALUE":
-                return "1" + "0123456789ABCDEF"[(self.value // (2 ** 12)) % 16] + "0123456789ABCDEF"[(self.value // (2 ** 8)) % 16] + "0123456789ABCDEF"[(self.value // (2 ** 4)) % 16] + "0123456789ABCDEF"[self.value % 16]
-            elif self.oppcode == "JUMP":
-                return "2" + int8_to_nibbles(self.jumpto_local)
-            elif self.oppcode == "BRANCH":
-                return "3" + "0123456789ABCDEF"[self.condition] + int8_to_nibbles(self.jumpto_local)
-            elif self.oppcode == "PUSH":
-                return "4" + "0123456789ABCDEF"[self.register]
-            elif self.oppcode == "POP":
-                return "5" + "0123456789ABCDEF"[self.register]
-            elif self.oppcode == "CALL":
-                medium, location = self.jumpto_page
-                if medium == "INTERNAL":
-                    return "6" + int8_to_nibbles(self.jumpto_local)
-                elif medium == "ROM":
-                    return "C" + "0123456789ABCDEF"[location] + int8_to_nibbles(self.jumpto_local)
-                elif medium == "RAM":
-                    #push address
-                    ans = "1" + "0123456789ABCDEF"[(location // (2 ** 12)) % 16] + "0123456789ABCDEF"[(location // (2 ** 8)) % 16] + "0123456789ABCDEF"[(location // (2 ** 4)) % 16] + "0123456789ABCDEF"[location % 16]
-                    #then call ram
-                    ans += "D" + int8_to_nibbles(self.jumpto_local)
-                    return ans
-                else:
-                    assert False
-            elif self.oppcode == "RETURN":
-                return "7"
-            elif self.oppcode == "ADD":
-                return "8" + "0123456789ABCDEF"[self.register]
-            elif self.oppcode == "ROTATE":
-                return "9" + "0123456789ABCDEF"[self.rot_num % 16] + "0123456789ABCDEF"[self.register]
-            elif self.oppcode in ALM1_OPPS:
-                return "A" + "0123456789ABCDEF"[ALM1_OPPS.index(self.oppcode)]
-            elif self.oppcode in ALM2_OPPS:
-                return "B" + "0123456789ABCDEF"[ALM2_OPPS.index(self.oppcode)] + "0123456789ABCDEF"[self.register]
-            elif self.oppcode == "INPUT":
-                return "E"
-            elif self.oppcode == "OUTPUT":
-                return "F" + "".join(str(n) for n in self.address_octal[:-1]) + "89ABCDEF"[self.address_octal[-1]]
-            else:
-                raise P16SyntaxError(f"Unknown oppcode \"{self.oppcode}\"")
-                                    
-    class DirLine(Line):
-        def __init__(self, line):
-            super().__init__(line)
-            self.line_nodot = self.bare_line[1:]
-            line_split = self.line_nodot.split(" ")
-            self.cmd = line_split[0]
-            def check_num_opperands(n):
-                if len(opperands) != n:
-                    raise P16SyntaxError(f"Directive command .{self.cmd} has the wrong number of opperands, got {len(opperands)} but need {n}")
-            opperands = line_split[1:]
-            if self.cmd == "PROM":
-                check_num_opperands(1)
-                self.page = parse_integer(opperands[0])
-                if self.page != self.page % 16:
-                    raise P16SyntaxError(f"rom page numbers range from 0-15, {self.page} is out of this range")
-            elif self.cmd == "LABEL":
-                check_num_opperands(1)
-                self.label = opperands[0]
-            elif self.cmd == "WAITFLAG":
-                #add pass so that 6 nibbles have passed sinse the last flag setting opperation
-                check_num_opperands(0)
-            elif self.cmd == "PRAM":
-                check_num_opperands(1)
-                self.address = parse_integer(opperands[0])
-                if not (0 <= self.address < 2 ** 12):
-                    raise P16SyntaxError(f"ram page addresses range from 0 to {2**12-1}, {self.address} is out of this range")
+#the start of each .PROM and .PRAM line, which is where the pages are split
+PAGE_DIRECTIVE = re.compile(r"^[ \t]*\.(PROM|PRAM)\b", re.MULTILINE)
+
+
+#where the command line keeps its AssemblyCache
+ASSEMBLY_CACHE_PATH = "assembly_cache.json"
+
+
+#remembers what compile_assembly worked out about each page, keyed by a hash of the page's text and whatever it depends on in other pages
+#passing the same cache to compile_assembly again means only pages which changed, or whose CALLs now land somewhere else, are recompiled
+#if path is given the cache is loaded from there and compile_assembly saves it back when it is done. A cache file which can't be
+#read is treated as empty, as it only ever saves work
+#entries are kept in the order they were last used, and only the limit most recently used are saved, so a file kept between
+#edits holds what the last few builds needed rather than growing with every one of them
+class AssemblyCache():
+    #bump this whenever the assembler changes what it produces, so that stale caches on disk are thrown away
+    VERSION = 2
+    #a build of every page uses around 100 entries, and an edit to a page only replaces that page's few
+    SAVED_ENTRIES = 512
+
+    def __init__(self, path = None, limit = SAVED_ENTRIES):
+        self.path = path
+        self.limit = limit
+        self.entries = {} #key -> value, least recently used first
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    saved = json.load(f)
+            except (OSError, ValueError): #a truncated or corrupt file, json's errors are ValueErrors
+                saved = None
+            if type(saved) == dict and saved.get("version") == self.VERSION and type(saved.get("entries")) == dict:
+                self.entries = saved["entries"]
+
+    def entry_key(self, *key):
+        return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+    def get(self, *key):
+        entry_key = self.entry_key(*key)
+        value = self.entries.pop(entry_key, None)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries[entry_key] = value #moved to the end as the most recently used
+            self.changed = True #so that the order is saved, otherwise entries every build hits would be the first to be dropped
+        return value
+
+    def put(self, value, *key):
+        entry_key = self.entry_key(*key)
+        self.entries.pop(entry_key, None)
+        self.entries[entry_key] = value
+        self.changed = True
+
+    #drops the least recently used entries until there are at most limit left
+    def trim(self, limit):
+        if len(self.entries) > limit:
+            for entry_key in list(self.entries)[: len(self.entries) - limit]:
+                del self.entries[entry_key]
+            self.changed = True
+
+    def save(self):
+        if self.path is not None and self.changed:
+            self.trim(self.limit)
+            with schemgen.atomic_write(self.path) as f:
+                f.write(json.dumps({"version" : self.VERSION, "entries" : self.entries}).encode("utf-8"))
+            self.changed = False
+
+
+class P16SyntaxError(Exception):
+    def __str__(self):
+        return "P16 Syntax error: " + super().__str__()
+
+
+HEX_DIGITS = "0123456789ABCDEF"
+ALM1_OPPS = ["PASS", "NOT", "PREAD", "KREAD", "INC", "CIN", "DEC", "CDEC", "PTF", "DUP", "KTF", "DEL", "RSH", "CRSH", "IRSH", "ARSH"]
+ALM2_OPPS = ["SWAP", "SUB", "KWRITE", "PWRITE", "AND", "NAND", "OR", "NOR", "XOR", "NXOR", "RTF", "CMP", "SADD", "SSUB", "CADD", "CSUB"]
+BRANCH_CONDITIONS = {"I" : 0, "!I" : 1,
+                     "Z" : 2, "=" : 2, "!Z" : 3, "!=" : 3,
+                     "N" : 4, "!N" : 5,
+                     "V" : 6, "!V" : 7,
+                     "C" : 8, "u>=" : 8, "!C" : 9, "u<" : 9,
+                     "u>" : 10, "u<=" : 11,
+                     "s>=" : 12, "<" : 13,
+                     "s>" : 14, "s<=" : 15}
+#how a CALL is encoded, which depends on the kind of page it calls, formatted with (rom page or ram address, local address of the label)
+#a call into ram pushes the address of the ram page and then calls it
+CALL_ENCODINGS = {"INTERNAL" : "6{1:02X}", "ROM" : "C{0:X}{1:02X}", "RAM" : "1{0:04X}D{1:02X}"}
+CALL_LENGTHS = {"INTERNAL" : 3, "ROM" : 4, "RAM" : 8}
+
+
+def parse_integer(text):
+    try:
+        return int(text)
+    except ValueError:
+        raise P16SyntaxError(f"{text} is not an integer")
+
+def parse_register(text):
+    assert text != ""
+    if text[0] != "r":
+        raise P16SyntaxError(f"Registers must begin with an \"r\", for example \"r5\"")
+    reg_num = parse_integer(text[1:])
+    if reg_num < 0 or reg_num > 15:
+        raise P16SyntaxError(f"Register range from r0-r15, r{reg_num} is out of this range")
+    return reg_num
+
+def parse_condition(text):
+    if not text in BRANCH_CONDITIONS:
+        raise P16SyntaxError(f"Unknown branch condition {text}, must be one of " + ", ".join(cond for cond in BRANCH_CONDITIONS))
+    return BRANCH_CONDITIONS[text]
+
+#an output address like 1.2.7 is parsed straight to its nibbles, the last part is offset by 8 to mark the end of the address
+def parse_octal(text):
+    adr_oct = [parse_integer(n) for n in text.split(".")]
+    for n in adr_oct:
+        if n < 0 or n > 7:
+            raise P16SyntaxError(f"Octal output address values must range from 0-7 separated by dots, {text} is not of this form")
+    return "".join(str(n) for n in adr_oct[:-1]) + "89ABCDEF"[adr_oct[-1]]
+
+#how each kind of opperand is parsed, labels are kept as they are until the pages have been laid out
+OPPERAND_PARSERS = {"register" : parse_register,
+                    "value" : lambda text : parse_integer(text) % (2 ** 16),
+                    "rotation" : lambda text : parse_integer(text) % 16,
+                    "condition" : parse_condition,
+                    "octal" : parse_octal,
+                    "label" : str}
+
+
+#everything the assembler needs to know about one oppcode
+#encoding is a format string which is given the parsed opperands, or None for oppcodes which are parsed but can't be compiled
+#if one of the opperands is a label then label_index is its position, it is given the label's local address when formatted
+class OppSpec():
+    __slots__ = ("oppcode", "parsers", "encoding", "label_index", "length", "sets_flags")
+
+    def __init__(self, oppcode, opperands, encoding, length = None):
+        self.oppcode = oppcode
+        self.parsers = tuple(OPPERAND_PARSERS[kind] for kind in opperands)
+        self.encoding = encoding
+        self.label_index = opperands.index("label") if "label" in opperands else None
+        self.length = length #only needed for oppcodes with a label, the rest are encoded as soon as they are parsed
+        self.sets_flags = oppcode in ALM1_OPPS or oppcode in ALM2_OPPS
+
+OPP_SPECS = {spec.oppcode : spec for spec in
+             [OppSpec(opp, (), "A" + HEX_DIGITS[i]) for i, opp in enumerate(ALM1_OPPS)] +
+             [OppSpec(opp, ("register",), "B" + HEX_DIGITS[i] + "{0:X}") for i, opp in enumerate(ALM2_OPPS)] +
+             [OppSpec("PASS", (), "0"), #PASS is also in ALM1_OPPS, but compiles to a single nibble
+              OppSpec("VALUE", ("value",), "1{0:04X}"),
+              OppSpec("JUMP", ("label",), "2{0:02X}", 3),
+              OppSpec("BRANCH", ("condition", "label"), "3{0:X}{1:02X}", 4),
+              OppSpec("PUSH", ("register",), "4{0:X}"),
+              OppSpec("POP", ("register",), "5{0:X}"),
+              OppSpec("CALL", ("label",), None), #see CALL_ENCODINGS
+              OppSpec("RETURN", (), "7"),
+              OppSpec("ADD", ("register",), "8{0:X}"),
+              OppSpec("ROTATE", ("rotation", "register"), "9{0:X}{1:X}"),
+              OppSpec("PAGERETURN", (), None),
+              OppSpec("INPUT", (), "E"),
+              OppSpec("OUTPUT", ("octal",), "F{0}")]}
+
+
+#one instruction of a page, nibbles is its encoding, or None until the local address of its label is known
+class OppLine():
+    __slots__ = ("line", "spec", "opperands", "nibbles", "length", "call_medium")
+
+    def __init__(self, line, bare_line):
+        self.line = line
+        line_split = bare_line.split(" ")
+        oppcode = line_split[0]
+        self.spec = spec = OPP_SPECS.get(oppcode)
+        if spec is None:
+            raise P16SyntaxError(f"Unknown oppcode {oppcode}")
+        if len(line_split) - 1 != len(spec.parsers):
+            raise P16SyntaxError(f"Oppcode {oppcode} has the wrong number of opperands, got {len(line_split) - 1} but need {len(spec.parsers)}")
+        self.opperands = tuple(parse(text) for parse, text in zip(spec.parsers, line_split[1:]))
+        #for CALLs this is set to "INTERNAL", "ROM" or "RAM" once it is known which kind of page the label is in
+        #the length depends on it, so it has to be set before the page can be laid out
+        self.call_medium = None
+        if spec.label_index is not None:
+            self.nibbles = None
+            self.length = spec.length
+        elif spec.encoding is None:
+            raise P16SyntaxError(f"Unknown oppcode \"{oppcode}\"")
+        else:
+            self.nibbles = spec.encoding.format(*self.opperands)
+            self.length = len(self.nibbles)
+
+    @property
+    def label(self):
+        return self.opperands[self.spec.label_index]
+
+    #the encoding once the label's local address is known, location is the rom page or ram address of the page it is in
+    def encode(self, location, local):
+        if not 0 <= local < 256:
+            raise P16SyntaxError(f"line {self} refers to label \"{self.label}\" at local address {local}, but pages only hold 256 nibbles")
+        if self.call_medium is not None:
+            return CALL_ENCODINGS[self.call_medium].format(location, local)
+        opperands = list(self.opperands)
+        opperands[self.spec.label_index] = local
+        return self.spec.encoding.format(*opperands)
+
+    def __str__(self):
+        return f"OppLine({self.line})"
+
+class DirLine():
+    __slots__ = ("line", "cmd", "opperand")
+
+    def __init__(self, line, bare_line):
+        self.line = line
+        line_split = bare_line[1:].split(" ")
+        self.cmd = line_split[0]
+        opperands = line_split[1:]
+        def check_num_opperands(n):
+            if len(opperands) != n:
+                raise P16SyntaxError(f"Directive command .{self.cmd} has the wrong number of opperands, got {len(opperands)} but need {n}")
+        self.opperand = None
+        if self.cmd == "PROM":
+            check_num_opperands(1)
+            self.opperand = parse_integer(opperands[0])
+            if self.opperand != self.opperand % 16:
+                raise P16SyntaxError(f"rom page numbers range from 0-15, {self.opperand} is out of this range")
+        elif self.cmd == "LABEL":
+            check_num_opperands(1)
+            self.opperand = opperands[0]
+        elif self.cmd == "WAITFLAG":
+            #add pass so that 6 nibbles have passed sinse the last flag setting opperation
+            check_num_opperands(0)
+        elif self.cmd == "PRAM":
+            #.PRAM auto leaves it to compile_assembly to find somewhere in the ram for the page
+            check_num_opperands(1)
+            if opperands[0] == "auto":
+                self.opperand = "auto"
             else:
-                raise P16SyntaxError(f"Unknown directive command .{self.cmd}")
-
-
-    def remove_comments(line):
-        if "#" in line:
-            idx = line.index("#")
-            return line[:idx].strip()
-        return line.strip()
-            
-
-
-    def make_line(line):
-        bare_line = remove_comments(line)
-        if bare_line == "":
-            return Line(line)
-        elif bare_line[0] == ".":
-            return DirLine(line)
+                self.opperand = parse_integer(opperands[0])
+            if self.opperand != "auto" and not (0 <= self.opperand < 2 ** 12):
+                raise P16SyntaxError(f"ram page addresses range from 0 to {2**12-1}, {self.opperand} is out of this range")
         else:
-            return OppLine(line)
-
-
-    class Page():
-        def __init__(self, ident, lines):       
-            self.lines = lines
-
-        @property
-        def length(self):
-            return sum(line.length() for line in self.lines)
-
-        def compile(self):
-            nibbles = " ".join(line.compile() for line in self.lines if isinstance(line, OppLine))
-            assert len(nibbles.replace(" ", "")) == self.length
-            return nibbles
-
-
-    lines = [make_line(line) for line in code.split("\n")]
-    pages = {} #page ident -> instructions
-    
-    current_page = None
-    for line in lines:
-        if isinstance(line, DirLine):
-            if line.cmd in {"PROM", "PRAM"}:
-                if line.cmd == "PROM":
-                    current_page = ("ROM", line.page)
-                elif line.cmd == "PRAM":
-                    current_page = ("RAM", line.address)
-
-                medium, location = current_page
-                if medium == "ROM":
-                    assert type(location) == int and 0 <= location < 16
-                elif medium == "RAM":
-                    assert type(location) == int and 0 <= location < 2 ** 12
-                    
-                if current_page in pages:
-                    raise P16SyntaxError(f".PROM and .PRAM can be called at most once for each address")
-
-                pages[current_page] = []
-                
-        if current_page is None and type(line) != Line: #disregard blank lines before the first page setter
+            raise P16SyntaxError(f"Unknown directive command .{self.cmd}")
+
+    def __str__(self):
+        return f"DirLine({self.line})"
+
+
+#an OppLine or DirLine for a line of code, or None if it is blank or just a comment
+def parse_line(line):
+    bare_line = line.partition("#")[0].strip()
+    if bare_line == "":
+        return None
+    elif bare_line[0] == ".":
+        return DirLine(line, bare_line)
+    else:
+        return OppLine(line, bare_line)
+
+
+#the source text of one page and what has been worked out about it so far
+#the text is parsed in one pass, which collects the labels and CALLs the page has for the cache
+#laying it out then takes one pass over the parsed lines, and compiling one pass over the instructions
+class PageSource():
+    def __init__(self, ident, text):
+        self.ident = ident
+        self.text = text
+        self.key = hashlib.sha256((repr(ident) + "\n" + text).encode("utf-8")).hexdigest()
+        self.info = None
+        self.lines = None #the OppLines and the LABEL and WAITFLAG DirLines, in order
+        self.calls = None
+        self.code = None #the OppLines once .WAITFLAGs have been expanded
+        self.local_lookup = None
+        self.length = None
+
+    def parse(self):
+        if self.lines is None:
+            self.lines = []
+            self.calls = []
+            labels = []
+            shared = {} #instructions without a label never change once they are parsed, so repeats of a line can share one OppLine
+            for text in self.text.split("\n"):
+                line = shared.get(text)
+                if line is None:
+                    line = parse_line(text)
+                    if type(line) is OppLine and line.nibbles is not None:
+                        shared[text] = line
+                if line is None:
+                    continue
+                elif type(line) is OppLine:
+                    if line.spec.oppcode == "CALL":
+                        self.calls.append(line)
+                elif line.cmd == "LABEL":
+                    labels.append(line.opperand)
+                elif line.cmd != "WAITFLAG":
+                    continue
+                self.lines.append(line)
+            self.info = {"labels" : labels, "calls" : [(line.label, str(line)) for line in self.calls]}
+        return self.lines
+
+    #set where the CALLs go, expand .WAITFLAGs into PASSes and find the local address of each label
+    def layout(self, label_page_lookup):
+        if self.code is None:
+            for line in self.calls:
+                call_ident = label_page_lookup[line.label]
+                line.call_medium = "INTERNAL" if call_ident == self.ident else call_ident[0]
+                line.length = CALL_LENGTHS[line.call_medium]
+
+            self.code = []
+            self.local_lookup = {}
+            local_addr = 0
+            last_flag_setter = 0
+            for line in self.parse():
+                if type(line) is OppLine:
+                    if line.spec.sets_flags:
+                        last_flag_setter = 0
+                    self.code.append(line)
+                    local_addr += line.length
+                    last_flag_setter += line.length
+                elif line.cmd == "LABEL":
+                    self.local_lookup[line.opperand] = local_addr
+                elif last_flag_setter < 7: #.WAITFLAG
+                    passes = 7 - last_flag_setter
+                    self.code.extend([PASS_LINE] * passes)
+                    local_addr += passes
+                    last_flag_setter = 7
+            self.length = local_addr
+
+    #the page's nibbles with a space between each instruction, locations gives the rom page or ram address of each page ident
+    def compile(self, label_page_lookup, label_local_lookup, locations):
+        nibbles = []
+        for line in self.code:
+            if line.nibbles is not None:
+                nibbles.append(line.nibbles)
+                continue
+            label = line.label
+            if not label in label_local_lookup:
+                raise P16SyntaxError(f"line {line} refers to label \"{label}\", but this label has not been assigned anywhere.")
+            call_ident = label_page_lookup[label]
+            if line.call_medium is None and call_ident != self.ident:
+                raise P16SyntaxError(f"line {line} refers to label \"{label}\". This label has been defined, but it must be defined in the current page for this opperation.")
+            nibbles.append(line.encode(locations[call_ident], label_local_lookup[label]))
+        nibbles = " ".join(nibbles)
+        assert len(nibbles) == self.length + max(len(self.code) - 1, 0)
+        return nibbles
+
+PASS_LINE = parse_line("PASS") #PASS lines have no state, so every .WAITFLAG can share this one
+
+
+#the number of nibbles in a page's code, not counting the spaces between instructions
+def nibble_count(nibbles):
+    return len(nibbles) - nibbles.count(" ")
+
+
+#the ram is 2 ** 12 nibbles, a .PRAM address is in 16 bit words so a page at address a starts at nibble 4 * a
+RAM_SIZE = 2 ** 12
+
+#which parts of the ram are used by which pages, kept as a list of (start, end, name) nibble intervals sorted by start
+#regions is a list of (start, length, name), every one which overlaps another or runs past the end of the ram is reported at once
+class RamMap():
+    def __init__(self, regions, size = RAM_SIZE):
+        self.size = size
+        self.regions = sorted((start, start + length, name) for start, length, name in regions if length != 0)
+        problems = []
+        last = None #the region seen so far which reaches furthest
+        for start, end, name in self.regions:
+            if end > size:
+                problems.append(f"{name} uses nibbles {start}-{end - 1} but the ram ends at nibble {size - 1}")
+            if last is not None and start < last[1]:
+                problems.append(f"{name} uses nibbles {start}-{end - 1} which overlap {last[2]} at nibbles {last[0]}-{last[1] - 1}")
+            if last is None or end > last[1]:
+                last = (start, end, name)
+        if len(problems) != 0:
+            raise P16SyntaxError("RAM pages don't fit: " + "; ".join(problems))
+
+    #the (start, end) of each unused stretch of ram
+    def gaps(self):
+        gaps = []
+        free_from = 0
+        for start, end, name in self.regions:
+            if start > free_from:
+                gaps.append((free_from, start))
+            free_from = max(free_from, end)
+        if free_from < self.size:
+            gaps.append((free_from, self.size))
+        return gaps
+
+    #find room for length nibbles starting on a word, returns the nibble it starts at
+    #the first gap big enough is used, so placing the biggest pages first packs them tightly
+    def place(self, length, name):
+        for start, end in self.gaps():
+            start = -(-start // 4) * 4
+            if end - start >= length:
+                bisect.insort(self.regions, (start, start + length, name))
+                return start
+        largest = max([end - -(-start // 4) * 4 for start, end in self.gaps()] + [0])
+        raise P16SyntaxError(f"{name} needs {length} nibbles of ram but the largest gap left is {largest} nibbles")
+
+    def used(self):
+        return sum(end - start for start, end, name in self.regions)
+
+    #a picture of the ram with a character for each word, "." for unused ones and a symbol for each page, followed by a key
+    def render(self, row_words = 64):
+        symbols = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+        words = ["."] * (self.size // 4)
+        key = []
+        for k, (start, end, name) in enumerate(self.regions):
+            symbol = symbols[k % len(symbols)]
+            words[start // 4 : -(-end // 4)] = symbol * (-(-end // 4) - start // 4)
+            key.append(f"  {symbol}  {name}: nibbles {start}-{end - 1}, {end - start} nibbles")
+        rows = [f"{4 * i:5}  " + "".join(words[i : i + row_words]) for i in range(0, len(words), row_words)]
+        largest = max([end - start for start, end in self.gaps()] + [0])
+        summary = f"{self.used()} of {self.size} nibbles of ram used ({100 * self.used() / self.size:.1f}%), largest gap {largest} nibbles"
+        return "\n".join(rows + key + [summary])
+
+#the RamMap of the ram pages returned by compile_assembly
+def ram_map(ram):
+    return RamMap([(4 * addr, nibble_count(nibbles), f".PRAM {addr}") for addr, nibbles in ram.items()])
+
+
+def compile_assembly(code, cache = None):
+    if cache is None:
+        cache = AssemblyCache()
+
+    #split the code into the text of each page, from its .PROM or .PRAM line up to the next one
+    #the pages are then handled separately so that the results for each can be cached, see AssemblyCache
+    starts = [match.start() for match in PAGE_DIRECTIVE.finditer(code)]
+    for line in code[:starts[0] if len(starts) != 0 else len(code)].split("\n"):
+        if parse_line(line) is not None: #disregard blank lines before the first page setter
             raise P16SyntaxError(f"You need to specify a page before any other commands. You probably need to add \".PROM 0\" as the first line of your code.")
-        if not current_page is None:
-            pages[current_page].append(line)
-        
-    #first we compute which page each label belongs to
+
+    pages = {} #page ident -> PageSource
+    auto_pages = [] #the idents of the .PRAM auto pages, which are ("RAM", "auto0"), ("RAM", "auto1"), ... until they are placed
+    for start, end in zip(starts, starts[1:] + [len(code)]):
+        text = code[start:end]
+        line = parse_line(text.split("\n", 1)[0])
+        ident = (line.cmd[1:], line.opperand) #("ROM", page) or ("RAM", address)
+        if line.opperand == "auto":
+            ident = ("RAM", f"auto{len(auto_pages)}")
+            auto_pages.append(ident)
+        if ident in pages:
+            raise P16SyntaxError(f".PROM and .PRAM can be called at most once for each address")
+        pages[ident] = PageSource(ident, text)
+
+    #first we find the labels each page defines and calls. This only depends on the page's own text
+    for ident, page in pages.items():
+        page.info = cache.get("info", page.key)
+        if page.info is None:
+            page.parse()
+            cache.put(page.info, "info", page.key)
+
+    #so we can compute which page each label belongs to
     label_page_lookup = {}
     for ident, page in pages.items():
-        for line in page:
-            if isinstance(line, DirLine):
-                if line.cmd == "LABEL":
-                    if line.label in label_page_lookup:
-                        raise P16SyntaxError(f"Label \"{line.label}\" cannot be used more than once")
-                    label_page_lookup[line.label] = ident
-
-    #now we can set the CALL instructions' jumpto_page
-    for ident in pages:
-        for line in pages[ident]:
-            if isinstance(line, OppLine):
-                if line.oppcode == "CALL":
-                    if not line.jumpto_label in label_page_lookup:
-                        raise P16SyntaxError(f"line {line} refers to label \"{line.jumpto_label}\", but this label has not been assigned anywhere.")
-                    call_ident = label_page_lookup[line.jumpto_label]
-                    if call_ident == ident:
-                        line.jumpto_page = ("INTERNAL", None)
-                    elif call_ident[0] == "ROM":
-                        line.jumpto_page = call_ident
-                    elif call_ident[0] == "RAM":
-                        line.jumpto_page = call_ident
-                    else:
-                        assert False
-
-    #now convert .WAITFLAGS into some PASS instructions. must do this after setting CALL instructions jumpto_page becasue only then do we know its length
-    def parse_waitflag(lines):    
-        new_lines = []
-        last_flag_setter = 0
-        for line in lines:
-            if isinstance(line, OppLine):
-                if line.sets_flags():
-                    last_flag_setter = 0
-
-            elif isinstance(line, DirLine):
-                if line.cmd == "WAITFLAG":
-                    while last_flag_setter < 7:
-                        new_lines.append(make_line("PASS"))
-                        last_flag_setter += 1
-                    continue
-                
-            new_lines.append(line)
-            last_flag_setter += line.length()
-        return new_lines
-    pages = {p : parse_waitflag(lines) for p, lines in pages.items()}
+        for label in page.info["labels"]:
+            if label in label_page_lookup:
+                raise P16SyntaxError(f"Label \"{label}\" cannot be used more than once")
+            label_page_lookup[label] = ident
+
+    for ident, page in pages.items():
+        for label, line in page.info["calls"]:
+            if not label in label_page_lookup:
+                raise P16SyntaxError(f"line {line} refers to label \"{label}\", but this label has not been assigned anywhere.")
 
     #then we compute the actual address. This is needed becasue the length of a CALL instruction depends on the type of page it is calling
+    #so a page's label addresses only change if its text changes or one of its CALLs now goes to a different kind of page
     label_local_lookup = {} #label -> local_addr
+    lengths = {} #page ident -> number of nibbles
     for ident, page in pages.items():
-        local_addr = 0
-        for line in page:
-            if isinstance(line, DirLine):
-                if line.cmd == "LABEL":
-                    if line.label in label_local_lookup:
-                        raise P16SyntaxError(f"Label \"{line.label}\" cannot be used more than once")
-                    label_local_lookup[line.label] = local_addr
-            local_addr += line.length()
+        call_pages = tuple(label_page_lookup[label] for label, line in page.info["calls"])
+        layout = cache.get("layout", page.key, call_pages)
+        if layout is None:
+            page.parse()
+            page.layout(label_page_lookup)
+            layout = {"labels" : page.local_lookup, "length" : page.length}
+            cache.put(layout, "layout", page.key, call_pages)
+        label_local_lookup.update(layout["labels"])
+        lengths[ident] = layout["length"]
 
     assert label_page_lookup.keys() == label_local_lookup.keys()
 
-    #now we can compute local jump/branch/call addresses
-    for ident in pages:
-        for line in pages[ident]:
-            if isinstance(line, OppLine):
-                if line.oppcode in {"JUMP", "BRANCH", "CALL"}:
-                    if not line.jumpto_label in label_local_lookup:
-                        raise P16SyntaxError(f"line {line} refers to label \"{line.jumpto_label}\", but this label has not been assigned anywhere.")
-                    goto_ident = label_page_lookup[line.jumpto_label]
-                    if line.oppcode in {"JUMP", "BRANCH"} and ident != goto_ident:
-                        raise P16SyntaxError(f"line {line} refers to label \"{line.jumpto_label}\". This label has been defined, but it must be defined in the current page for this opperation.")
-                    line.jumpto_local = label_local_lookup[line.jumpto_label]
-
-    pages = {ident : Page(ident, lines) for ident, lines in pages.items()}
+    #now the lengths are known the ram pages can be checked for overlaps and the .PRAM auto pages put in the gaps between them
+    ram_map = RamMap([(4 * ident[1], lengths[ident], f".PRAM {ident[1]}") for ident in pages if ident[0] == "RAM" and not ident in auto_pages])
+    locations = {ident : ident[1] for ident in pages} #page ident -> rom page or ram address
+    for ident in sorted(auto_pages, key = lambda ident : -lengths[ident]): #biggest first so they pack well
+        labels = pages[ident].info["labels"]
+        locations[ident] = ram_map.place(lengths[ident], ".PRAM auto" + (f" ({labels[0]})" if len(labels) != 0 else "")) // 4
+
+    #now we can compute local jump/branch/call addresses and compile
+    #a page's nibbles only change if its text changes or one of its CALLs now lands somewhere else
     compiled_rom = {}
     compiled_ram = {}
-    for ident in pages:
-        medium, location = ident
+    for ident, page in pages.items():
+        call_targets = tuple((label_page_lookup[label][0], locations[label_page_lookup[label]], label_local_lookup[label]) for label, line in page.info["calls"])
+        nibbles = cache.get("nibbles", page.key, call_targets)
+        if nibbles is None:
+            page.parse()
+            page.layout(label_page_lookup)
+            nibbles = page.compile(label_page_lookup, label_local_lookup, locations)
+            cache.put(nibbles, "nibbles", page.key, call_targets)
+
+        medium, location = ident[0], locations[ident]
         if medium == "ROM":
-            compiled_rom[location] = pages[ident].compile()
+            compiled_rom[location] = nibbles
         elif medium == "RAM":
-            compiled_ram[location] = pages[ident].compile()
+            compiled_ram[location] = nibbles
         else:
             assert False
-    
-    used_ram = set() #store the used ram locations in nibbles
-    for addr, nibbles in compiled_ram.items():
-        for offset, nibble in enumerate(nibbles):
-            i = 4 * addr + offset #4* here becasue there are 4 nibbles per 16 bit ram location
-            if i in used_ram:
-                raise P16SyntaxError(f"RAM address {i} is used for more than one thing")
-            elif i >= 2 ** 12:
-                raise P16SyntaxError(f"RAM address {i} is out of range")
-            else:
-                used_ram.add(i)
+    cache.save()
 
     for page, nibbles in compiled_rom.items():
-        for n in nibbles:
-            assert n in "0123456789ABCDEF "
+        assert set(nibbles) <= set("0123456789ABCDEF ")
     for addr, nibbles in compiled_ram.items():
-        for n in nibbles:
-            assert n in "0123456789ABCDEF "
+        assert set(nibbles) <= set("0123456789ABCDEF ")
                 
     return compiled_rom, compiled_ram
         
@@ -383,12 +534,122 @@ def print_nibbles(rom, ram):
     for idx, page in rom.items():
         print(f"Rom {idx}: " + page)
     for idx, page in ram.items():
-        print(f"Ram {idx}-{idx + len(page) // 4}: " + page)
-
-
-def nibbles_to_schem(rom, ram, active_pages = {1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15}):
-    print(ram)
-    
+        print(f"Ram {idx}-{idx + nibble_count(page) // 4}: " + page)
+
+
+#which rom pages nibbles_to_schem builds by default
+DEFAULT_ACTIVE_PAGES = {1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15}
+
+
+#the value of each nibble character, -1 for characters which aren't nibbles
+NIBBLE_VALUES = numpy.full(256, -1, dtype = numpy.int64)
+NIBBLE_VALUES[numpy.frombuffer(b"0123456789ABCDEF", dtype = numpy.uint8)] = numpy.arange(16)
+
+#the values of a string of nibbles as an array, padded with zeros or cut down to size if it is given
+def nibble_values(nibbles, size = None):
+    if size is not None:
+        nibbles = nibbles[:size]
+    data = nibbles.encode("utf-8")
+    values = NIBBLE_VALUES[numpy.frombuffer(data, dtype = numpy.uint8)]
+    if len(data) != len(nibbles) or (values < 0).any():
+        raise ValueError(f"\"{nibbles}\" contains characters which are not nibbles")
+    if size is not None and len(values) < size:
+        values = numpy.concatenate([values, numpy.zeros(size - len(values), dtype = values.dtype)])
+    return values
+
+
+#the layout of the ram, as (x, y, z, x_dir) arrays for an array of nibble addresses
+#the layout repeats every 2 ** 14 addresses
+def ram_layout(addrs):
+    n = numpy.array([3, 2, 1, 0, 7, 6, 5, 4])[addrs % 8] #which nibble in the block of 8
+    xi = (addrs // (2 ** 10)) % 16
+    yi = (addrs // (2 ** 3)) % 4 #which vertical block of 8 nibbles
+    zi = (addrs // (2 ** 5)) % 32
+    x_dir = 1 - 2 * (xi % 2)
+
+    x = 17 - 6 * xi - 3 * x_dir
+    y = -119 + 18 * yi + 2 * n
+    z = 29 - 4 * zi
+
+    return x, y, z, x_dir
+
+RAM_LAYOUT = numpy.stack(ram_layout(numpy.arange(2 ** 14))) #row k is ram_layout's k-th array, column i is address i
+
+
+#where the blocks of a rom page go, in the order they are placed
+#returns arrays of which nibble and which bit of it each block shows and the blocks' x, y, z
+#pages 0-3 have a block per bit. Pages 4-15 have a barrel per nibble so their bit is always 0
+def rom_page_layout(page):
+    if page in {0, 1, 2, 3}:
+        i = numpy.repeat(numpy.arange(256), 4)
+        b = numpy.tile(numpy.arange(4), 256)
+        x = -5 - 2 * (3 - b) - 8 * (i // 32)
+        y = numpy.full(len(i), 0 if page == 0 else -5 - 5 * page)
+        z = -5 - 2 * (i % 32)
+    else:
+        p = page - 4
+        i = numpy.arange(256)
+        b = numpy.zeros(256, dtype = i.dtype)
+        x = -13 - 2 * (i % 32)
+        y = -27 + (p % 2) * 16 - 2 * (i // 32)
+        z = numpy.full(256, 13 + 4 * (p // 2))
+    return i, b, x, y, z
+
+ROM_PAGE_LAYOUTS = [rom_page_layout(page) for page in range(16)]
+
+STATES = schemgen.BLOCK_STATES
+LEVER_STATES = numpy.array([STATES.intern("minecraft:lever", "[facing=east,face=floor,powered=false]"),
+                            STATES.intern("minecraft:lever", "[facing=east,face=floor,powered=true]")])
+TORCH_STATES = numpy.array([STATES.intern("minecraft:glass", ""), STATES.intern("minecraft:redstone_wall_torch", "[facing=north,lit=false]")])
+GLASS_STATE = STATES.intern("minecraft:glass", "")
+WOOL_STATE = STATES.intern("minecraft:brown_wool", "")
+SIGNAL_STATE = schemgen.SIGNAL_TEMPLATES[0].state
+
+
+#the blocks for one rom page as the arrays schemgen.arrays_to_volume takes, nibbles is the page's code with the spaces removed
+#signal barrels are given as the shared schemgen.SIGNAL_TEMPLATES, volumes keep track of where they are
+def rom_page_arrays(page, nibbles):
+    i, b, x, y, z = ROM_PAGE_LAYOUTS[page]
+    values = nibble_values(nibbles, 256)[i]
+    if page == 0:
+        return x, y, z, LEVER_STATES[(values >> b) & 1], {}
+    elif page in {1, 2, 3}:
+        return x, y, z, TORCH_STATES[(values >> b) & 1], {}
+    else:
+        states = numpy.where(values == 0, GLASS_STATE, SIGNAL_STATE)
+        return x, y, z, states, {k : schemgen.SIGNAL_TEMPLATES[m] for k, m in enumerate(values.tolist()) if m != 0}
+
+
+#the blocks for the ram as the arrays schemgen.arrays_to_volume takes, ram_nibbles is a dict of {nibble address : nibble}
+#each nibble has a glass block behind it followed by either wool or a signal barrel
+def ram_arrays(ram_nibbles):
+    addrs = numpy.fromiter(ram_nibbles.keys(), dtype = numpy.int64, count = len(ram_nibbles))
+    values = nibble_values("".join(ram_nibbles.values()))
+    x, y, z, x_dir = RAM_LAYOUT[:, addrs % (2 ** 14)]
+
+    xs = numpy.stack([x + 2 * x_dir, x + x_dir], axis = 1).ravel()
+    ys = numpy.stack([y, y], axis = 1).ravel()
+    zs = numpy.stack([z - 1, z], axis = 1).ravel()
+    states = numpy.stack([numpy.full(len(values), GLASS_STATE), numpy.where(values == 0, WOOL_STATE, SIGNAL_STATE)], axis = 1).ravel()
+    entities = {2 * k + 1 : schemgen.SIGNAL_TEMPLATES[m] for k, m in enumerate(values.tolist()) if m != 0}
+    return xs, ys, zs, states, entities
+
+
+#these are what the worker processes run when building in parallel, so they return compact volumes rather than blocks
+def rom_page_volume(page, nibbles):
+    with schemgen.profile_stage(f"rom page {page}"):
+        return schemgen.arrays_to_volume(*rom_page_arrays(page, nibbles))
+
+def ram_volume(ram_nibbles):
+    with schemgen.profile_stage("ram"):
+        return schemgen.arrays_to_volume(*ram_arrays(ram_nibbles))
+
+
+#build the volumes for the rom pages and the ram
+#returns the list of pages built, a (volume, corner) pair for each of them and a (volume, corner) pair for the ram
+#with workers > 1 the pages and the ram are built on a pool of that many processes, the result is the same either way
+#if on_rom is given it is called with pages and rom_parts as soon as the rom is built, so it can be saved while the ram is built
+def build_volumes(rom, ram, active_pages = DEFAULT_ACTIVE_PAGES, workers = 1, on_rom = None):
     code = rom
     code = {p : code.get(p, "").replace(" ", "") for p in range(16)}
 
@@ -397,100 +658,343 @@ def nibbles_to_schem(rom, ram, active_pages = {1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11
         for offset, nibble in enumerate(nibbles.replace(" ", "")):
             ram_nibbles[4 * start_addr + offset] = nibble #4* becasue each 16 bit ram location holds 4 nibbles
 
-    def ram_adr_to_block_pos(i):
-        n = [3, 2, 1, 0, 7, 6, 5, 4][i % 8] #which nibble in the block of 8
-        xi = (i // (2 ** 10)) % 16
-        yi = (i // (2 ** 3)) % 4 #which vertical block of 8 nibbles
-        zi = (i // (2 ** 5)) % 32
-        x_dir = [1, -1][xi % 2]
-
-        x = 17 - 6 * xi - 3 * x_dir
-        y = -119 + 18 * yi + 2 * n
-        z = 29 - 4 * zi
-
-        return x, y, z, x_dir
-
-    def gen_blocks():            
-        for page in range(16):
-            if page in active_pages:
-                if page == 0:
-                    for i in range(256):
-                        if i < len(code[page]):
-                            n = code[page][i]
-                        else:
-                            n = "0"
-
-                        for b in range(4):
-                            x, y, z = -5 - 2 * (3 - b) - 8 * (i // 32), 0, -5 -2 * (i % 32)
-                            if ("0123456789ABCDEF".index(n) & 2 ** b):
-                                yield schemgen.Block(x, y, z, "minecraft:lever", extra = "[facing=east,face=floor,powered=true]")
-                            else:
-                                yield schemgen.Block(x, y, z, "minecraft:lever", extra = "[facing=east,face=floor,powered=false]")
-                
-                
-                elif page in {1, 2, 3}:
-                    for i in range(256):
-                        if i < len(code[page]):
-                            n = code[page][i]
-                        else:
-                            n = "0"
-                        
-                        for b in range(4):
-                            x, y, z = -5 - 2 * (3 - b) - 8 * (i // 32), -5 - 5 * page, -5 -2 * (i % 32)
-                            if ("0123456789ABCDEF".index(n) & 2 ** b):
-                                yield schemgen.Block(x, y, z, "minecraft:redstone_wall_torch", extra = "[facing=north,lit=false]")
-                            else:
-                                yield schemgen.Block(x, y, z, "minecraft:glass")
-                
-                elif page in {4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15}:
-                    p = page - 4
-                    xo = -13
-                    yo = -27 + (p % 2) * 16
-                    zo = 13 + 4 * (p // 2)
-                    
-                    for i in range(256):
-                        if i < len(code[page]):
-                            n = code[page][i]
-                        else:
-                            n = "0"
-                        
-                        for b in range(4):
-                            x, y, z = xo - 2 * (i % 32), yo - 2 * (i // 32), zo
-                            m = "0123456789ABCDEF".index(n)
-                            if m == 0:
-                                yield schemgen.Block(x, y, z, "minecraft:glass")
-                            else:
-                                yield schemgen.Signal(x, y, z, m)
-    
-    
-    file = schemgen.blocks_to_schem(gen_blocks(), 0, 0, 0)
-    rom_path = "rom.schem"
-    file.save(rom_path)
+    pages = [page for page in range(16) if page in active_pages]
+    if workers == 1:
+        rom_parts = [rom_page_volume(page, code[page]) for page in pages]
+        if on_rom is not None:
+            on_rom(pages, rom_parts)
+        ram_part = ram_volume(ram_nibbles)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as pool:
+            ram_future = pool.submit(ram_volume, ram_nibbles)
+            rom_parts = list(pool.map(rom_page_volume, pages, [code[page] for page in pages]))
+            if on_rom is not None:
+                on_rom(pages, rom_parts)
+            ram_part = ram_future.result()
+    return pages, rom_parts, ram_part
+
+
+#where nibbles_to_schem records what it built, so that the next build can be a delta against it
+BUILD_STATE_PATH = "last_build.json"
+
+def save_build_state(path, rom, ram, active_pages):
+    state = {"rom" : {str(page) : nibbles for page, nibbles in rom.items()},
+             "ram" : {str(addr) : nibbles for addr, nibbles in ram.items()},
+             "active_pages" : sorted(active_pages)}
+    with schemgen.atomic_write(path) as f:
+        f.write(json.dumps(state).encode("utf-8"))
+
+#returns rom, ram, active_pages as they were passed to save_build_state
+def load_build_state(path):
+    with open(path) as f:
+        state = json.load(f)
+    rom = {int(page) : nibbles for page, nibbles in state["rom"].items()}
+    ram = {int(addr) : nibbles for addr, nibbles in state["ram"].items()}
+    return rom, ram, set(state["active_pages"])
+
+
+#the previous build for nibbles_to_schem to make a delta against, as a pair of (volume, corner) for the rom and the ram
+#it can either be rebuilt from the previous nibbles, or read back from the schematics that were made from them
+def previous_build_from_nibbles(rom, ram, active_pages = DEFAULT_ACTIVE_PAGES):
+    pages, rom_parts, ram_part = build_volumes(rom, ram, active_pages)
+    return schemgen.merge_volumes(rom_parts), ram_part
+
+def previous_build_from_schems(rom_path, ram_path):
+    return schemgen.schem_to_volume(nbtlib.load(rom_path)), schemgen.schem_to_volume(nbtlib.load(ram_path))
+
+
+#save schematics of only the levers, torches, barrels etc which differ from the previous build, see schemgen.changed_cells
+#returns the number of changed cells for each rom page and for the ram under the key "RAM"
+#save is called like schemgen.save_volume_schem to save them, e.g. with a schemgen.BackgroundSaver's
+def save_delta_schems(pages, rom_parts, ram_part, previous, out_dir = ".", compression = "default", save = schemgen.save_volume_schem):
+    old_rom, old_ram = previous
+    report = {}
+
+    delta_parts = []
+    for page, (volume, corner) in zip(pages, rom_parts):
+        changed = schemgen.changed_cells(volume, corner, *old_rom)
+        report[page] = int(changed.sum())
+        delta, (x, y, z) = volume.select(changed)
+        delta_parts.append((delta, (corner[0] + x, corner[1] + y, corner[2] + z)))
+    volume, (min_x, min_y, min_z) = schemgen.merge_volumes(delta_parts)
+    rom_path = os.path.join(out_dir, "rom_delta.schem")
+    save(volume, -min_x, -min_y, -min_z, rom_path, compression)
+
+    volume, corner = ram_part
+    changed = schemgen.changed_cells(volume, corner, *old_ram)
+    report["RAM"] = int(changed.sum())
+    delta, (x, y, z) = volume.select(changed)
+    ram_path = os.path.join(out_dir, "ram_delta.schem")
+    save(delta, -(corner[0] + x), -(corner[1] + y), -(corner[2] + z), ram_path, compression)
+
+    for page in pages:
+        print(f"Rom {page}: {report[page]} cells changed")
+    print(f"Ram: {report['RAM']} cells changed")
+    return report
+
+
+#each rom page covers its own region, so the pages are built separately and then merged in page order
+#the schematics are saved in out_dir
+#if previous is given (see previous_build_from_nibbles and previous_build_from_schems) delta schematics are saved too and their report is returned
+#run it inside schemgen.profiling() to see how long each stage takes
+#compression is one of schemgen.COMPRESSIONS
+#if pipelined the schematics are compressed and written on background threads, so the rom is compressed while the ram is built
+#and both while the delta is worked out. Either way each file is written under a temporary name and renamed into place when done
+def nibbles_to_schem(rom, ram, active_pages = DEFAULT_ACTIVE_PAGES, workers = 1, previous = None, out_dir = ".", compression = "default", pipelined = False):
+    print(ram)
+
+    rom_path = os.path.join(out_dir, "rom.schem")
+    ram_path = os.path.join(out_dir, "ram.schem")
+    report = None
+    with schemgen.BackgroundSaver(2 if pipelined else 0) as saver:
+        def save_rom(pages, rom_parts):
+            volume, (min_x, min_y, min_z) = schemgen.merge_volumes(rom_parts)
+            saver.save_volume_schem(volume, -min_x, -min_y, -min_z, rom_path, compression)
+
+        with schemgen.profile_stage("build volumes"):
+            pages, rom_parts, ram_part = build_volumes(rom, ram, active_pages, workers, on_rom = save_rom)
+
+        volume, (min_x, min_y, min_z) = ram_part
+        saver.save_volume_schem(volume, -min_x, -min_y, -min_z, ram_path, compression)
+
+        if previous is not None:
+            with schemgen.profile_stage("delta"):
+                report = save_delta_schems(pages, rom_parts, ram_part, previous, out_dir, compression, saver.save_volume_schem)
+
+        with schemgen.profile_stage("wait for saves"):
+            saver.wait()
+
+    #only once every schematic is on disk, so that a failed save isn't taken as the previous build by the next --delta state
+    save_build_state(os.path.join(out_dir, BUILD_STATE_PATH), rom, ram, active_pages)
+
     print(f"PROM schematic saved to \"{rom_path}\". \"//paste -a\" on the start button.")
-    
-    def gen_blocks():            
-        for i, n in ram_nibbles.items():
-            x, y, z, x_dir = ram_adr_to_block_pos(i)
-            yield schemgen.Block(x + 2 * x_dir, y, z - 1, "minecraft:glass")
-            if ram_nibbles[i] == "0":
-                yield schemgen.Block(x + x_dir, y, z, "minecraft:brown_wool")
-            else:
-                yield schemgen.Signal(x + x_dir, y, z, "0123456789ABCDEF".index(n))
-    
-    file = schemgen.blocks_to_schem(gen_blocks(), 0, 0, 0)
-    ram_path = "ram.schem"
-    file.save(ram_path)
     print(f"PRAM schematic saved to \"{ram_path}\". \"//paste -a\" on the start button and then \"//undo\".")
+    if previous is not None:
+        print(f"Delta schematics saved to \"{os.path.join(out_dir, 'rom_delta.schem')}\" and \"{os.path.join(out_dir, 'ram_delta.schem')}\". "
+              "\"//paste -a\" them in the same place as the full ones.")
+    return report
+
+
+#the same schematics as nibbles_to_schem makes, but returned as a dict of file name -> bytes instead of being saved
+def nibbles_to_schem_bytes(rom, ram, active_pages = DEFAULT_ACTIVE_PAGES, workers = 1, compression = "default"):
+    with schemgen.profile_stage("build volumes"):
+        pages, rom_parts, ram_part = build_volumes(rom, ram, active_pages, workers)
+    schems = {}
+    for name, (volume, (min_x, min_y, min_z)) in [("rom.schem", schemgen.merge_volumes(rom_parts)), ("ram.schem", ram_part)]:
+        with schemgen.profile_stage(name):
+            schems[name] = schemgen.volume_schem_bytes(volume, -min_x, -min_y, -min_z, compression, name)
+    return schems
+
+
+#reading nibbles back out of rom and ram schematics, to check that what was pasted into a world is what compile_assembly made
+
+#what a cell of a schematic shows: 0-15 for a nibble (or 0-1 for a bit), or one of these
+CELL_MISSING = -2 #air, or outside the schematic
+CELL_UNKNOWN = -1 #a block which shouldn't be there, or a barrel which isn't one of the signal barrels
+CELL_BARREL = 16 #a barrel, whose value is found from its items
+
+#the total number of redstone in each signal barrel -> its signal strength, for barrels which weren't written by schemgen
+SIGNAL_TOTALS = {sum(count for ident, count in template.items.values()) : ss for ss, template in enumerate(schemgen.SIGNAL_TEMPLATES)}
+
+#the signal strength of the barrel whose Items list payload starts at pos in buf, or CELL_UNKNOWN if it isn't one a Signal makes
+def barrel_signal(buf, pos):
+    item_id, count = struct.unpack_from(">bi", buf, pos)
+    pos += 5
+    if count != 0 and item_id != schemgen.TAG_COMPOUND:
+        return CELL_UNKNOWN
+    total = 0
+    for _ in range(count):
+        items, pos = schemgen.scan_nbt_compound(buf, pos)
+        fields = {name : (tag_id, item_pos) for name, tag_id, item_pos in items}
+        if fields.get("id", (None,))[0] != schemgen.TAG_STRING or not "Count" in fields:
+            return CELL_UNKNOWN
+        id_pos = fields["id"][1]
+        if bytes(buf[id_pos + 2 : id_pos + 2 + struct.unpack_from(">H", buf, id_pos)[0]]) != b"minecraft:redstone":
+            return CELL_UNKNOWN
+        count_id, count_pos = fields["Count"]
+        total += struct.unpack_from({schemgen.TAG_BYTE : ">b", schemgen.TAG_INT : ">i"}.get(count_id, ">b"), buf, count_pos)[0]
+    return SIGNAL_TOTALS.get(total, CELL_UNKNOWN)
+
+#the cells of a rom or ram schematic, read straight from its nbt rather than through nbtlib, which is much slower
+class SchemImage():
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            buf = f.read()
+        if buf[:2] == b"\x1f\x8b":
+            buf = gzip.decompress(buf)
+        index = schemgen.scan_schem_nbt(buf, path, entity_tags = {"Items"})
+        self.width, self.height, self.length = index["size"]
+        self.corner = tuple(index["corner"]) #world position of the (0, 0, 0) corner relative to the //paste origin
+        offset, length = index["block_data"]
+        self.cells = schemgen.decode_varints(numpy.frombuffer(buf, dtype = numpy.uint8, count = length, offset = offset))
+        self.palette = [index["palette"].get(idx, "minecraft:air") for idx in range(max(index["palette"], default = -1) + 1)]
+
+        #the signal strength of each barrel by local position. Barrels schemgen wrote have exactly the items of a signal template
+        #so most are found by comparing their bytes, anything else is decoded
+        known = {template.items_nbt : ss for ss, template in enumerate(schemgen.SIGNAL_TEMPLATES)}
+        self.signals = {}
+        for x, y, z, start, end, tags in index["entities"]:
+            if "Items" in tags:
+                pos, items_end = tags["Items"]
+                items_nbt = bytes(buf[pos - 8 : items_end]) #8 for the tag id and name before the payload
+                if not items_nbt in known:
+                    known[items_nbt] = barrel_signal(buf, pos) if buf[pos - 8] == schemgen.TAG_LIST else CELL_UNKNOWN
+                self.signals[(x, y, z)] = known[items_nbt]
+
+    #what the cells at world positions xs, ys, zs show, as arrays of CELL_ values or what classify(ident + extra) gives for each block
+    def read(self, xs, ys, zs, classify):
+        x, y, z = xs - self.corner[0], ys - self.corner[1], zs - self.corner[2]
+        inside = (0 <= x) & (x < self.width) & (0 <= y) & (y < self.height) & (0 <= z) & (z < self.length)
+        cells = numpy.where(inside, x + z * self.width + y * self.width * self.length, 0)
+        #the extra entry on the end is what ids of -1, for cells outside the schematic, pick out
+        table = numpy.array([CELL_MISSING if name == "minecraft:air" else classify(name) for name in self.palette] + [CELL_MISSING])
+        values = table[numpy.where(inside, self.cells[cells] if len(self.cells) != 0 else -1, -1)]
+        for k in numpy.flatnonzero(values == CELL_BARREL).tolist():
+            values[k] = self.signals.get((int(x[k]), int(y[k]), int(z[k])), CELL_UNKNOWN)
+        return values
+
+#how a block of each kind of page reads, as functions of ident + extra for SchemImage.read
+def read_lever(name):
+    if name.startswith("minecraft:lever["):
+        return 1 if "powered=true" in name else 0
+    return CELL_UNKNOWN
+
+def read_torch(name):
+    if name.startswith("minecraft:redstone_wall_torch"):
+        return 1
+    return 0 if name == "minecraft:glass" else CELL_UNKNOWN
+
+def read_barrel(empty):
+    def read(name):
+        if name.startswith("minecraft:barrel"):
+            return CELL_BARREL
+        return 0 if name == empty else CELL_UNKNOWN
+    return read
+
+#nibble values as a string, "?" for ones which couldn't be read
+def values_to_nibbles(values):
+    return numpy.frombuffer(b"0123456789ABCDEF?", dtype = numpy.uint8)[numpy.where(values < 0, 16, values)].tobytes().decode("ascii")
+
+
+#read the nibbles of each rom page back out of a rom schematic, returns {page : nibbles} for the pages it has blocks of
+#each page comes back as all 256 of its nibbles without spaces, with "?" where the blocks don't show a nibble
+def rom_schem_to_nibbles(path):
+    image = SchemImage(path)
+    rom = {}
+    for page in range(16):
+        i, b, x, y, z = ROM_PAGE_LAYOUTS[page]
+        cells = image.read(x, y, z, read_lever if page == 0 else read_torch if page in {1, 2, 3} else read_barrel("minecraft:glass"))
+        if (cells == CELL_MISSING).all():
+            continue
+        if page in {0, 1, 2, 3}:
+            bits = cells.reshape(256, 4) #i and b go through the nibbles and then their bits
+            values = numpy.where((bits < 0).any(axis = 1), CELL_UNKNOWN, (bits << numpy.arange(4)).sum(axis = 1))
+        else:
+            values = numpy.where(cells == CELL_MISSING, CELL_UNKNOWN, cells)
+        rom[page] = values_to_nibbles(values)
+    return rom
+
+#read the nibbles of a ram schematic back, returns {address : nibbles} like compile_assembly's ram
+#the pages are found as runs of nibbles, so a page which ends on a word right before the next one comes back joined to it
+def ram_schem_to_nibbles(path):
+    image = SchemImage(path)
+    x, y, z, x_dir = RAM_LAYOUT[:, :RAM_SIZE]
+    values = image.read(x + x_dir, y, z, read_barrel("minecraft:brown_wool"))
+    present = numpy.concatenate([[False], values != CELL_MISSING, [False]])
+    edges = numpy.flatnonzero(present[1:] != present[:-1]).reshape(-1, 2) #the start and end of each run
+    ram = {}
+    for start, end in edges.tolist():
+        word = start // 4 #runs should start on a word, if one doesn't the nibbles before it are shown as unreadable
+        ram[word] = values_to_nibbles(numpy.concatenate([numpy.full(start - 4 * word, CELL_UNKNOWN), values[start : end]]))
+    return ram
+
+
+#every ram nibble as a character, " " for unused ones, from {address : nibbles} with or without spaces
+def ram_characters(ram):
+    chars = numpy.full(RAM_SIZE, ord(" "), dtype = numpy.uint8)
+    for addr, nibbles in ram.items():
+        data = numpy.frombuffer(nibbles.replace(" ", "").encode("ascii"), dtype = numpy.uint8)[: max(RAM_SIZE - 4 * addr, 0)]
+        chars[4 * addr : 4 * addr + len(data)] = data
+    return chars
+
+#compare what compile_assembly made with what was read back from schematics by rom_schem_to_nibbles and ram_schem_to_nibbles
+#only the active pages of the rom are compared, as they are the only ones nibbles_to_schem builds
+#returns a list of the differences, at most limit for each page and for the ram
+def diff_nibbles(rom, ram, found_rom, found_ram, active_pages = DEFAULT_ACTIVE_PAGES, limit = 10):
+    differences = []
+    def describe(where, expected, found):
+        wrong = numpy.flatnonzero(expected != found)
+        for k in wrong[:limit].tolist():
+            differences.append(f"{where(k)}: expected {chr(expected[k])!r}, found {chr(found[k])!r}")
+        if len(wrong) > limit:
+            differences.append(f"... and {len(wrong) - limit} more")
+
+    for page in sorted(active_pages):
+        if not page in found_rom:
+            differences.append(f"rom page {page} is missing")
+            continue
+        expected = numpy.frombuffer(rom.get(page, "").replace(" ", "")[:256].ljust(256, "0").encode("ascii"), dtype = numpy.uint8)
+        found = numpy.frombuffer(found_rom[page].encode("ascii"), dtype = numpy.uint8)
+        describe(lambda k : f"rom page {page} nibble {k}", expected, found)
+    describe(lambda k : f"ram nibble {k} (word {k // 4})", ram_characters(ram), ram_characters(found_ram))
+    return differences
 
 
-        
-
 if __name__ == "__main__":
-    with open("assembly.txt") as f:
-        code = f.read()
-        rom, ram = compile_assembly(code)
-        print_nibbles(rom, ram)
-        nibbles_to_schem(rom, ram)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type = int, default = 1, help = "number of processes to build the schematics with")
+    parser.add_argument("--delta", choices = ["state", "schem"], help = "also save schematics of only what changed since the last build, "
+                        f"found from {BUILD_STATE_PATH} or by reading the old rom.schem and ram.schem")
+    parser.add_argument("--cache", default = ASSEMBLY_CACHE_PATH, help = "file to keep compiled pages in between runs, so that only pages which changed are recompiled")
+    parser.add_argument("--profile", metavar = "TRACE", help = "print how long each stage of the build took and save a chrome trace of it to this file, "
+                        "pages built by --workers processes only show up as a whole")
+    parser.add_argument("--compression", choices = schemgen.COMPRESSIONS, default = "default", help = "how to compress the schematics, "
+                        "\"none\" and \"fast\" are quicker for test builds and \"raw\" can't be read by WorldEdit")
+    parser.add_argument("--pipelined", action = "store_true", help = "compress and write the schematics on background threads while the next one is built")
+    parser.add_argument("--ram-map", action = "store_true", help = "print which parts of the ram each page uses, including where the .PRAM auto pages were put")
+    parser.add_argument("--verify", action = "store_true", help = "instead of building, check that rom.schem and ram.schem (e.g. exported "
+                        "back out of a world) hold what assembly.txt compiles to")
+    args = parser.parse_args()
+
+    if args.verify:
+        with open("assembly.txt") as f:
+            rom, ram = compile_assembly(f.read(), cache = AssemblyCache(args.cache))
+        start = time.perf_counter()
+        differences = diff_nibbles(rom, ram, rom_schem_to_nibbles("rom.schem"), ram_schem_to_nibbles("ram.schem"))
+        for difference in differences:
+            print(difference)
+        print(f"rom.schem and ram.schem {'differ from' if differences else 'match'} assembly.txt, read in {1000 * (time.perf_counter() - start):.1f}ms")
+        sys.exit(1 if differences else 0)
+
+    previous = None
+    if args.delta == "state":
+        if not os.path.exists(BUILD_STATE_PATH):
+            parser.error(f"--delta state needs {BUILD_STATE_PATH} from an earlier build, build once without --delta first")
+        try:
+            previous = previous_build_from_nibbles(*load_build_state(BUILD_STATE_PATH))
+        except (ValueError, KeyError, TypeError) as e: #json's errors are ValueErrors
+            parser.error(f"{BUILD_STATE_PATH} can't be read ({e}), build once without --delta to remake it")
+    elif args.delta == "schem":
+        for path in ["rom.schem", "ram.schem"]:
+            if not os.path.exists(path):
+                parser.error(f"--delta schem needs {path} from an earlier build, build once without --delta first")
+        previous = previous_build_from_schems("rom.schem", "ram.schem")
+
+    with schemgen.profiling() if args.profile else contextlib.nullcontext() as profile:
+        with open("assembly.txt") as f:
+            code = f.read()
+            with schemgen.profile_stage("compile_assembly"):
+                rom, ram = compile_assembly(code, cache = AssemblyCache(args.cache))
+            print_nibbles(rom, ram)
+            if args.ram_map:
+                print(ram_map(ram).render())
+            with schemgen.profile_stage("nibbles_to_schem"):
+                nibbles_to_schem(rom, ram, workers = args.workers, previous = previous, compression = args.compression, pipelined = args.pipelined)
+
+    if args.profile:
+        print(profile.report())
+        profile.save_trace(args.profile)
+        print(f"Trace saved to \"{args.profile}\"")
 
 
 
@@ -0,0 +1,152 @@
+#compile_assembly's cache and ram layout, run with "python -m pytest"
+import os
+import json
+
+import pytest
+import main as p16
+
+
+#page 0 calls into page 1 and the ram, page 1 has code before its label so the label isn't at the start
+BASE = """.PROM 0
+CALL helper
+CALL ramsub
+RETURN
+.PROM 1
+VALUE 1
+.LABEL helper
+VALUE 2
+OUTPUT 1
+RETURN
+.PROM 2
+PASS
+.PRAM 16
+.LABEL ramsub
+RETURN
+"""
+
+EDITS = {
+    #a page's own text changes
+    "page edit" : BASE.replace("VALUE 2", "VALUE 3"),
+    #page 0 is unchanged, but the label it calls is now at a different address of page 1
+    "label moves in its page" : BASE.replace("VALUE 1\n", "VALUE 1\nVALUE 4\n"),
+    #page 0 is unchanged, but the label it calls is now on page 2
+    "label moves page" : BASE.replace(".LABEL helper\n", "").replace(".PROM 2\nPASS\n", ".PROM 2\nPASS\n.LABEL helper\nRETURN\n"),
+    #the call becomes a call into ram, which is longer, so page 0's layout changes too
+    "call changes kind" : BASE.replace(".LABEL helper\n", "") + ".PRAM 32\n.LABEL helper\nRETURN\n",
+    #growing the first .PRAM auto page moves the second one, which page 0 calls
+    "auto page moves" : BASE.replace("CALL ramsub", "CALL later") + ".PRAM auto\nVALUE 1\nRETURN\n.PRAM auto\n.LABEL later\nRETURN\n",
+}
+
+
+@pytest.mark.parametrize("name", sorted(EDITS))
+def test_cache_matches_cold_compile(name, tmp_path):
+    edited = EDITS[name]
+    assert p16.compile_assembly(edited) != p16.compile_assembly(BASE)
+    path = os.path.join(tmp_path, "cache.json")
+
+    assert p16.compile_assembly(BASE, p16.AssemblyCache(path)) == p16.compile_assembly(BASE)
+    cache = p16.AssemblyCache(path)
+    assert p16.compile_assembly(edited, cache) == p16.compile_assembly(edited)
+    assert cache.hits != 0 #some of the pages really did come from the cache
+    #and back again, with both versions in the cache
+    cache = p16.AssemblyCache(path)
+    assert p16.compile_assembly(BASE, cache) == p16.compile_assembly(BASE)
+    assert cache.misses == 0
+
+
+def test_cache_auto_page_grows(tmp_path):
+    code = EDITS["auto page moves"]
+    grown = code.replace(".PRAM auto\nVALUE 1\n", ".PRAM auto\nVALUE 1\nVALUE 2\n")
+    cache = p16.AssemblyCache(os.path.join(tmp_path, "cache.json"))
+    p16.compile_assembly(code, cache)
+    assert p16.compile_assembly(grown, cache) == p16.compile_assembly(grown)
+
+
+#the entries a cold compile of code makes
+def entry_keys(code):
+    cache = p16.AssemblyCache()
+    p16.compile_assembly(code, cache)
+    return set(cache.entries)
+
+def saved_keys(path):
+    with open(path) as f:
+        return list(json.load(f)["entries"])
+
+def test_cache_eviction(tmp_path):
+    path = os.path.join(tmp_path, "cache.json")
+    cache = p16.AssemblyCache(path, limit = 5)
+    p16.compile_assembly(BASE, cache)
+    assert len(entry_keys(BASE)) > 5
+    assert len(cache.entries) == 5
+    assert len(saved_keys(path)) == 5
+    assert len(p16.AssemblyCache(path).entries) == 5
+
+def test_cache_keeps_most_recently_used(tmp_path):
+    path = os.path.join(tmp_path, "cache.json")
+    first, second = BASE, EDITS["call changes kind"]
+    keep = entry_keys(first)
+    p16.compile_assembly(first, p16.AssemblyCache(path, limit = 100))
+    p16.compile_assembly(second, p16.AssemblyCache(path, limit = 100))
+    p16.compile_assembly(first, p16.AssemblyCache(path, limit = 100)) #only hits, but they are still the most recently used
+    p16.compile_assembly(first, p16.AssemblyCache(path, limit = len(keep)))
+    assert set(saved_keys(path)) == keep
+
+#the daemon trims its cache, which has no file, between builds
+def test_cache_trim():
+    first, second = BASE, EDITS["call changes kind"]
+    keep = entry_keys(first)
+    cache = p16.AssemblyCache()
+    p16.compile_assembly(first, cache)
+    p16.compile_assembly(second, cache)
+    p16.compile_assembly(first, cache)
+    assert len(cache.entries) > len(keep)
+    cache.trim(len(keep))
+    assert set(cache.entries) == keep
+    cache.trim(len(keep))
+    assert set(cache.entries) == keep
+
+def test_cache_unreadable_file(tmp_path):
+    path = os.path.join(tmp_path, "cache.json")
+    with open(path, "w") as f:
+        f.write("{\"version\" : 2, \"entr")
+    cache = p16.AssemblyCache(path)
+    assert cache.entries == {}
+    assert p16.compile_assembly(BASE, cache) == p16.compile_assembly(BASE)
+    assert len(p16.AssemblyCache(path).entries) != 0
+
+
+#a .PRAM page of n VALUEs, which is 5 * n nibbles long
+def values_page(address, n, label = None):
+    return f".PRAM {address}\n" + (f".LABEL {label}\n" if label is not None else "") + "VALUE 0\n" * n
+
+def test_ram_problems_reported_together():
+    code = ".PROM 0\nRETURN\n" + values_page(0, 8) + values_page(5, 2) + values_page(8, 1) + values_page(1020, 8)
+    with pytest.raises(p16.P16SyntaxError) as error:
+        p16.compile_assembly(code)
+    message = str(error.value)
+    assert ".PRAM 5 uses nibbles 20-29 which overlap .PRAM 0 at nibbles 0-39" in message
+    assert ".PRAM 8 uses nibbles 32-36 which overlap .PRAM 0 at nibbles 0-39" in message
+    assert ".PRAM 1020 uses nibbles 4080-4119 but the ram ends at nibble 4095" in message
+
+def test_ram_map_overlap():
+    with pytest.raises(p16.P16SyntaxError):
+        p16.RamMap([(0, 10, "a"), (4, 2, "b")])
+    assert p16.RamMap([(0, 10, "a"), (10, 2, "b")]).gaps() == [(12, p16.RAM_SIZE)]
+
+def test_auto_pages_fill_gaps():
+    #fixed pages use nibbles 0-6 and 40-59, leaving gaps at 7-39 and from 60
+    code = (".PROM 0\nCALL small\nCALL big\nRETURN\n" + ".PRAM 0\nVALUE 1\nPOP r0\n" + values_page(10, 4) +
+            values_page("auto", 7, "big") + values_page("auto", 3, "small"))
+    rom, ram = p16.compile_assembly(code)
+    #the biggest is placed first. 35 nibbles don't fit in the first gap once it is rounded up to word 2, so it goes after word 15
+    assert set(ram) == {0, 10, 15, 2}
+    assert p16.nibble_count(ram[15]) == 35
+    assert p16.nibble_count(ram[2]) == 15
+    #and the calls go to where they were put
+    calls = rom[0].split()
+    assert calls[0] == p16.CALL_ENCODINGS["RAM"].format(2, 0)
+    assert calls[1] == p16.CALL_ENCODINGS["RAM"].format(15, 0)
+
+def test_auto_page_too_big():
+    with pytest.raises(p16.P16SyntaxError):
+        p16.compile_assembly(".PROM 0\nRETURN\n" + values_page(0, 800) + values_page("auto", 40))
@@ -0,0 +1,97 @@
+#the emulator running what compile_assembly makes, run with "python -m pytest"
+import os
+
+import pytest
+import main as p16
+import emulator
+
+
+def run(code, steps = 1000, **kwargs):
+    rom, ram = p16.compile_assembly(code)
+    emu = emulator.P16Emulator(rom, ram, **kwargs)
+    emu.run(steps)
+    return emu
+
+
+def test_fibonacci():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "assembly.txt")) as f:
+        emu = run(f.read(), steps = 200, start_page = 4)
+    values = [value for address, value in emu.outputs if address == (2,)]
+    assert values[:12] == [0, 1, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89]
+    assert not emu.halted
+
+
+#CMP sets Z, which the BRANCH only sees once FLAG_LATENCY nibbles have gone by
+BRANCH_ON_CMP = """.PROM 0
+VALUE 5
+POP r1
+VALUE 5
+CMP r1
+{wait}
+BRANCH Z same
+VALUE 1
+OUTPUT 1
+RETURN
+.LABEL same
+VALUE 2
+OUTPUT 1
+RETURN
+"""
+
+def test_waitflag():
+    emu = run(BRANCH_ON_CMP.format(wait = ".WAITFLAG"))
+    assert emu.outputs == [((1,), 2)]
+    assert emu.flag_hazards == []
+    assert emu.halted
+
+def test_missing_waitflag():
+    emu = run(BRANCH_ON_CMP.format(wait = ""))
+    assert emu.outputs == [((1,), 1)] #the branch saw the flags from before the CMP
+    assert len(emu.flag_hazards) == 1
+    medium, location, pc, clock = emu.flag_hazards[0]
+    assert (medium, location, pc) == ("ROM", 0, 15) #the BRANCH, after VALUE, POP, VALUE and CMP
+
+
+def test_call_ram_and_return():
+    emu = run(""".PROM 0
+CALL sub
+VALUE 9
+OUTPUT 1
+RETURN
+.PRAM 16
+.LABEL sub
+VALUE 7
+OUTPUT 1
+RETURN
+""")
+    assert emu.outputs == [((1,), 7), ((1,), 9)]
+    assert emu.calls == []
+    assert emu.halted #the last RETURN had nothing to return to
+
+
+#the ram page writes OUTPUT 0 (F8) and two PASSes over the four PASSes at word 21, just ahead of where it is running
+def test_pwrite_into_running_page():
+    emu = run(""".PROM 0
+CALL selfmod
+RETURN
+.PRAM 16
+.LABEL selfmod
+VALUE 63488
+POP r2
+VALUE 42
+VALUE 21
+PWRITE r2
+PASS
+PASS
+PASS
+PASS
+RETURN
+""")
+    assert emu.read_word(21) == 0xF800
+    assert emu.outputs == [((0,), 42)]
+    assert emu.halted
+
+
+def test_stack_underflow():
+    with pytest.raises(emulator.P16EmulatorError):
+        run(".PROM 0\nPOP r0\n")
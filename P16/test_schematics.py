@@ -0,0 +1,65 @@
+#reading rom and ram nibbles back out of the schematics nibbles_to_schem saves, run with "python -m pytest"
+import os
+import random
+
+import pytest
+import main as p16
+
+
+ALL_PAGES = set(range(16))
+
+
+def random_nibbles(rng, n):
+    return "".join(rng.choice(p16.HEX_DIGITS) for _ in range(n))
+
+#every rom page, and a few ram pages with gaps between them
+@pytest.fixture
+def program():
+    rng = random.Random(0)
+    rom = {page : random_nibbles(rng, 256) for page in range(16)}
+    ram = {0 : random_nibbles(rng, 64), 100 : random_nibbles(rng, 400), 1000 : random_nibbles(rng, 96)}
+    return rom, ram
+
+
+def build_and_read(rom, ram, out_dir):
+    p16.nibbles_to_schem(rom, ram, active_pages = ALL_PAGES, out_dir = str(out_dir))
+    return p16.rom_schem_to_nibbles(os.path.join(out_dir, "rom.schem")), p16.ram_schem_to_nibbles(os.path.join(out_dir, "ram.schem"))
+
+
+def test_round_trip(program, tmp_path):
+    rom, ram = program
+    found_rom, found_ram = build_and_read(rom, ram, tmp_path)
+    assert found_rom == rom
+    assert found_ram == ram
+    assert p16.diff_nibbles(rom, ram, found_rom, found_ram, ALL_PAGES) == []
+
+
+#each change is (rom page or None for the ram, index of the nibble in the page) and what should be reported
+@pytest.mark.parametrize("page, k, report", [
+    (0, 17, "rom page 0 nibble 17"), #levers
+    (2, 255, "rom page 2 nibble 255"), #torches
+    (9, 100, "rom page 9 nibble 100"), #barrels
+    (None, 5, "ram nibble 405 (word 101)"),
+])
+def test_one_nibble_changed(program, tmp_path, page, k, report):
+    rom, ram = program
+    changed_rom, changed_ram = dict(rom), dict(ram)
+    if page is None:
+        old = ram[100]
+        changed_ram[100] = old[:k] + ("0" if old[k] != "0" else "1") + old[k + 1:]
+    else:
+        old = rom[page]
+        changed_rom[page] = old[:k] + ("0" if old[k] != "0" else "1") + old[k + 1:]
+
+    found_rom, found_ram = build_and_read(changed_rom, changed_ram, tmp_path)
+    differences = p16.diff_nibbles(rom, ram, found_rom, found_ram, ALL_PAGES)
+    assert len(differences) == 1
+    assert differences[0].startswith(report + ":")
+
+
+def test_missing_page(program, tmp_path):
+    rom, ram = program
+    p16.nibbles_to_schem(rom, ram, active_pages = {0, 4}, out_dir = str(tmp_path))
+    found_rom = p16.rom_schem_to_nibbles(os.path.join(tmp_path, "rom.schem"))
+    assert set(found_rom) == {0, 4}
+    assert p16.diff_nibbles(rom, ram, found_rom, ram, {0, 4, 5}) == ["rom page 5 is missing"]
@@ -0,0 +1,393 @@
+#benchmarks for schemgen and the P16 pipeline, run with "python bench.py"
+#each benchmark reports its fastest wall time, peak traced memory and output size
+#"python bench.py --save-baseline" records the results in bench_baseline.json, later runs are compared against it
+#and exit with an error if anything got slower or bigger in memory by more than --tolerance
+#each result is stored with the time a fixed calibration workload took on the machine that recorded it, and times are
+#compared relative to that, so a baseline recorded on one machine can be checked on a faster or slower one. This only
+#evens out the speed of the machine, so if the comparisons are still noisy run --save-baseline once on the machine first
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import zlib
+import tempfile
+import tracemalloc
+
+import numpy
+import schemgen
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "P16"))
+import main as p16
+import emulator
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+#run f a few times and return the fastest wall time in seconds
+def best_time(f, repeat = 3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        t = time.perf_counter() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+
+#the peak memory allocated while running f once, in bytes. numpy reports its buffers to tracemalloc so they are included
+def peak_memory(f):
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+#a fixed mix of python, numpy and zlib work, roughly like the benchmarks, timed to measure how fast this machine is
+def calibration_workload():
+    rng = random.Random(0)
+    counts = {}
+    for _ in range(30000):
+        key = rng.randrange(1000)
+        counts[key] = counts.get(key, 0) + 1
+    values = numpy.random.default_rng(0).integers(0, 300, 2 ** 18)
+    numpy.unique(values, return_inverse = True)
+    zlib.compress(values.astype(numpy.uint16).tobytes(), 6)
+
+#how long calibration_workload takes here in seconds, the fastest of a few runs
+def calibrate():
+    return best_time(calibration_workload, repeat = 10)
+
+
+#a solid cube of mixed stone blocks
+def gen_dense_blocks(size = 64):
+    idents = ["minecraft:stone", "minecraft:granite", "minecraft:diorite", "minecraft:andesite"]
+    for x in range(size):
+        for y in range(size):
+            for z in range(size):
+                yield schemgen.Block(x, y, z, idents[(x + y + z) % 4])
+
+
+#a few blocks scattered through a big mostly air volume
+def gen_sparse_blocks(n = 20000, size = 256, seed = 0):
+    rng = random.Random(seed)
+    for _ in range(n):
+        yield schemgen.Block(rng.randrange(size), rng.randrange(size // 4), rng.randrange(size), "minecraft:glass")
+
+
+#a cube where almost every block has its own state, so the palette is huge
+def gen_palette_blocks(size = 48):
+    for x in range(size):
+        for y in range(size):
+            for z in range(size):
+                yield schemgen.Block(x, y, z, "minecraft:note_block", extra = f"[note={x % 25},instrument=i{y}_{z},powered=false]")
+
+
+#a ROM sized slab of Signal barrels, the worst case for block entity writing
+def gen_barrel_blocks(n = 4096):
+    for i in range(n):
+        yield schemgen.Signal(-2 * (i % 32), -2 * ((i // 32) % 8), 4 * (i // 256), i % 16)
+
+
+#a random program of roughly n_lines lines spread over all 16 rom pages, with jumps, branches, calls between pages and .WAITFLAGs
+#no page is anywhere near small enough to fit in the computer, but compile_assembly doesn't mind
+def gen_assembly(n_lines, seed = 0):
+    rng = random.Random(seed)
+    lines = []
+    for page in range(16):
+        lines.append(f".PROM {page}")
+        lines.append(f".LABEL page{page}")
+        for _ in range(n_lines // 16):
+            r = rng.random()
+            if r < 0.15:
+                lines.append(f"VALUE {rng.randrange(2 ** 16)}")
+            elif r < 0.3:
+                lines.append(f"{rng.choice(['PUSH', 'POP', 'ADD'])} r{rng.randrange(16)}")
+            elif r < 0.45:
+                lines.append(rng.choice(["NOT", "INC", "DEC", "DUP", "RSH"]))
+            elif r < 0.6:
+                lines.append(f"{rng.choice(['SWAP', 'SUB', 'AND', 'OR', 'XOR', 'CMP'])} r{rng.randrange(16)}")
+            elif r < 0.65:
+                lines.append(".WAITFLAG")
+            elif r < 0.7:
+                lines.append(f"JUMP page{page}")
+            elif r < 0.75:
+                lines.append(f"BRANCH Z page{page}")
+            elif r < 0.8:
+                lines.append(f"CALL page{rng.randrange(16)}")
+            elif r < 0.85:
+                lines.append(f"OUTPUT {rng.randrange(8)}.{rng.randrange(8)}")
+            elif r < 0.9:
+                lines.append(f"ROTATE {rng.randrange(16)} r{rng.randrange(16)}")
+            else:
+                lines.append("PASS")
+    return "\n".join(lines)
+
+
+#a random program that really fits in the computer: all 16 rom pages are filled to their 256 nibbles
+#and the ram is filled with 16 pages of 64 words, calling each other and the rom pages
+#with auto_ram the ram pages are .PRAM auto, so compile_assembly has to pack them in itself
+def gen_full_assembly(seed = 0, auto_ram = False):
+    rng = random.Random(seed)
+    rom_labels = [f"rom{page}" for page in range(16)]
+    ram_labels = [f"ram{addr}" for addr in range(0, 2 ** 10, 64)]
+
+    def gen_page(label, size):
+        lines = [f".LABEL {label}"]
+        used = 0
+        while True:
+            r = rng.random()
+            if r < 0.2:
+                line, length = f"VALUE {rng.randrange(2 ** 16)}", 5
+            elif r < 0.35:
+                line, length = f"{rng.choice(['PUSH', 'POP', 'ADD'])} r{rng.randrange(16)}", 2
+            elif r < 0.5:
+                line, length = rng.choice(["NOT", "INC", "DEC", "DUP", "RSH"]), 2
+            elif r < 0.65:
+                line, length = f"{rng.choice(['SWAP', 'SUB', 'AND', 'OR', 'XOR', 'CMP'])} r{rng.randrange(16)}", 3
+            elif r < 0.7:
+                line, length = f"JUMP {label}", 3
+            elif r < 0.75:
+                line, length = f"BRANCH Z {label}", 4
+            elif r < 0.8:
+                line, length = f"CALL {rng.choice([other for other in rom_labels if other != label])}", 4
+            elif r < 0.85:
+                line, length = f"CALL {rng.choice([other for other in ram_labels if other != label])}", 8
+            elif r < 0.9:
+                line, length = f"ROTATE {rng.randrange(16)} r{rng.randrange(16)}", 3
+            else:
+                line, length = "RETURN", 1
+            if used + length > size:
+                break
+            lines.append(line)
+            used += length
+        lines += ["PASS"] * (size - used)
+        return lines
+
+    lines = []
+    for page in range(16):
+        lines.append(f".PROM {page}")
+        lines += gen_page(rom_labels[page], 256)
+    for label in ram_labels:
+        lines.append(".PRAM auto" if auto_ram else f".PRAM {label[3:]}")
+        lines += gen_page(label, 256)
+    return "\n".join(lines)
+
+
+#a big volume of terrain-like layers with some noise, so that compression has something to do
+def gen_noisy_volume(size = 128, seed = 0):
+    rng = numpy.random.default_rng(seed)
+    volume = schemgen.Volume(size, size, size)
+    states = [volume.state(f"minecraft:{ident}") for ident in ["stone", "dirt", "grass_block", "gravel", "sand", "clay", "andesite", "granite"]]
+    layers = numpy.repeat(numpy.arange(size) * len(states) // size, size * size)
+    noise = rng.random(size ** 3) < 0.1
+    volume.data = numpy.array(states, dtype = numpy.int32)[numpy.where(noise, rng.integers(len(states), size = size ** 3), layers)]
+    return volume
+
+
+#random nibbles for every rom page and every ram address, the biggest thing nibbles_to_schem can be asked to build
+def gen_full_nibbles(seed = 0):
+    rng = random.Random(seed)
+    rom = {page : "".join(rng.choice("0123456789ABCDEF") for _ in range(256)) for page in range(16)}
+    ram = {0 : "".join(rng.choice("0123456789ABCDEF") for _ in range(2 ** 12))}
+    return rom, ram
+
+
+#each benchmark is given a scratch directory and returns the number of bytes it wrote there
+def bench_save_schem(gen_blocks, bounds = None):
+    def run(directory):
+        path = os.path.join(directory, "out.schem")
+        schemgen.save_schem(gen_blocks(), 0, 0, 0, path, bounds = bounds)
+        return os.path.getsize(path)
+    return run
+
+def bench_blocks_to_schem(gen_blocks):
+    def run(directory):
+        path = os.path.join(directory, "out.schem")
+        schemgen.blocks_to_schem(gen_blocks(), 0, 0, 0).save(path)
+        return os.path.getsize(path)
+    return run
+
+def bench_schem_to_blocks(gen_blocks):
+    file = schemgen.blocks_to_schem(gen_blocks(), 0, 0, 0)
+    def run(directory):
+        for block in schemgen.schem_to_blocks(file, skip = {"minecraft:air"}):
+            pass
+        return 0
+    return run
+
+#random lookups in a saved schematic through SchemReader, with its sidecar files already made
+def bench_schem_reader(gen_blocks, n_lookups = 1000, seed = 0):
+    scratch = tempfile.TemporaryDirectory() #kept alive by run
+    path = os.path.join(scratch.name, "in.schem")
+    schemgen.save_schem(gen_blocks(), 0, 0, 0, path)
+    with schemgen.SchemReader(path) as reader:
+        rng = random.Random(seed)
+        lookups = [(reader.corner[0] + rng.randrange(reader.width), reader.corner[1] + rng.randrange(reader.height),
+                    reader.corner[2] + rng.randrange(reader.length)) for _ in range(n_lookups)]
+    def run(directory, scratch = scratch):
+        with schemgen.SchemReader(path) as reader:
+            for x, y, z in lookups:
+                reader.get(x, y, z)
+        return 0
+    return run
+
+def bench_compile_assembly(code):
+    def run(directory):
+        rom, ram = p16.compile_assembly(code)
+        return sum(len(nibbles) for nibbles in rom.values()) + sum(len(nibbles) for nibbles in ram.values())
+    return run
+
+def bench_nibbles_to_schem(rom, ram, pipelined = False):
+    def run(directory):
+        p16.nibbles_to_schem(rom, ram, active_pages = set(range(16)), out_dir = directory, pipelined = pipelined)
+        return os.path.getsize(os.path.join(directory, "rom.schem")) + os.path.getsize(os.path.join(directory, "ram.schem"))
+    return run
+
+#reading the nibbles back out of the rom and ram schematics of a full build
+def bench_schem_to_nibbles(rom, ram):
+    scratch = tempfile.TemporaryDirectory() #kept alive by run
+    p16.nibbles_to_schem(rom, ram, active_pages = set(range(16)), out_dir = scratch.name)
+    def run(directory, scratch = scratch):
+        found_rom = p16.rom_schem_to_nibbles(os.path.join(scratch.name, "rom.schem"))
+        found_ram = p16.ram_schem_to_nibbles(os.path.join(scratch.name, "ram.schem"))
+        return sum(len(nibbles) for nibbles in found_rom.values()) + sum(len(nibbles) for nibbles in found_ram.values())
+    return run
+
+def bench_compression(compression):
+    volume = gen_noisy_volume()
+    def run(directory):
+        path = os.path.join(directory, "out.schem")
+        schemgen.save_volume_schem(volume, 0, 0, 0, path, compression)
+        return os.path.getsize(path)
+    return run
+
+#two big volumes overlapping by half, merged with the second one taking priority over the first
+def bench_merge_volumes():
+    parts = [(gen_noisy_volume(seed = 0), (0, 0, 0)), (gen_noisy_volume(seed = 1), (64, 32, 64))]
+    def run(directory):
+        volume, corner = schemgen.merge_volumes(parts, priorities = [1, 0])
+        return 0
+    return run
+
+def bench_emulator(n_steps = 10 ** 6):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "P16", "assembly.txt")) as f:
+        rom, ram = p16.compile_assembly(f.read())
+    def run(directory):
+        emulator.P16Emulator(rom, ram, start_page = 4).run(n_steps)
+        return 0
+    return run
+
+
+#name -> (function making the benchmark, how many times to time it)
+#the workloads are only generated when their benchmark is run
+BENCHMARKS = {
+    "save_schem/dense" : (lambda : bench_save_schem(gen_dense_blocks), 3),
+    "save_schem/dense_bounded" : (lambda : bench_save_schem(gen_dense_blocks, bounds = ((0, 0, 0), (64, 64, 64))), 3),
+    "save_schem/sparse" : (lambda : bench_save_schem(gen_sparse_blocks), 3),
+    "save_schem/palette" : (lambda : bench_save_schem(gen_palette_blocks), 3),
+    "save_schem/barrels" : (lambda : bench_save_schem(gen_barrel_blocks), 3),
+    "blocks_to_schem/dense" : (lambda : bench_blocks_to_schem(gen_dense_blocks), 3),
+    "blocks_to_schem/barrels" : (lambda : bench_blocks_to_schem(gen_barrel_blocks), 1),
+    "schem_to_blocks/dense" : (lambda : bench_schem_to_blocks(gen_dense_blocks), 3),
+    "schem_to_blocks/sparse" : (lambda : bench_schem_to_blocks(gen_sparse_blocks), 3),
+    "schem_reader/dense" : (lambda : bench_schem_reader(gen_dense_blocks), 3),
+    "schem_reader/palette" : (lambda : bench_schem_reader(gen_palette_blocks), 3),
+    "merge_volumes/large" : (lambda : bench_merge_volumes(), 3),
+    "compile_assembly/full" : (lambda : bench_compile_assembly(gen_full_assembly()), 3),
+    "compile_assembly/full_auto_ram" : (lambda : bench_compile_assembly(gen_full_assembly(auto_ram = True)), 3),
+    "compile_assembly/64k_lines" : (lambda : bench_compile_assembly(gen_assembly(2 ** 16)), 1),
+    "nibbles_to_schem/full" : (lambda : bench_nibbles_to_schem(*gen_full_nibbles()), 3),
+    "nibbles_to_schem/full_pipelined" : (lambda : bench_nibbles_to_schem(*gen_full_nibbles(), pipelined = True), 3),
+    "schem_to_nibbles/full" : (lambda : bench_schem_to_nibbles(*gen_full_nibbles()), 3),
+    "emulator/1M_steps" : (lambda : bench_emulator(), 1),
+}
+for compression in schemgen.COMPRESSIONS:
+    BENCHMARKS[f"compression/{compression}"] = (lambda compression = compression : bench_compression(compression), 3)
+
+
+#run one benchmark and return {"time" : seconds, "memory" : bytes, "size" : bytes}
+def run_benchmark(name):
+    make, repeat = BENCHMARKS[name]
+    with tempfile.TemporaryDirectory() as directory:
+        out = open(os.devnull, "w") #nibbles_to_schem prints a lot
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            run = make()
+            size = run(directory)
+            t = best_time(lambda : run(directory), repeat = repeat)
+            memory = peak_memory(lambda : run(directory))
+        finally:
+            sys.stdout = stdout
+            out.close()
+    return {"time" : t, "memory" : memory, "size" : size}
+
+
+#the baseline time of a benchmark scaled to a machine whose calibrate() took calibration seconds
+#results recorded before calibration was added are taken as they are
+def scaled_time(base, calibration):
+    if "calibration" not in base:
+        return base["time"]
+    return base["time"] * calibration / base["calibration"]
+
+#compare results against the baseline, returning a list of what got worse
+#times are compared after scaling the baseline to this machine, memory is compared as it is
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = {"time" : scaled_time(baseline[name], result["calibration"]), "memory" : baseline[name]["memory"]}
+        for key in ["time", "memory"]:
+            if result[key] > tolerance * expected[key]:
+                regressions.append(f"{name} {key} went from {expected[key]:.4g} to {result[key]:.4g}")
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark schemgen and the P16 pipeline")
+    parser.add_argument("names", nargs = "*", help = "benchmarks to run, or prefixes of them such as \"save_schem\". Defaults to all of them")
+    parser.add_argument("--baseline", default = BASELINE_PATH, help = "json file of results to compare against")
+    parser.add_argument("--save-baseline", action = "store_true", help = "store these results as the new baseline instead of comparing")
+    parser.add_argument("--tolerance", type = float, default = 1.5, help = "how many times slower or bigger than the baseline counts as a regression")
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if len(args.names) == 0 or any(name.startswith(prefix) for prefix in args.names)]
+    if len(names) == 0:
+        parser.error("no benchmarks match " + ", ".join(args.names))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    calibration = calibrate()
+    print(f"calibration {1000 * calibration:.1f}ms, baseline times are scaled to match")
+    print(f"{'benchmark':<28} {'time':>10} {'baseline':>10} {'peak memory':>12} {'output':>10}")
+    for name in names:
+        result = run_benchmark(name)
+        result["calibration"] = calibration
+        results[name] = result
+        base = f"{1000 * scaled_time(baseline[name], calibration):8.1f}ms" if name in baseline else f"{'-':>10}"
+        print(f"{name:<28} {1000 * result['time']:8.1f}ms {base} {result['memory'] / 2 ** 20:10.1f}MB {result['size']:>10}")
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent = 4, sort_keys = True)
+        print(f"Baseline saved to \"{args.baseline}\"")
+        return 0
+
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION: " + regression)
+    return 1 if len(regressions) != 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,24 +1,256 @@
+import io
+import os
+import gzip
+import mmap
+import json
+import time
+import zlib
+import shutil
+import pickle
+import struct
+import tempfile
+import threading
+import contextlib
+import concurrent.futures
+import numpy
 import nbtlib
 from nbtlib.tag import String, List, Compound, IntArray, Int, ByteArray, Byte, Short
 
 
+#nbt tag ids, see https://minecraft.fandom.com/wiki/NBT_format
+TAG_END = 0
+TAG_BYTE = 1
+TAG_SHORT = 2
+TAG_INT = 3
+TAG_LONG = 4
+TAG_FLOAT = 5
+TAG_DOUBLE = 6
+TAG_BYTE_ARRAY = 7
+TAG_STRING = 8
+TAG_LIST = 9
+TAG_COMPOUND = 10
+TAG_INT_ARRAY = 11
+TAG_LONG_ARRAY = 12
+
+
+#an opt-in record of how long each stage of a build took and how much it handled, see profiling()
+#stages can nest and can run on several threads, each finished stage is kept as an event
+class BuildProfile():
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = [] #dicts of name, path, depth, thread, start, duration and counts, in the order the stages finished
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stack = self.stack()
+        path = "/".join([event["name"] for event in stack] + [name])
+        event = {"name" : name, "path" : path, "depth" : len(stack), "thread" : threading.get_ident(), "counts" : {}}
+        stack.append(event)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            event["start"] = start - self.start
+            event["duration"] = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                self.events.append(event)
+
+    #add to the counts of the innermost stage running on this thread
+    def count(self, **counts):
+        stack = self.stack()
+        if len(stack) != 0:
+            event_counts = stack[-1]["counts"]
+            for key, value in counts.items():
+                event_counts[key] = event_counts.get(key, 0) + value
+
+    #the events combined by path, in the order the stages started
+    #returns a list of dicts of path, name, depth, calls, time and the summed counts
+    def summary(self):
+        stages = {}
+        for event in sorted(self.events, key = lambda event : event["start"]):
+            stage = stages.setdefault(event["path"], {"path" : event["path"], "name" : event["name"], "depth" : event["depth"],
+                                                      "calls" : 0, "time" : 0.0, "counts" : {}})
+            stage["calls"] += 1
+            stage["time"] += event["duration"]
+            for key, value in event["counts"].items():
+                stage["counts"][key] = stage["counts"].get(key, 0) + value
+        return list(stages.values())
+
+    def report(self):
+        lines = [f"{'stage':<40} {'calls':>5} {'time':>10}  counts"]
+        for stage in self.summary():
+            counts = ", ".join(f"{key}={value}" for key, value in stage["counts"].items())
+            lines.append(f"{'  ' * stage['depth'] + stage['name']:<40} {stage['calls']:>5} {1000 * stage['time']:8.1f}ms  {counts}")
+        return "\n".join(lines)
+
+    #save the events in the chrome trace format, which chrome://tracing and https://ui.perfetto.dev can show
+    #the summary is saved alongside them under its own key
+    def save_trace(self, path):
+        trace = {"traceEvents" : [{"name" : event["name"], "ph" : "X", "pid" : os.getpid(), "tid" : event["thread"],
+                                   "ts" : 1e6 * event["start"], "dur" : 1e6 * event["duration"], "args" : event["counts"]}
+                                  for event in self.events],
+                 "summary" : self.summary()}
+        with open(path, "w") as f:
+            json.dump(trace, f, indent = 1)
+
+
+#the profile being recorded into, if any. Only set this through profiling()
+PROFILE = None
+NO_STAGE = contextlib.nullcontext()
+
+
+#record the stages of everything run inside the with block, e.g.
+#    with schemgen.profiling() as profile:
+#        schemgen.save_schem(blocks, 0, 0, 0, "out.schem")
+#    print(profile.report())
+#stages run in other processes (such as nibbles_to_schem's workers) are not recorded
+@contextlib.contextmanager
+def profiling():
+    global PROFILE
+    previous = PROFILE
+    PROFILE = BuildProfile()
+    try:
+        yield PROFILE
+    finally:
+        PROFILE = previous
+
+
+#a context manager timing a stage of the build if a profile is being recorded, and doing nothing otherwise
+def profile_stage(name):
+    if PROFILE is None:
+        return NO_STAGE
+    return PROFILE.stage(name)
+
+
+#add to the counts of the current stage if a profile is being recorded
+def profile_count(**counts):
+    if PROFILE is not None:
+        PROFILE.count(**counts)
+
+
+#writes big endian nbt straight to a file object, without building nbtlib tags first
+#produces exactly the bytes nbtlib would for the same tags
+#the caller is responsible for nesting, e.g. every begin_compound needs a matching end_compound
+class NBTWriter():
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write_header(self, tag_id, name):
+        data = name.encode("utf-8")
+        self.fileobj.write(struct.pack(">bH", tag_id, len(data)) + data)
+
+    def write_byte(self, name, value):
+        self.write_header(TAG_BYTE, name)
+        self.fileobj.write(struct.pack(">b", value))
+
+    def write_short(self, name, value):
+        self.write_header(TAG_SHORT, name)
+        self.fileobj.write(struct.pack(">h", value))
+
+    def write_int(self, name, value):
+        self.write_header(TAG_INT, name)
+        self.fileobj.write(struct.pack(">i", value))
+
+    def write_string(self, name, value):
+        self.write_header(TAG_STRING, name)
+        data = value.encode("utf-8")
+        self.fileobj.write(struct.pack(">H", len(data)) + data)
+
+    def write_byte_array(self, name, data):
+        self.write_header(TAG_BYTE_ARRAY, name)
+        self.fileobj.write(struct.pack(">i", len(data)))
+        self.fileobj.write(data)
+
+    def write_int_array(self, name, values):
+        self.write_header(TAG_INT_ARRAY, name)
+        self.fileobj.write(struct.pack(f">i{len(values)}i", len(values), *values))
+
+    def begin_compound(self, name):
+        self.write_header(TAG_COMPOUND, name)
+
+    def end_compound(self):
+        self.fileobj.write(b"\x00")
+
+    #the elements must then be written as bare payloads, e.g. compound contents followed by end_compound
+    def begin_list(self, name, tag_id, count):
+        self.write_header(TAG_LIST, name)
+        self.fileobj.write(struct.pack(">bi", tag_id, count))
+
+
+#every distinct (ident, extra) pair is given one global state id, so blocks of the same kind share it
+#and volumes can look states up by id instead of building an ident + extra string for every block
+class BlockStates():
+    def __init__(self):
+        self.ids = {} #(ident, extra) -> state id
+        self.names = [] #state id -> ident + extra
+        self.parts = [] #state id -> (ident, extra)
+        self.lock = threading.Lock() #only taken for new states, so that threads interning the same one at once agree on its id
+
+    #the id of a block state, checking it the first time it is seen
+    def intern(self, ident, extra):
+        state = self.ids.get((ident, extra))
+        if state is None:
+            assert type(ident) == str
+            assert type(extra) == str
+            if len(extra) != 0:
+                assert extra[0] == "[" and extra[-1] == "]"
+            with self.lock:
+                state = self.ids.get((ident, extra))
+                if state is None:
+                    state = len(self.names)
+                    self.names.append(ident + extra)
+                    self.parts.append((ident, extra))
+                    self.ids[(ident, extra)] = state
+        return state
+
+BLOCK_STATES = BlockStates()
+
+
+#the names of the slots of a class and all its bases, apart from the position, cached per class
+SLOT_NAMES = {}
+
+def slot_names(cls):
+    names = SLOT_NAMES.get(cls)
+    if names is None:
+        names = tuple(name for base in cls.__mro__ for name in getattr(base, "__slots__", ()) if name not in {"x", "y", "z"})
+        SLOT_NAMES[cls] = names
+    return names
+
+
 #general minecraft block
 #x, y, z is the positions of the block
 #ident is the type of block, e.g. "minecraft:barrel"
 #extra is anything that comes after the type of block, eg "[facing=up,open=false]"
+#only the position and the BLOCK_STATES id are stored, ident and extra are looked up from the id
 class Block():
+    __slots__ = ("x", "y", "z", "state")
+
     def __init__(self, x, y, z, ident, extra = ""):
         assert type(x) == type(y) == type(z) == int
-        assert type(ident) == str
-        assert type(extra) == str
-        if len(extra) != 0:
-            assert extra[0] == "[" and extra[-1] == "]"
-        self.ident = ident
-        self.extra = extra
+        self.state = BLOCK_STATES.intern(ident, extra)
         self.x = x
         self.y = y
         self.z = z
 
+    #whether block_entities yields anything, so that volumes only need to keep hold of blocks which do
+    has_block_entities = False
+
+    @property
+    def ident(self):
+        return BLOCK_STATES.parts[self.state][0]
+
+    @property
+    def extra(self):
+        return BLOCK_STATES.parts[self.state][1]
+
     def __str__(self):
         return f"Block({self.x}, {self.y}, {self.z}, {self.ident + self.extra})"
 
@@ -26,21 +258,68 @@ class Block():
     def pos(self):
         return (self.x, self.y, self.z)
 
+    #a copy of this block at a different position, sharing everything else (e.g. a barrel's items) with the original
+    def moved_to(self, x, y, z):
+        assert type(x) == type(y) == type(z) == int
+        block = object.__new__(type(self))
+        for name in slot_names(type(self)):
+            setattr(block, name, getattr(self, name))
+        block.x = x
+        block.y = y
+        block.z = z
+        return block
+
     def block_entities(self):
         return
         yield
 
+    #write the block entities of this block, placed at local position pos, as bare compound payloads to fileobj
+    #returns how many were written
+    def write_block_entities(self, fileobj, pos):
+        count = 0
+        for ent in self.block_entities():
+            ent["Id"] = String(self.ident)
+            ent["Pos"] = IntArray([Int(pos[0]), Int(pos[1]), Int(pos[2])])
+            ent.write(fileobj)
+            count += 1
+        return count
+
+#the items of a barrel, which can't be changed in place because Signals share them (and their prebuilt nbt) with their template
+#assign new items to the barrel instead
+class FrozenItems(dict):
+    def refuse(self, *args, **kwargs):
+        raise TypeError("A barrel's items can't be changed in place, assign new items to it instead")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = refuse
+
+    #pickle rebuilds dicts item by item, which would be refused
+    def __reduce__(self):
+        return (FrozenItems, (dict(self),))
+
 #a barrel containing some items
 #items should be a dict whose keys are slots from 0-26 and whose values are tuples of (item name, quantity) e.g. {7 : ("minecraft:redstone", 64)}
 class Barrel(Block):
+    __slots__ = ("_items", "items_nbt")
+
     def __init__(self, x, y, z, items):
+        super().__init__(x, y, z, "minecraft:barrel", "[facing=up,open=false]")
+        self.items = items
+
+    @property
+    def items(self):
+        return self._items
+
+    @items.setter
+    def items(self, items):
         for slot in items:
             item, quant = items[slot]
             assert type(slot) == int and 0 <= slot < 27
             assert type(item) == str
             assert 0 <= quant <= 64
-        super().__init__(x, y, z, "minecraft:barrel", "[facing=up,open=false]")
-        self.items = items #dict of {slot : (item, quant)}
+        self._items = FrozenItems(items) #dict of {slot : (item, quant)}
+        self.items_nbt = None #the serialized Items list if it has been prebuilt, see encode_barrel_items
+
+    has_block_entities = True
 
     def block_entities(self):
         def gen_sid():
@@ -49,138 +328,1136 @@ class Barrel(Block):
                 yield slot, ident, count
         yield Compound({"Items" : List[Compound]([Compound({"Slot" : Byte(slot), "id" : String(ident), "Count" : Byte(count)}) for slot, ident, count in gen_sid()])})
 
+    #same bytes as the default implementation but without going through nbtlib
+    def write_block_entities(self, fileobj, pos):
+        if self.items_nbt is None:
+            fileobj.write(encode_barrel_items(self.items))
+        else:
+            fileobj.write(self.items_nbt)
+        nbt = NBTWriter(fileobj)
+        nbt.write_string("Id", self.ident)
+        nbt.write_int_array("Pos", pos)
+        nbt.end_compound()
+        return 1
+
 
-#a barrel which contains enough redstone to emit a signal of ss when read by a comparator
-def Signal(x, y, z, ss):
-    n = [0, 123, 246, 370, 493, 617, 740, 863, 987, 1110, 1234, 1357, 1481, 1604, 1727, 1728][ss]
-    items = []
-    while n >= 64:
+#the named Items list of a barrel's block entity as nbt bytes
+def encode_barrel_items(items):
+    fileobj = io.BytesIO()
+    nbt = NBTWriter(fileobj)
+    nbt.begin_list("Items", TAG_COMPOUND, len(items))
+    for slot, (ident, count) in items.items():
+        nbt.write_byte("Slot", slot)
+        nbt.write_string("id", ident)
+        nbt.write_byte("Count", count)
+        nbt.end_compound()
+    return fileobj.getvalue()
+
+
+#one barrel for each signal strength 0-15, with their items already serialized
+#Signal only ever moves copies of these around, so the items are built and validated once rather than per barrel
+def make_signal_templates():
+    templates = []
+    for n in [0, 123, 246, 370, 493, 617, 740, 863, 987, 1110, 1234, 1357, 1481, 1604, 1727, 1728]:
+        items = []
+        while n >= 64:
             items.append(64)
             n -= 64
-    if n != 0:
-        items.append(n)
-        n = 0
-    return Barrel(x, y, z, {idx : ("minecraft:redstone", count) for idx, count in enumerate(items)})
-    
-    
-#make a schematic out of a list of blocks. The origin for //paste is given by (x, y, z)
-def blocks_to_schem(mblocks, x, y, z):
-    assert type(x) == type(y) == type(z) == int
+        if n != 0:
+            items.append(n)
+            n = 0
+        template = Barrel(0, 0, 0, {idx : ("minecraft:redstone", count) for idx, count in enumerate(items)})
+        template.items_nbt = encode_barrel_items(template.items)
+        templates.append(template)
+    return templates
 
-    blocks = {}
-    for block in mblocks:
-        blocks[block.pos] = block
-    
-    if len(blocks) == 0:
-        block_data = []
-        palette = {}
-        width = 0
-        height = 0
-        length = 0
-        we_x = x
-        we_y = y
-        we_z = z
-    else:
-        min_x = min(p[0] for p in blocks)
-        min_y = min(p[1] for p in blocks)
-        min_z = min(p[2] for p in blocks)
-        we_x = x - min_x
-        we_y = y - min_y
-        we_z = z - min_z
-        blocks = {(p[0] - min_x, p[1] - min_y, p[2] - min_z) : blocks[p] for p in blocks}
-        width = max(p[0] for p in blocks) + 1
-        height = max(p[1] for p in blocks) + 1
-        length = max(p[2] for p in blocks) + 1
-
-        def t31(x, y, z):
-            assert 0 <= x < width
-            assert 0 <= y < height
-            assert 0 <= z < length
-            idx = x + z * width + y * width * length
-            assert 0 <= idx < width * height * length
-            return idx
-        
-    ##    def t13(idx):
-    ##        assert 0 <= idx < width * height * length
-    ##        yz, x = divmod(idx, width)
-    ##        y, z = divmod(yz, length)
-    ##        assert 0 <= x < width
-    ##        assert 0 <= y < height
-    ##        assert 0 <= z < length
-    ##        return x, y, z
-
-        for x in range(width):
-            for y in range(height):
-                for z in range(length):
-                    if not (x, y, z) in blocks:
-                        blocks[(x, y, z)] = Block(min_x + x, min_y + y, min_z + z, "minecraft:air")
-
-        palette = {ident : idx for idx, ident in enumerate(set(block.ident + block.extra for block in blocks.values()))}
-
-        block_data = [None] * (width * height * length)
-        for p in blocks:
-            block = blocks[p]
-            block_data[t31(*p)] = palette[block.ident + block.extra]
-            
-    def gen_ents():
-        for p in blocks:
-            block = blocks[p]
+SIGNAL_TEMPLATES = make_signal_templates()
+
+
+#a barrel which contains enough redstone to emit a signal of ss when read by a comparator
+def Signal(x, y, z, ss):
+    return SIGNAL_TEMPLATES[ss].moved_to(x, y, z)
+
+
+#a block read back from a schematic along with the block entities it had there, which are kept as nbtlib compounds
+#entities should not contain "Id" or "Pos", they are added back when writing
+class EntityBlock(Block):
+    __slots__ = ("entities",)
+
+    def __init__(self, x, y, z, ident, extra, entities):
+        super().__init__(x, y, z, ident, extra)
+        self.entities = entities
+
+    has_block_entities = True
+
+    def block_entities(self):
+        for ent in self.entities:
+            yield Compound(ent)
+
+
+#the bytes a block's entities would be written as at (0, 0, 0), for comparing the entities of two blocks
+def block_entities_nbt(block):
+    fileobj = io.BytesIO()
+    block.write_block_entities(fileobj, (0, 0, 0))
+    return fileobj.getvalue()
+
+
+#BlockData in a sponge schematic is a sequence of unsigned varints, one per cell
+#each value is split into 7 bit groups, lowest first, and every byte except the last of a value has its top bit set
+#so palette indices up to 127 take 1 byte, up to 16383 take 2 bytes and so on
+def encode_varints(values):
+    values = numpy.asarray(values)
+    if len(values) == 0:
+        return numpy.zeros(0, dtype = numpy.uint8)
+    assert values.min() >= 0 and values.max() < 2 ** 32
+    #with up to 128 palette entries every varint is one byte, the value itself
+    if values.max() < 2 ** 7:
+        return values.astype(numpy.uint8)
+
+    #kept as narrow as they can be, as there is one of each per cell of the volume
+    values = values.astype(numpy.uint32, copy = False)
+    sizes = numpy.ones(len(values), dtype = numpy.uint8)
+    for k in range(1, 5):
+        sizes += values >= 2 ** (7 * k)
+    starts = numpy.cumsum(sizes, dtype = numpy.uint32 if 5 * len(values) < 2 ** 32 else numpy.int64)
+    total = int(starts[-1])
+    starts -= sizes
+
+    data = numpy.empty(total, dtype = numpy.uint8)
+    for k in range(int(sizes.max())):
+        #the k-th byte of every value which is at least k+1 bytes long, which for the first byte is all of them
+        which = slice(None) if k == 0 else sizes > k
+        groups = ((values[which] >> (7 * k)) & 0x7F).astype(numpy.uint8)
+        groups[sizes[which] > k + 1] |= 0x80
+        data[starts[which] + k] = groups
+    return data
+
+
+#inverse of encode_varints, returns an int64 array of values
+def decode_varints(data):
+    data = numpy.asarray(data).astype(numpy.uint8)
+    if len(data) == 0:
+        return numpy.zeros(0, dtype = numpy.int64)
+    if data[-1] & 0x80:
+        raise ValueError("BlockData ends part way through a varint")
+
+    ends = numpy.flatnonzero((data & 0x80) == 0)
+    starts = numpy.concatenate([[0], ends[:-1] + 1])
+    sizes = ends - starts + 1
+    if sizes.max() > 5:
+        raise ValueError("BlockData contains a varint longer than 5 bytes")
+
+    shifts = 7 * (numpy.arange(len(data)) - numpy.repeat(starts, sizes))
+    groups = (data & 0x7F).astype(numpy.int64) << shifts
+    return numpy.bitwise_or.reduceat(groups, starts)
+
+
+#a box of blocks stored compactly as a palette and a flat array of palette indices, one per cell
+#cells are indexed in the same order as the schematic BlockData, see Volume.index
+#palette index 0 is always air so a freshly allocated volume is empty
+#blocks with block entities (e.g. barrels) are kept by local position so their entities can be written later
+class Volume():
+    def __init__(self, width, height, length):
+        assert type(width) == type(height) == type(length) == int
+        assert width >= 0 and height >= 0 and length >= 0
+        self.width = width
+        self.height = height
+        self.length = length
+        self.palette = {"minecraft:air" : 0} #ident + extra -> palette index
+        self.palette_lookup = {BLOCK_STATES.intern("minecraft:air", "") : 0} #global state id -> palette index
+        self.data = numpy.zeros(width * height * length, dtype = numpy.int32)
+        self.entity_blocks = {} #local (x, y, z) -> block
+
+    def index(self, x, y, z):
+        assert 0 <= x < self.width
+        assert 0 <= y < self.height
+        assert 0 <= z < self.length
+        return x + z * self.width + y * self.width * self.length
+
+    #the palette index of a block state, adding it to the palette if it is new
+    def state(self, ident_extra):
+        idx = self.palette.get(ident_extra)
+        if idx is None:
+            idx = len(self.palette)
+            self.palette[ident_extra] = idx
+        return idx
+
+    #place a block at local coordinates (x, y, z), replacing whatever was there
+    def set_block(self, x, y, z, block):
+        idx = self.palette_lookup.get(block.state)
+        if idx is None:
+            idx = self.state(BLOCK_STATES.names[block.state])
+            self.palette_lookup[block.state] = idx
+        self.data[self.index(x, y, z)] = idx
+        if block.has_block_entities:
+            self.entity_blocks[(x, y, z)] = block
+        else:
+            self.entity_blocks.pop((x, y, z), None)
+
+    #copy the non-air cells of another volume into this one with its (0, 0, 0) corner at local coordinates (x, y, z)
+    #with include_air the air cells are copied too, like //paste without -a
+    #the other volume's palette is remapped onto this one and its block entities come along too
+    def paste(self, other, x, y, z, include_air = False):
+        assert 0 <= x and x + other.width <= self.width
+        assert 0 <= y and y + other.height <= self.height
+        assert 0 <= z and z + other.length <= self.length
+
+        remap = numpy.zeros(len(other.palette), dtype = numpy.int32)
+        for ident_extra, idx in other.palette.items():
+            remap[idx] = self.state(ident_extra)
+
+        #index = x + z * width + y * width * length, so the flat data is a (height, length, width) array
+        src = other.data.reshape(other.height, other.length, other.width)
+        dst = self.data.reshape(self.height, self.length, self.width)[y : y + other.height, z : z + other.length, x : x + other.width]
+        if include_air:
+            placed = numpy.ones(src.shape, dtype = bool)
+            dst[...] = remap[src]
+        else:
+            placed = src != 0
+            dst[placed] = remap[src[placed]]
+
+        for p in list(self.entity_blocks):
+            ox, oy, oz = p[0] - x, p[1] - y, p[2] - z
+            if 0 <= ox < other.width and 0 <= oy < other.height and 0 <= oz < other.length and placed[oy, oz, ox]:
+                del self.entity_blocks[p]
+        for p, block in other.entity_blocks.items():
+            self.entity_blocks[(p[0] + x, p[1] + y, p[2] + z)] = block
+
+    #a copy of the cells where mask (a flat boolean array, one entry per cell) is set, cropped to just contain them
+    #returns the new volume and the local position in this volume of its (0, 0, 0) corner
+    def select(self, mask):
+        cells = mask.reshape(self.height, self.length, self.width)
+        if not cells.any():
+            return Volume(0, 0, 0), (0, 0, 0)
+        ys, zs, xs = numpy.nonzero(cells)
+        x0, y0, z0 = int(xs.min()), int(ys.min()), int(zs.min())
+        x1, y1, z1 = int(xs.max()) + 1, int(ys.max()) + 1, int(zs.max()) + 1
+
+        sub = Volume(x1 - x0, y1 - y0, z1 - z0)
+        sub.palette = dict(self.palette)
+        sub.palette_lookup = dict(self.palette_lookup)
+        data = self.data.reshape(self.height, self.length, self.width)
+        sub.data = numpy.where(cells, data, 0)[y0 : y1, z0 : z1, x0 : x1].ravel()
+        for p, block in self.entity_blocks.items():
+            if cells[p[1], p[2], p[0]]:
+                sub.entity_blocks[(p[0] - x0, p[1] - y0, p[2] - z0)] = block
+        return sub, (x0, y0, z0)
+
+    #yield the block entities of the volume with their Id and local Pos filled in
+    def gen_block_entities(self):
+        for p, block in self.entity_blocks.items():
             for ent in block.block_entities():
                 ent["Id"] = String(block.ident)
                 ent["Pos"] = IntArray([Int(p[0]), Int(p[1]), Int(p[2])])
                 yield ent
-    
+
+
+#make a volume out of a list of blocks, just big enough to contain them all
+#if multiple blocks are at the same location, the last one is the chosen one
+#if the caller already knows where the blocks are, bounds = ((x0, y0, z0), (x1, y1, z1)) gives the volume to use instead,
+#covering x0 <= x < x1 and so on. The blocks are then placed as they are generated, without holding on to any of them,
+#and a ValueError is raised for any block outside the bounds
+#returns the volume and the world position of its (0, 0, 0) corner
+def blocks_to_volume(mblocks, bounds = None):
+    if bounds is not None:
+        return blocks_to_bounded_volume(mblocks, bounds)
+
+    with profile_stage("generate blocks"):
+        blocks = list(mblocks)
+        profile_count(blocks = len(blocks))
+    if len(blocks) == 0:
+        return Volume(0, 0, 0), (0, 0, 0)
+
+    with profile_stage("bounds"):
+        min_x = min(block.x for block in blocks)
+        min_y = min(block.y for block in blocks)
+        min_z = min(block.z for block in blocks)
+        width = max(block.x for block in blocks) - min_x + 1
+        height = max(block.y for block in blocks) - min_y + 1
+        length = max(block.z for block in blocks) - min_z + 1
+
+    with profile_stage("allocate volume"):
+        volume = Volume(width, height, length)
+        profile_count(cells = volume.data.size)
+    with profile_stage("place blocks"):
+        for block in blocks:
+            volume.set_block(block.x - min_x, block.y - min_y, block.z - min_z, block)
+        profile_count(palette = len(volume.palette), entity_blocks = len(volume.entity_blocks))
+    return volume, (min_x, min_y, min_z)
+
+
+def blocks_to_bounded_volume(mblocks, bounds):
+    (x0, y0, z0), (x1, y1, z1) = bounds
+    assert type(x0) == type(y0) == type(z0) == type(x1) == type(y1) == type(z1) == int
+    assert x0 <= x1 and y0 <= y1 and z0 <= z1
+
+    with profile_stage("allocate volume"):
+        volume = Volume(x1 - x0, y1 - y0, z1 - z0)
+        profile_count(cells = volume.data.size)
+    with profile_stage("generate and place blocks"):
+        count = 0
+        for block in mblocks:
+            x, y, z = block.x - x0, block.y - y0, block.z - z0
+            if not (0 <= x < volume.width and 0 <= y < volume.height and 0 <= z < volume.length):
+                raise ValueError(f"{block} is outside the bounds {bounds}")
+            volume.set_block(x, y, z, block)
+            count += 1
+        profile_count(blocks = count, palette = len(volume.palette), entity_blocks = len(volume.entity_blocks))
+    return volume, (x0, y0, z0)
+
+
+#the same as blocks_to_volume but for blocks given as arrays, so that no Block objects are needed
+#xs, ys, zs are the world positions of the blocks and states their BLOCK_STATES ids, in the order they would have been yielded
+#entities is a dict of {index into the arrays : block} for the blocks which have block entities
+#the volume is identical to what blocks_to_volume makes, including the order of its palette and block entities
+#returns the volume and the world position of its (0, 0, 0) corner
+def arrays_to_volume(xs, ys, zs, states, entities = None):
+    entities = {} if entities is None else entities
+    xs, ys, zs, states = (numpy.asarray(a, dtype = numpy.int64) for a in (xs, ys, zs, states))
+    assert xs.shape == ys.shape == zs.shape == states.shape and xs.ndim == 1
+    if len(xs) == 0:
+        return Volume(0, 0, 0), (0, 0, 0)
+    assert states.min() >= 0 and states.max() < len(BLOCK_STATES.names)
+
+    with profile_stage("bounds"):
+        min_x, min_y, min_z = int(xs.min()), int(ys.min()), int(zs.min())
+        width = int(xs.max()) - min_x + 1
+        height = int(ys.max()) - min_y + 1
+        length = int(zs.max()) - min_z + 1
+
+    with profile_stage("allocate volume"):
+        volume = Volume(width, height, length)
+        profile_count(cells = volume.data.size)
+    with profile_stage("place blocks"):
+        #the palette is in the order the states first appear, as set_block would have added them
+        used, first = numpy.unique(states, return_index = True)
+        lookup = numpy.zeros(int(used[-1]) + 1, dtype = numpy.int32)
+        for state in used[numpy.argsort(first)].tolist():
+            lookup[state] = volume.state(BLOCK_STATES.names[state])
+            volume.palette_lookup[state] = int(lookup[state])
+
+        #the last block at each cell is the one which is kept
+        cells = (xs - min_x) + (zs - min_z) * width + (ys - min_y) * width * length
+        last = len(cells) - 1 - numpy.unique(cells[::-1], return_index = True)[1]
+        volume.data[cells[last]] = lookup[states[last]]
+
+        #replay set_block's bookkeeping for the cells which ever hold a block entity, so the entities end up in the same order
+        if len(entities) != 0:
+            touched = numpy.flatnonzero(numpy.isin(cells, cells[list(entities)]))
+            for k in touched.tolist():
+                p = (int(xs[k]) - min_x, int(ys[k]) - min_y, int(zs[k]) - min_z)
+                if k in entities:
+                    volume.entity_blocks[p] = entities[k]
+                else:
+                    volume.entity_blocks.pop(p, None)
+        profile_count(blocks = len(xs), palette = len(volume.palette), entity_blocks = len(volume.entity_blocks))
+    return volume, (min_x, min_y, min_z)
+
+
+#make plain Blocks out of arrays of positions and BLOCK_STATES ids, checking the arrays as a whole rather than each block
+#returns a list of the blocks
+def blocks_from_arrays(xs, ys, zs, states):
+    xs, ys, zs, states = (numpy.asarray(a) for a in (xs, ys, zs, states))
+    assert xs.shape == ys.shape == zs.shape == states.shape and xs.ndim == 1
+    assert all(a.dtype.kind in "iu" for a in (xs, ys, zs, states))
+    assert len(states) == 0 or (states.min() >= 0 and states.max() < len(BLOCK_STATES.names))
+
+    blocks = []
+    new = object.__new__
+    for x, y, z, state in zip(xs.tolist(), ys.tolist(), zs.tolist(), states.tolist()):
+        block = new(Block)
+        block.x = x
+        block.y = y
+        block.z = z
+        block.state = state
+        blocks.append(block)
+    return blocks
+
+
+#combine volumes into one just big enough to contain them all
+#parts is a list of (volume, (x, y, z)) where (x, y, z) is the world position of the volume's (0, 0, 0) corner, as returned by blocks_to_volume
+#so a part can be moved just by changing its corner
+#later parts overwrite earlier ones, except that air never overwrites anything unless include_air is set
+#if priorities (one number per part) are given, parts with a higher priority overwrite those with a lower one instead,
+#and parts with the same priority overwrite each other in order
+#palettes are remapped onto the merged volume and block entities come along with their blocks, all without making any Blocks
+#returns the merged volume and the world position of its (0, 0, 0) corner
+def merge_volumes(parts, priorities = None, include_air = False):
+    if priorities is not None:
+        assert len(priorities) == len(parts)
+        order = sorted(range(len(parts)), key = lambda k : priorities[k]) #sorted is stable so ties stay in order
+        parts = [parts[k] for k in order]
+    parts = [(volume, corner) for volume, corner in parts if volume.data.size != 0]
+    if len(parts) == 0:
+        return Volume(0, 0, 0), (0, 0, 0)
+
+    min_x = min(corner[0] for volume, corner in parts)
+    min_y = min(corner[1] for volume, corner in parts)
+    min_z = min(corner[2] for volume, corner in parts)
+    width = max(corner[0] + volume.width for volume, corner in parts) - min_x
+    height = max(corner[1] + volume.height for volume, corner in parts) - min_y
+    length = max(corner[2] + volume.length for volume, corner in parts) - min_z
+
+    with profile_stage("merge volumes"):
+        merged = Volume(width, height, length)
+        for volume, corner in parts:
+            merged.paste(volume, corner[0] - min_x, corner[1] - min_y, corner[2] - min_z, include_air)
+        profile_count(volumes = len(parts), cells = merged.data.size)
+    return merged, (min_x, min_y, min_z)
+
+
+#a flat boolean mask over the cells of volume marking those which differ from what old has at the same world position
+#corner and old_corner are the world positions of the volumes' (0, 0, 0) corners, and anywhere outside old counts as air
+#air cells of volume are never marked, so the marked cells are exactly what "//paste -a" needs to place to turn old into volume
+def changed_cells(volume, corner, old, old_corner):
+    #old's palette indices translated to volume's, -1 for states volume doesn't have
+    old_to_new = numpy.full(len(old.palette), -1, dtype = numpy.int32)
+    for ident_extra, idx in old.palette.items():
+        old_to_new[idx] = volume.palette.get(ident_extra, -1)
+
+    before = numpy.zeros((volume.height, volume.length, volume.width), dtype = numpy.int32)
+    dx, dy, dz = old_corner[0] - corner[0], old_corner[1] - corner[1], old_corner[2] - corner[2]
+    x0, x1 = max(dx, 0), min(dx + old.width, volume.width)
+    y0, y1 = max(dy, 0), min(dy + old.height, volume.height)
+    z0, z1 = max(dz, 0), min(dz + old.length, volume.length)
+    if x0 < x1 and y0 < y1 and z0 < z1:
+        old_data = old.data.reshape(old.height, old.length, old.width)
+        before[y0 : y1, z0 : z1, x0 : x1] = old_to_new[old_data[y0 - dy : y1 - dy, z0 - dz : z1 - dz, x0 - dx : x1 - dx]]
+    changed = (volume.data != before.ravel()) & (volume.data != 0)
+
+    #cells with the same state can still differ in their block entities, e.g. barrels with different contents
+    def compare_entities(p):
+        idx = volume.index(*p)
+        if changed[idx] or volume.data[idx] == 0:
+            return
+        old_block = old.entity_blocks.get((p[0] - dx, p[1] - dy, p[2] - dz))
+        new_block = volume.entity_blocks.get(p)
+        if old_block is None or new_block is None or block_entities_nbt(old_block) != block_entities_nbt(new_block):
+            changed[idx] = True
+
+    for p in volume.entity_blocks:
+        compare_entities(p)
+    for p in old.entity_blocks:
+        p = (p[0] + dx, p[1] + dy, p[2] + dz)
+        if 0 <= p[0] < volume.width and 0 <= p[1] < volume.height and 0 <= p[2] < volume.length:
+            compare_entities(p)
+    return changed
+
+
+#make a schematic out of a volume. The origin for //paste is given by (we_x, we_y, we_z) relative to the (0, 0, 0) corner of the volume
+def volume_to_schem(volume, we_x, we_y, we_z):
+    assert type(we_x) == type(we_y) == type(we_z) == int
+    check_schem_size(volume)
+
     comp = Compound({})
     comp["Version"] = Int(2)
     comp["DataVersion"] = Int(2584)
-    comp["PaletteMax"] = Int(len(palette))
-    comp["Palette"] = Compound({ident : Int(idx) for ident, idx in palette.items()})
-    comp["Width"] = Short(width)
-    comp["Height"] = Short(height)
-    comp["Length"] = Short(length)
-    comp["BlockData"] = ByteArray(block_data)
-    comp["BlockEntities"] = List[Compound](list(gen_ents()))
+    comp["PaletteMax"] = Int(len(volume.palette))
+    comp["Palette"] = Compound({ident : Int(idx) for ident, idx in volume.palette.items()})
+    comp["Width"] = Short(volume.width)
+    comp["Height"] = Short(volume.height)
+    comp["Length"] = Short(volume.length)
+    with profile_stage("encode block data"):
+        comp["BlockData"] = ByteArray(encode_varints(volume.data).view(numpy.int8))
+        profile_count(bytes = len(comp["BlockData"]))
+    with profile_stage("block entities"):
+        comp["BlockEntities"] = List[Compound](list(volume.gen_block_entities()))
+        profile_count(entities = len(comp["BlockEntities"]))
     comp["Metadata"] = Compound({"WEOffsetX" : Int(-we_x), "WEOffsetY" : Int(-we_y), "WEOffsetZ" : Int(-we_z)})
     comp["Offset"] = ByteArray([0, 0, 0])
     return nbtlib.File(Compound({"Schematic" : comp}), gzipped = True)
 
 
-def schem_to_blocks(file):
+#make a schematic out of a list of blocks. The origin for //paste is given by (x, y, z)
+#bounds can be given to fill the volume in one pass as the blocks are generated, see blocks_to_volume
+#nbtlib.File.save does the gzipping afterwards, so it is not part of the profile
+def blocks_to_schem(mblocks, x, y, z, bounds = None):
+    assert type(x) == type(y) == type(z) == int
+    with profile_stage("blocks_to_schem"):
+        volume, (min_x, min_y, min_z) = blocks_to_volume(mblocks, bounds)
+        with profile_stage("volume_to_schem"):
+            return volume_to_schem(volume, x - min_x, y - min_y, z - min_z)
+
+
+def check_schem_size(volume):
+    if max(volume.width, volume.height, volume.length) > MAX_SCHEM_SIZE:
+        raise ValueError(f"A {volume.width}x{volume.height}x{volume.length} volume is too big for one schematic, use save_tiled_schems instead")
+
+
+#write the uncompressed nbt of the schematic volume_to_schem would make straight to fileobj
+#the bytes are identical to volume_to_schem(volume, we_x, we_y, we_z).write(fileobj) but no nbtlib tags are built along the way
+def write_volume_schem(volume, we_x, we_y, we_z, fileobj):
+    assert type(we_x) == type(we_y) == type(we_z) == int
+    check_schem_size(volume)
+
+    nbt = NBTWriter(fileobj)
+    nbt.begin_compound("Schematic")
+    nbt.write_int("Version", 2)
+    nbt.write_int("DataVersion", 2584)
+    nbt.write_int("PaletteMax", len(volume.palette))
+    nbt.begin_compound("Palette")
+    for ident, idx in volume.palette.items():
+        nbt.write_int(ident, idx)
+    nbt.end_compound()
+    nbt.write_short("Width", volume.width)
+    nbt.write_short("Height", volume.height)
+    nbt.write_short("Length", volume.length)
+    with profile_stage("encode block data"):
+        block_data = encode_varints(volume.data).tobytes()
+        profile_count(bytes = len(block_data))
+    nbt.write_byte_array("BlockData", block_data)
+
+    #the list length comes before its elements, so the entities are serialized to a buffer first
+    with profile_stage("block entities"):
+        ents = io.BytesIO()
+        count = 0
+        for p, block in volume.entity_blocks.items():
+            count += block.write_block_entities(ents, p)
+        profile_count(entities = count, bytes = ents.tell())
+    nbt.begin_list("BlockEntities", TAG_COMPOUND, count)
+    fileobj.write(ents.getbuffer())
+
+    nbt.begin_compound("Metadata")
+    nbt.write_int("WEOffsetX", -we_x)
+    nbt.write_int("WEOffsetY", -we_y)
+    nbt.write_int("WEOffsetZ", -we_z)
+    nbt.end_compound()
+    nbt.write_byte_array("Offset", bytes([0, 0, 0]))
+    nbt.end_compound()
+
+
+#how a .schem file is compressed when it is saved
+#    "raw"      plain uncompressed nbt. nbtlib.load can read it but WorldEdit can't, it is only for tools
+#    "none"     gzip with level 0, so WorldEdit can read it but no time is spent compressing
+#    "fast"     gzip level 1
+#    "default"  gzip level 9, the same as nbtlib and the gzip module
+#    "max"      gzip level 9 with zlib's biggest memory level, slightly smaller than default
+#    "parallel" level 9 gzip of PARALLEL_CHUNK_SIZE chunks compressed on several threads and concatenated into a multi-member gzip
+#               file. Any gzip reader (including WorldEdit's) reads the members back as one stream
+COMPRESSIONS = ["raw", "none", "fast", "default", "max", "parallel"]
+GZIP_LEVELS = {"none" : 0, "fast" : 1, "default" : 9}
+PARALLEL_CHUNK_SIZE = 2 ** 20
+
+#raise a ValueError unless compression is one of COMPRESSIONS
+def check_compression(compression):
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}, must be one of " + ", ".join(COMPRESSIONS))
+
+
+#a file to write path through. It is written under a temporary name next to path and only renamed to path once it is complete,
+#so anything reading path never sees half a file and a failed save leaves the old file alone
+@contextlib.contextmanager
+def atomic_write(path):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            yield f
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+#a file object to stream the nbt of a schematic into, for the compressions which can be streamed, see atomic_write
+@contextlib.contextmanager
+def open_schem_file(path, compression):
+    with atomic_write(path) as f:
+        if compression == "raw":
+            yield f
+        else:
+            #the gzip header names the file, so it is given the real name rather than the temporary one
+            with gzip.GzipFile(path, "wb", GZIP_LEVELS[compression], f) as gzip_file:
+                yield gzip_file
+
+
+#compress uncompressed nbt and write it to fileobj, name is the file name recorded in the gzip header
+#workers is the number of threads "parallel" uses, by default one per cpu
+def write_compressed(data, fileobj, compression = "default", workers = None, name = ""):
+    check_compression(compression)
+
+    if compression == "max":
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS, 9) #16 + for a gzip header
+        fileobj.write(compressor.compress(data))
+        fileobj.write(compressor.flush())
+    elif compression == "parallel":
+        data = memoryview(data)
+        chunks = [data[i : i + PARALLEL_CHUNK_SIZE] for i in range(0, len(data), PARALLEL_CHUNK_SIZE)]
+        #zlib releases the GIL while compressing, so threads are enough
+        with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as pool:
+            for member in pool.map(lambda chunk : gzip.compress(chunk, compresslevel = 9), chunks):
+                fileobj.write(member)
+    elif compression == "raw":
+        fileobj.write(data)
+    else:
+        with gzip.GzipFile(name, "wb", GZIP_LEVELS[compression], fileobj) as gzip_file:
+            gzip_file.write(data)
+
+
+#compress uncompressed nbt and save it to path, see write_compressed
+def save_compressed(data, path, compression = "default", workers = None):
+    check_compression(compression)
+    with atomic_write(path) as f:
+        write_compressed(data, f, compression, workers, path)
+
+
+#the bytes of a .schem file for a volume, for when it isn't going to be saved straight away
+def volume_schem_bytes(volume, we_x, we_y, we_z, compression = "default", name = ""):
+    nbt = volume_schem_nbt(volume, we_x, we_y, we_z)
+    with profile_stage("compress"):
+        out = io.BytesIO()
+        write_compressed(nbt, out, compression, name = name)
+        profile_count(bytes = out.tell())
+    return out.getvalue()
+
+
+#save a volume as a .schem file at path, see write_volume_schem and COMPRESSIONS
+#when profiling or compressing in a way which can't be streamed, the nbt is written to memory first
+def save_volume_schem(volume, we_x, we_y, we_z, path, compression = "default"):
+    check_compression(compression)
+
+    if PROFILE is None and compression not in {"max", "parallel"}:
+        with open_schem_file(path, compression) as fileobj:
+            write_volume_schem(volume, we_x, we_y, we_z, fileobj)
+        return
+
+    with profile_stage("save " + os.path.basename(path)):
+        nbt = volume_schem_nbt(volume, we_x, we_y, we_z)
+        with profile_stage("compress"):
+            save_compressed(nbt, path, compression)
+            profile_count(bytes = os.path.getsize(path))
+
+
+#the uncompressed nbt write_volume_schem writes, in memory
+def volume_schem_nbt(volume, we_x, we_y, we_z):
+    with profile_stage("write nbt"):
+        nbt = io.BytesIO()
+        write_volume_schem(volume, we_x, we_y, we_z, nbt)
+        profile_count(palette = len(volume.palette), bytes = nbt.tell())
+    return nbt.getbuffer()
+
+
+#saves schematics on background threads, so that the next one can be built while the last is compressed and written
+#the nbt is written to memory on the calling thread, and only compressing and writing it, which zlib and file writes
+#release the GIL for, happen in the background. With workers = 0 everything is saved on the calling thread instead
+#leaving the with block waits for every save to finish, and raises the first error any of them hit
+class BackgroundSaver():
+    def __init__(self, workers = 2):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers) if workers != 0 else None
+        self.futures = []
+
+    #the same as schemgen.save_volume_schem, except that the file may not be written until wait is called
+    def save_volume_schem(self, volume, we_x, we_y, we_z, path, compression = "default"):
+        if self.pool is None:
+            return save_volume_schem(volume, we_x, we_y, we_z, path, compression)
+        check_compression(compression)
+        with profile_stage("save " + os.path.basename(path)):
+            nbt = volume_schem_nbt(volume, we_x, we_y, we_z)
+        self.futures.append(self.pool.submit(self.compress, nbt, path, compression))
+
+    def compress(self, nbt, path, compression):
+        with profile_stage("compress " + os.path.basename(path)):
+            save_compressed(nbt, path, compression)
+            profile_count(bytes = os.path.getsize(path))
+
+    #block until everything saved so far is on disk
+    def wait(self):
+        futures, self.futures = self.futures, []
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.wait()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+
+
+#the same as blocks_to_schem(mblocks, x, y, z, bounds).save(path) but streamed straight to disk
+def save_schem(mblocks, x, y, z, path, compression = "default", bounds = None):
+    assert type(x) == type(y) == type(z) == int
+    with profile_stage("save_schem"):
+        volume, (min_x, min_y, min_z) = blocks_to_volume(mblocks, bounds)
+        save_volume_schem(volume, x - min_x, y - min_y, z - min_z, path, compression)
+
+
+#Width, Height and Length are stored as Shorts, so no schematic can be bigger than this along any axis
+MAX_SCHEM_SIZE = 2 ** 15 - 1
+
+
+#how many blocks of a tile save_tiled_schems gathers before appending them to the tile's spill file
+TILE_SPILL_BLOCKS = 4096
+
+
+#split a list of blocks into tiles of tile_size = (width, height, length) and save each tile as its own schematic in directory
+#every tile is saved with the same //paste origin (x, y, z), so pasting each of them from the same spot rebuilds the whole thing
+#the blocks are spilled to a temporary file per tile as int32 (x, y, z, state) rows as they are generated, and blocks with
+#block entities are pickled to a second file per tile, so only one tile's blocks and volume are held in memory at a time
+#a manifest.json is written alongside listing each tile's file and the world position of its (0, 0, 0) corner, and the manifest is returned
+def save_tiled_schems(mblocks, x, y, z, directory, tile_size = (256, 256, 256), compression = "default"):
+    assert type(x) == type(y) == type(z) == int
+    for size in tile_size:
+        assert type(size) == int and 0 < size <= MAX_SCHEM_SIZE
+    tile_w, tile_h, tile_l = tile_size
+
+    with tempfile.TemporaryDirectory() as spill_dir:
+        pending = {} #(tx, ty, tz) -> flat list of x, y, z, state of the blocks not yet spilled
+        pending_entities = {} #(tx, ty, tz) -> list of (index of the block in the tile, block) not yet spilled
+        counts = {} #(tx, ty, tz) -> number of blocks in the tile
+
+        def spill_path(key, kind):
+            return os.path.join(spill_dir, "{}_{}_{}.{}".format(*key, kind))
+
+        def spill(key):
+            with open(spill_path(key, "bin"), "ab") as f:
+                numpy.array(pending[key], dtype = numpy.int32).tofile(f)
+            pending[key].clear()
+            if len(pending_entities[key]) != 0:
+                #pickled a batch at a time, so blocks in a batch which share their items (like Signals) still share them
+                with open(spill_path(key, "pickle"), "ab") as f:
+                    pickle.dump(pending_entities[key], f, pickle.HIGHEST_PROTOCOL)
+                pending_entities[key].clear()
+
+        def load_entities(key):
+            entities = {}
+            if os.path.exists(spill_path(key, "pickle")):
+                with open(spill_path(key, "pickle"), "rb") as f:
+                    while f.peek(1) != b"":
+                        entities.update(pickle.load(f))
+                os.remove(spill_path(key, "pickle"))
+            return entities
+
+        with profile_stage("spill blocks"):
+            for block in mblocks:
+                key = (block.x // tile_w, block.y // tile_h, block.z // tile_l)
+                rows = pending.get(key)
+                if rows is None:
+                    rows = pending[key] = []
+                    pending_entities[key] = []
+                    counts[key] = 0
+                if block.has_block_entities:
+                    pending_entities[key].append((counts[key], block))
+                rows += (block.x, block.y, block.z, block.state)
+                counts[key] += 1
+                if len(rows) >= 4 * TILE_SPILL_BLOCKS:
+                    spill(key)
+            for key, rows in pending.items():
+                if len(rows) != 0:
+                    spill(key)
+            del pending, pending_entities
+            profile_count(blocks = sum(counts.values()), tiles = len(counts))
+
+        os.makedirs(directory, exist_ok = True)
+        manifest = {"origin" : [x, y, z], "tile_size" : list(tile_size), "tiles" : []}
+        for key in sorted(counts):
+            rows = numpy.fromfile(spill_path(key, "bin"), dtype = numpy.int32).reshape(-1, 4)
+            os.remove(spill_path(key, "bin"))
+            volume, (min_x, min_y, min_z) = arrays_to_volume(rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3], load_entities(key))
+            del rows
+            name = "tile_{}_{}_{}.schem".format(*key)
+            save_volume_schem(volume, x - min_x, y - min_y, z - min_z, os.path.join(directory, name), compression)
+            manifest["tiles"].append({"file" : name,
+                                      "corner" : [min_x, min_y, min_z],
+                                      "size" : [volume.width, volume.height, volume.length]})
+            del volume
+
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent = 2)
+    return manifest
+
+
+#split a palette entry such as "minecraft:barrel[facing=up,open=false]" into its ident and extra
+def split_state(ident_extra):
+    if "[" in ident_extra:
+        k = ident_extra.index("[")
+        return ident_extra[:k], ident_extra[k:]
+    return ident_extra, ""
+
+
+#read the blocks of a schematic as arrays instead of Block objects
+#returns xs, ys, zs, ids, states where the first four are int64 arrays with one entry per block
+#xs, ys, zs are world coordinates relative to the //paste origin, ids are palette indices and states[id] is (ident, extra)
+#cells whose ident + extra is in skip are left out, e.g. skip = {"minecraft:air"}
+def schem_to_arrays(file, skip = ()):
     comp = file.root
 
     width = int(comp["Width"])
     height = int(comp["Height"])
     length = int(comp["Length"])
-    
-    def t13(idx):
-        assert 0 <= idx < width * height * length
-        yz, x = divmod(idx, width)
-        y, z = divmod(yz, length)
-        assert 0 <= x < width
-        assert 0 <= y < height
-        assert 0 <= z < length
-        return x, y, z
-
-    block_data = [int(x) for x in comp["BlockData"]]
-    palette_max = comp["PaletteMax"]
-    palette = {int(idx) : ident for ident, idx in comp["Palette"].items()}
+
+    palette = {int(idx) : ident_extra for ident_extra, idx in comp["Palette"].items()}
+    states = [None] * (max(palette) + 1 if len(palette) != 0 else 0)
+    for idx, ident_extra in palette.items():
+        states[idx] = split_state(ident_extra)
+
+    block_data = decode_varints(comp["BlockData"])
+    if len(block_data) != width * height * length:
+        raise ValueError(f"BlockData has {len(block_data)} entries but the schematic is {width}x{height}x{length}")
+
+    skip_ids = [idx for idx, ident_extra in palette.items() if ident_extra in skip]
+    if len(skip_ids) == 0:
+        cells = numpy.arange(len(block_data))
+    else:
+        cells = numpy.flatnonzero(~numpy.isin(block_data, skip_ids))
+
+    yz, xs = numpy.divmod(cells, width)
+    ys, zs = numpy.divmod(yz, length)
 
     we_x = -int(comp["Metadata"]["WEOffsetX"])
     we_y = -int(comp["Metadata"]["WEOffsetY"])
     we_z = -int(comp["Metadata"]["WEOffsetZ"])
+    return xs - we_x, ys - we_y, zs - we_z, block_data[cells], states
+
+
+#read a schematic back into a volume, keeping its block entities as EntityBlocks
+#returns the volume and the world position of its (0, 0, 0) corner relative to the //paste origin
+def schem_to_volume(file):
+    comp = file.root
+
+    width = int(comp["Width"])
+    height = int(comp["Height"])
+    length = int(comp["Length"])
+    volume = Volume(width, height, length)
+
+    palette = {int(idx) : ident_extra for ident_extra, idx in comp["Palette"].items()}
+    remap = numpy.zeros(max(palette) + 1 if len(palette) != 0 else 0, dtype = numpy.int32)
+    for idx, ident_extra in palette.items():
+        remap[idx] = volume.state(ident_extra)
+
+    block_data = decode_varints(comp["BlockData"])
+    if len(block_data) != width * height * length:
+        raise ValueError(f"BlockData has {len(block_data)} entries but the schematic is {width}x{height}x{length}")
+    volume.data = remap[block_data]
 
-    for idx in range(width * height * length):
-        x, y, z = t13(idx)
-        ident_extra = palette[block_data[idx]]
-        if "[" in ident_extra:
-            k = ident_extra.index("[")
-            ident, extra = ident_extra[:k], ident_extra[k:]
+    names = {idx : ident_extra for ident_extra, idx in volume.palette.items()}
+    we_x = -int(comp["Metadata"]["WEOffsetX"])
+    we_y = -int(comp["Metadata"]["WEOffsetY"])
+    we_z = -int(comp["Metadata"]["WEOffsetZ"])
+    for ent in comp.get("BlockEntities", []):
+        x, y, z = (int(n) for n in ent["Pos"])
+        ent = Compound({key : value for key, value in ent.items() if key not in {"Id", "Pos"}})
+        p = (x, y, z)
+        if p in volume.entity_blocks:
+            volume.entity_blocks[p].entities.append(ent)
         else:
-            ident, extra = ident_extra, ""
-        yield Block(x - we_x, y - we_y, z - we_z, ident, extra)
+            ident, extra = split_state(names[int(volume.data[volume.index(x, y, z)])])
+            volume.entity_blocks[p] = EntityBlock(x - we_x, y - we_y, z - we_z, ident, extra, [ent])
+    return volume, (-we_x, -we_y, -we_z)
+
+
+#yield the blocks of a schematic, skipping any whose ident + extra is in skip
+def schem_to_blocks(file, skip = ()):
+    xs, ys, zs, ids, states = schem_to_arrays(file, skip = skip)
+    for x, y, z, idx in zip(xs.tolist(), ys.tolist(), zs.tolist(), ids.tolist()):
+        ident, extra = states[idx]
+        yield Block(x, y, z, ident, extra)
+
+
+#the size in bytes of the payload of tags which are always the same size
+NBT_FIXED_SIZES = {TAG_BYTE : 1, TAG_SHORT : 2, TAG_INT : 4, TAG_LONG : 8, TAG_FLOAT : 4, TAG_DOUBLE : 8}
+
+
+#the position just after the payload of a tag with id tag_id starting at pos in the big endian nbt buf, without decoding it
+def skip_nbt_payload(buf, pos, tag_id):
+    if tag_id in NBT_FIXED_SIZES:
+        return pos + NBT_FIXED_SIZES[tag_id]
+    elif tag_id == TAG_BYTE_ARRAY:
+        return pos + 4 + struct.unpack_from(">i", buf, pos)[0]
+    elif tag_id == TAG_INT_ARRAY:
+        return pos + 4 + 4 * struct.unpack_from(">i", buf, pos)[0]
+    elif tag_id == TAG_LONG_ARRAY:
+        return pos + 4 + 8 * struct.unpack_from(">i", buf, pos)[0]
+    elif tag_id == TAG_STRING:
+        return pos + 2 + struct.unpack_from(">H", buf, pos)[0]
+    elif tag_id == TAG_LIST:
+        item_id, count = struct.unpack_from(">bi", buf, pos)
+        pos += 5
+        if item_id in NBT_FIXED_SIZES:
+            return pos + count * NBT_FIXED_SIZES[item_id]
+        for _ in range(count):
+            pos = skip_nbt_payload(buf, pos, item_id)
+        return pos
+    elif tag_id == TAG_COMPOUND:
+        #fixed size tags and strings are stepped over here rather than by recursing, as they are most of what compounds hold
+        while True:
+            item_id = buf[pos]
+            if item_id == TAG_END:
+                return pos + 1
+            pos += 3 + struct.unpack_from(">H", buf, pos + 1)[0]
+            if item_id in NBT_FIXED_SIZES:
+                pos += NBT_FIXED_SIZES[item_id]
+            elif item_id == TAG_STRING:
+                pos += 2 + struct.unpack_from(">H", buf, pos)[0]
+            else:
+                pos = skip_nbt_payload(buf, pos, item_id)
+    else:
+        raise ValueError(f"Unknown nbt tag id {tag_id}")
+
+
+#how many different payloads skip_repeated_nbt_payload remembers for lists starting with the same item id and count
+NBT_REPEATS_KEPT = 16
+
+#like skip_nbt_payload, but lists are remembered in seen (a dict, empty to start with) and a list with the same bytes as one
+#skipped before is stepped over by comparing them. Block entities in a schematic mostly repeat the same few item lists
+def skip_repeated_nbt_payload(buf, pos, tag_id, seen):
+    if tag_id != TAG_LIST:
+        return skip_nbt_payload(buf, pos, tag_id)
+    candidates = seen.setdefault(bytes(buf[pos : pos + 5]), [])
+    for payload in candidates:
+        if buf[pos : pos + len(payload)] == payload:
+            return pos + len(payload)
+    end = skip_nbt_payload(buf, pos, tag_id)
+    if len(candidates) < NBT_REPEATS_KEPT:
+        candidates.append(bytes(buf[pos : end]))
+    return end
+
+#find the tags in the compound whose payload starts at pos in buf without decoding them
+#returns a list of (name, tag id, payload position) and the position just after the compound
+#seen is passed on to skip_repeated_nbt_payload, for scanning many compounds which are mostly the same
+def scan_nbt_compound(buf, pos, seen = None):
+    items = []
+    while buf[pos] != TAG_END:
+        tag_id = buf[pos]
+        name_length = struct.unpack_from(">H", buf, pos + 1)[0]
+        name = bytes(buf[pos + 3 : pos + 3 + name_length]).decode("utf-8")
+        pos += 3 + name_length
+        items.append((name, tag_id, pos))
+        pos = skip_nbt_payload(buf, pos, tag_id) if seen is None else skip_repeated_nbt_payload(buf, pos, tag_id, seen)
+    return items, pos + 1
+
+
+#find where everything is in the uncompressed nbt of a sponge schematic without decoding it, path is only for error messages
+#returns a dict of "palette" (palette index -> ident + extra), "size" ([width, height, length]), "corner" (the WEOffset),
+#"block_data" ([offset, length] of the BlockData bytes) and "entities" ([x, y, z, start, end] for each block entity compound)
+#if entity_tags are given, each entity also gets a dict of those tag names it has -> the position of their payload and the
+#position just after it, which saves scanning the entities again to find them
+def scan_schem_nbt(buf, path = "schematic", entity_tags = ()):
+    if buf[0] != TAG_COMPOUND:
+        raise ValueError(f"{path} is not an nbt file")
+
+    index = {"palette" : {}, "corner" : [0, 0, 0], "entities" : []}
+    sizes = {}
+    #the root compound is walked here rather than with scan_nbt_compound so that the block entities are only stepped through once
+    pos = 3 + struct.unpack_from(">H", buf, 1)[0]
+    while buf[pos] != TAG_END:
+        tag_id = buf[pos]
+        name_length = struct.unpack_from(">H", buf, pos + 1)[0]
+        name = bytes(buf[pos + 3 : pos + 3 + name_length]).decode("utf-8")
+        pos += 3 + name_length
+        if name in {"Width", "Height", "Length"} and tag_id == TAG_SHORT:
+            sizes[name] = struct.unpack_from(">H", buf, pos)[0]
+        elif name == "Palette" and tag_id == TAG_COMPOUND:
+            for ident_extra, item_id, item_pos in scan_nbt_compound(buf, pos)[0]:
+                if item_id == TAG_INT:
+                    index["palette"][struct.unpack_from(">i", buf, item_pos)[0]] = ident_extra
+        elif name == "BlockData" and tag_id == TAG_BYTE_ARRAY:
+            index["block_data"] = [pos + 4, struct.unpack_from(">i", buf, pos)[0]]
+        elif name == "BlockEntities" and tag_id == TAG_LIST and buf[pos] == TAG_COMPOUND:
+            count = struct.unpack_from(">i", buf, pos + 1)[0]
+            pos += 5
+            seen = {}
+            for _ in range(count):
+                ent_items, ent_end = scan_nbt_compound(buf, pos, seen)
+                tags = {}
+                for k, (ent_name, ent_id, ent_pos) in enumerate(ent_items):
+                    if ent_name == "Pos" and ent_id == TAG_INT_ARRAY:
+                        index["entities"].append([*struct.unpack_from(">3i", buf, ent_pos + 4), pos, ent_end])
+                    if ent_name in entity_tags:
+                        #a payload ends where the next tag's id and name start, or on the compound's end tag
+                        if k + 1 < len(ent_items):
+                            next_name = ent_items[k + 1][0]
+                            tags[ent_name] = [ent_pos, ent_items[k + 1][2] - 3 - len(next_name.encode("utf-8"))]
+                        else:
+                            tags[ent_name] = [ent_pos, ent_end - 1]
+                if entity_tags and len(index["entities"]) != 0 and index["entities"][-1][3] == pos:
+                    index["entities"][-1].append(tags)
+                pos = ent_end
+            continue #pos is already after the list
+        elif name == "Metadata" and tag_id == TAG_COMPOUND:
+            offsets = {key : struct.unpack_from(">i", buf, item_pos)[0] for key, item_id, item_pos in scan_nbt_compound(buf, pos)[0] if item_id == TAG_INT}
+            index["corner"] = [offsets.get("WEOffsetX", 0), offsets.get("WEOffsetY", 0), offsets.get("WEOffsetZ", 0)]
+        pos = skip_nbt_payload(buf, pos, tag_id)
+
+    if len(sizes) != 3 or "block_data" not in index:
+        raise ValueError(f"{path} is not a sponge schematic")
+    index["size"] = [sizes["Width"], sizes["Height"], sizes["Length"]]
+    return index
+
+
+#look up blocks in a big .schem file without loading all of it
+#the file is decompressed once into an uncompressed sidecar file next to it (path + ".nbt" unless sidecar is given) which is
+#memory mapped, so reopening is quick and only the parts of BlockData that are looked at are ever read
+#the first open walks the tags of the file to find where everything is, stepping over each block entity but not each cell,
+#and caches what it found in another sidecar (+ ".idx.json")
+#if BlockData has any varints longer than one byte, the byte offset of every CELL_CHECKPOINT-th cell is worked out the first
+#time it is needed and cached too (+ ".idx.npy")
+#coordinates are world coordinates relative to the //paste origin, the same as schem_to_blocks
+class SchemReader():
+    CELL_CHECKPOINT = 64
+
+    def __init__(self, path, sidecar = None):
+        with open(path, "rb") as f:
+            gzipped = f.read(2) == b"\x1f\x8b"
+        if gzipped:
+            self.nbt_path = path + ".nbt" if sidecar is None else sidecar
+            if not os.path.exists(self.nbt_path) or os.path.getmtime(self.nbt_path) < os.path.getmtime(path):
+                #through a temporary file of its own, so readers opening the same schematic at once can't mix their writes
+                with gzip.open(path, "rb") as src, atomic_write(self.nbt_path) as dst:
+                    shutil.copyfileobj(src, dst, 2 ** 20)
+        else:
+            self.nbt_path = path
+
+        with open(self.nbt_path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        self.cell_offsets = None
+
+        index_path = self.nbt_path + ".idx.json"
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(self.nbt_path):
+            with open(index_path) as f:
+                index = json.load(f)
+        else:
+            index = self.scan(path)
+            with atomic_write(index_path) as f:
+                f.write(json.dumps(index).encode("utf-8"))
+
+        self.palette = {int(idx) : ident_extra for idx, ident_extra in index["palette"].items()} #palette index -> ident + extra
+        self.width, self.height, self.length = index["size"]
+        self.corner = tuple(index["corner"]) #world position of the (0, 0, 0) corner relative to the //paste origin
+        self.block_data = tuple(index["block_data"]) #(offset, length) of the BlockData bytes
+        self.entity_offsets = {} #local (x, y, z) -> list of (start, end) byte ranges of block entity compounds
+        for x, y, z, start, end in index["entities"]:
+            self.entity_offsets.setdefault((x, y, z), []).append((start, end))
+        self.cells = self.width * self.height * self.length
+        #if every varint is one byte long, cell i is just byte i
+        self.one_byte = self.block_data[1] == self.cells
+
+    #find where everything is in the nbt, returning a dict which can be saved as json
+    def scan(self, path):
+        return scan_schem_nbt(self.mmap, path)
+
+    def close(self):
+        self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def bytes(self, offset, length):
+        return numpy.frombuffer(self.mmap, dtype = numpy.uint8, count = length, offset = offset)
+
+    #the byte offset within BlockData of every CELL_CHECKPOINT-th cell, followed by the length of BlockData
+    def checkpoints(self):
+        if self.cell_offsets is not None:
+            return self.cell_offsets
+        index_path = self.nbt_path + ".idx.npy"
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(self.nbt_path):
+            self.cell_offsets = numpy.load(index_path)
+            return self.cell_offsets
+
+        #scan for the last byte of each varint a chunk at a time so that memory stays bounded
+        step = self.CELL_CHECKPOINT
+        offset, length = self.block_data
+        offsets = [numpy.zeros(1, dtype = numpy.int64)]
+        cell = 0 #cells ended before this chunk
+        for start in range(0, length, 2 ** 24):
+            ends = numpy.flatnonzero(self.bytes(offset + start, min(2 ** 24, length - start)) < 0x80) + start
+            #ends[i] + 1 is where cell cell + 1 + i starts
+            offsets.append(ends[(-(cell + 1)) % step :: step] + 1)
+            cell += len(ends)
+        if cell != self.cells:
+            raise ValueError(f"BlockData has {cell} entries but the schematic is {self.width}x{self.height}x{self.length}")
+        offsets = numpy.concatenate(offsets)
+        self.cell_offsets = numpy.concatenate([offsets[offsets < length], [length]])
+        with atomic_write(index_path) as f:
+            numpy.save(f, self.cell_offsets)
+        return self.cell_offsets
+
+    #the palette indices of cells start up to stop in BlockData order
+    def read_cells(self, start, stop):
+        offset, length = self.block_data
+        if self.one_byte:
+            return self.bytes(offset + start, stop - start).astype(numpy.int64)
+        checkpoints = self.checkpoints()
+        first = start // self.CELL_CHECKPOINT
+        last = min(-(-stop // self.CELL_CHECKPOINT), len(checkpoints) - 1)
+        values = decode_varints(self.bytes(offset + int(checkpoints[first]), int(checkpoints[last] - checkpoints[first])))
+        return values[start - first * self.CELL_CHECKPOINT : stop - first * self.CELL_CHECKPOINT]
+
+    def local(self, x, y, z):
+        lx, ly, lz = x - self.corner[0], y - self.corner[1], z - self.corner[2]
+        if not (0 <= lx < self.width and 0 <= ly < self.height and 0 <= lz < self.length):
+            raise IndexError(f"({x}, {y}, {z}) is outside the schematic")
+        return lx, ly, lz
+
+    #the ident + extra of the block at (x, y, z)
+    def get(self, x, y, z):
+        x, y, z = self.local(x, y, z)
+        idx = x + z * self.width + y * self.width * self.length
+        return self.palette[int(self.read_cells(idx, idx + 1)[0])]
+
+    def parse_entities(self, p):
+        return [Compound.parse(io.BytesIO(self.mmap[start : end])) for start, end in self.entity_offsets.get(p, [])]
+
+    #the block entity compounds at (x, y, z), with their Id and Pos as stored
+    def get_block_entities(self, x, y, z):
+        return self.parse_entities(self.local(x, y, z))
+
+    #read the part of the schematic with x0 <= x < x1, y0 <= y < y1 and z0 <= z < z1 into a volume, clipped to the schematic
+    #only the rows of BlockData inside the region are decoded
+    #returns the volume and the world position of its (0, 0, 0) corner, like schem_to_volume
+    def region(self, x0, x1, y0, y1, z0, z1):
+        cx, cy, cz = self.corner
+        x0, x1 = max(x0 - cx, 0), min(x1 - cx, self.width)
+        y0, y1 = max(y0 - cy, 0), min(y1 - cy, self.height)
+        z0, z1 = max(z0 - cz, 0), min(z1 - cz, self.length)
+        if x0 >= x1 or y0 >= y1 or z0 >= z1:
+            return Volume(0, 0, 0), (0, 0, 0)
+
+        if self.one_byte:
+            offset, length = self.block_data
+            cells = self.bytes(offset, self.cells).reshape(self.height, self.length, self.width)
+            ids = cells[y0 : y1, z0 : z1, x0 : x1].astype(numpy.int64)
+        else:
+            ids = numpy.empty((y1 - y0, z1 - z0, x1 - x0), dtype = numpy.int64)
+            for y in range(y0, y1):
+                for z in range(z0, z1):
+                    row = z * self.width + y * self.width * self.length
+                    ids[y - y0, z - z0] = self.read_cells(row + x0, row + x1)
+
+        volume = Volume(x1 - x0, y1 - y0, z1 - z0)
+        used, inverse = numpy.unique(ids, return_inverse = True)
+        remap = numpy.array([volume.state(self.palette[int(idx)]) for idx in used], dtype = numpy.int32)
+        volume.data = remap[inverse.ravel()]
+
+        names = {idx : ident_extra for ident_extra, idx in volume.palette.items()}
+        for p in self.entity_offsets:
+            x, y, z = p
+            if x0 <= x < x1 and y0 <= y < y1 and z0 <= z < z1:
+                ents = [Compound({key : value for key, value in ent.items() if key not in {"Id", "Pos"}}) for ent in self.parse_entities(p)]
+                ident, extra = split_state(names[int(volume.data[volume.index(x - x0, y - y0, z - z0)])])
+                volume.entity_blocks[(x - x0, y - y0, z - z0)] = EntityBlock(x + cx, y + cy, z + cz, ident, extra, ents)
+        return volume, (x0 + cx, y0 + cy, z0 + cz)
+
+
+#combine schematic files into one saved at path, see merge_volumes
+#sources is a list of (path, (dx, dy, dz)) where each schematic is moved by (dx, dy, dz) from where it would be pasted
+#the result pastes from the same origin as the sources did
+#the sources are only read, whole, so nothing is written next to them (unlike SchemReader, which leaves sidecar files)
+def merge_schems(sources, path, priorities = None, include_air = False, compression = "default"):
+    parts = []
+    for source, (dx, dy, dz) in sources:
+        volume, (x, y, z) = schem_to_volume(nbtlib.load(source))
+        parts.append((volume, (x + dx, y + dy, z + dz)))
+    volume, (x, y, z) = merge_volumes(parts, priorities, include_air)
+    save_volume_schem(volume, -x, -y, -z, path, compression)
+    return volume, (x, y, z)
 
-    
-    
 
 def print_nbt(file):
     print(f"gzipped = {file.gzipped}")
@@ -0,0 +1,92 @@
+#round trips of BlockData through schemgen, with palettes big enough that the varints take more than one byte
+#run with "python -m pytest"
+import os
+import pickle
+import threading
+
+import numpy
+import nbtlib
+import pytest
+import schemgen
+
+
+#blocks of n_states different block states, each state used twice, the second time in a shuffled order
+def gen_state_blocks(n_states, seed = 0):
+    order = numpy.random.default_rng(seed).permutation(n_states).tolist()
+    for k, state in enumerate(list(range(n_states)) + order):
+        yield schemgen.Block(k % 64, k // 4096, (k // 64) % 64, "minecraft:stone", f"[state={state}]")
+
+
+@pytest.mark.parametrize("n_states", [128, 300, 4096])
+def test_varints_round_trip(n_states):
+    values = numpy.random.default_rng(n_states).integers(0, n_states, 10000)
+    values[:n_states] = numpy.arange(n_states) #every value, including the largest
+    data = schemgen.encode_varints(values)
+    assert data.dtype == numpy.uint8
+    assert len(data) == len(values) + int((values >= 128).sum())
+    assert (schemgen.decode_varints(data) == values).all()
+
+
+def test_varints_sizes():
+    values = numpy.array([0, 127, 128, 16383, 16384, 2 ** 21, 2 ** 28, 2 ** 32 - 1])
+    data = schemgen.encode_varints(values)
+    assert data.tolist()[:6] == [0, 127, 0x80, 1, 0xFF, 0x7F]
+    assert len(data) == 1 + 1 + 2 + 2 + 3 + 4 + 5 + 5
+    assert (schemgen.decode_varints(data) == values).all()
+
+
+def test_varints_bad_data():
+    with pytest.raises(ValueError):
+        schemgen.decode_varints(numpy.array([0x80], dtype = numpy.uint8))
+    with pytest.raises(ValueError):
+        schemgen.decode_varints(numpy.array([0x80] * 5 + [0], dtype = numpy.uint8))
+
+
+@pytest.mark.parametrize("n_states", [128, 300, 4096])
+def test_schem_round_trip(n_states, tmp_path):
+    blocks = list(gen_state_blocks(n_states))
+    path = os.path.join(tmp_path, "out.schem")
+    schemgen.blocks_to_schem(blocks, 0, 0, 0).save(path)
+
+    file = nbtlib.load(path)
+    assert len(file.root["Palette"]) == n_states + 1 #and air
+    expected = {block.pos : block.ident + block.extra for block in blocks}
+    found = {block.pos : block.ident + block.extra for block in schemgen.schem_to_blocks(file, skip = {"minecraft:air"})}
+    assert found == expected
+
+
+def test_unknown_compression(tmp_path):
+    volume = schemgen.Volume(1, 1, 1)
+    with pytest.raises(ValueError):
+        schemgen.save_volume_schem(volume, 0, 0, 0, os.path.join(tmp_path, "out.schem"), "zip")
+    with schemgen.BackgroundSaver() as saver, pytest.raises(ValueError):
+        saver.save_volume_schem(volume, 0, 0, 0, os.path.join(tmp_path, "out.schem"), "zip")
+    assert os.listdir(tmp_path) == []
+
+
+#readers opening the same schematic at once each write its sidecars through their own temporary file
+def test_schem_reader_concurrent_open(tmp_path):
+    path = os.path.join(tmp_path, "in.schem")
+    schemgen.save_schem(gen_state_blocks(300), 0, 0, 0, path)
+    found = []
+    def read():
+        with schemgen.SchemReader(path) as reader:
+            found.append((reader.get(5, 0, 3), len(reader.checkpoints())))
+    threads = [threading.Thread(target = read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(found) == 4 and len(set(found)) == 1
+    assert sorted(os.listdir(tmp_path)) == ["in.schem", "in.schem.nbt", "in.schem.nbt.idx.json", "in.schem.nbt.idx.npy"]
+
+
+#Signals share their items and prebuilt nbt with a template, so they can only be given new items, which drops the nbt
+def test_signal_items_not_shared():
+    a, b = schemgen.Signal(0, 0, 0, 7), schemgen.Signal(1, 0, 0, 7)
+    with pytest.raises(TypeError):
+        a.items[0] = ("minecraft:stone", 1)
+    a.items = {0 : ("minecraft:stone", 1)}
+    assert a.items_nbt is None
+    assert b.items == schemgen.SIGNAL_TEMPLATES[7].items and b.items_nbt is not None
+    assert pickle.loads(pickle.dumps(a)).items == {0 : ("minecraft:stone", 1)}